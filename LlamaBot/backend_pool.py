@@ -0,0 +1,253 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+import aiohttp
+
+from ollama_client import OllamaClient, OllamaError
+
+logger = logging.getLogger(__name__)
+
+# Errors after which a request is retried on another node.
+FAILOVER_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+def is_failover(error):
+    return isinstance(error, FAILOVER_ERRORS) or (isinstance(error, OllamaError) and error.status >= 500)
+
+
+class Backend:
+    """
+    One Ollama node and what the last health check learned about it.
+    """
+    def __init__(self, url, client):
+        self.url = url
+        self.client = client
+        self.healthy = True
+        self.models = set()
+        self.loaded = set()
+        self.in_flight = 0
+
+
+class BackendPool:
+    """
+    A pool of Ollama nodes behind the same interface the cogs used for a single server.
+
+    A background task polls /api/tags and /api/ps on every node to learn which models it has
+    and which are loaded. Requests for a model go to the node the user's conversation last ran
+    on, so its prompt cache is reused, otherwise to a node with the model already in memory,
+    then to any node that has it, least busy first. A node that fails is marked unhealthy and
+    the request fails over to the next candidate until the health check brings it back.
+    """
+    def __init__(self, urls, health_interval=30, max_affinity=10000, on_refresh=None, **client_options):
+        if not urls:
+            raise ValueError("No Ollama server URLs given")
+        self.backends = OrderedDict((url, Backend(url, OllamaClient(url, **client_options))) for url in urls)
+        self.health_interval = health_interval
+        self.max_affinity = max_affinity
+        self.on_refresh = on_refresh
+        self.affinity = OrderedDict()
+        self.health_task = None
+
+    @property
+    def available_models(self):
+        """
+        Sorted union of the models on every healthy node.
+        """
+        return sorted(set().union(*(backend.models for backend in self.backends.values() if backend.healthy)))
+
+    def start(self):
+        if self.health_task is None:
+            self.health_task = asyncio.create_task(self.health_loop())
+
+    async def health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            try:
+                models = await self.refresh()
+                if self.on_refresh is not None:
+                    await self.on_refresh(models)
+            except Exception as e:
+                logger.warning(f"Health check found no usable Ollama node: {str(e)}")
+
+    async def check(self, backend):
+        """
+        Refresh one node's model list and loaded models. Returns the error if the node is down.
+        """
+        try:
+            tags, ps = await asyncio.gather(backend.client.get('/api/tags'), backend.client.get('/api/ps'))
+        except (OllamaError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if backend.healthy:
+                logger.warning(f"Ollama node {backend.url} is unhealthy: {str(e)}")
+            backend.healthy = False
+            return e
+        if not backend.healthy:
+            logger.info(f"Ollama node {backend.url} is healthy again")
+        backend.healthy = True
+        backend.models = {model['name'] for model in tags.get('models', [])}
+        backend.loaded = {model['name'] for model in ps.get('models', [])}
+        return None
+
+    async def refresh(self):
+        """
+        Health-check every node now and return the union of their models.
+        Raises the last error if no node answered.
+        """
+        errors = await asyncio.gather(*(self.check(backend) for backend in self.backends.values()))
+        if not errors or all(errors):
+            raise errors[-1] if errors else aiohttp.ClientError("No Ollama nodes to check")
+        return self.available_models
+
+    def candidates(self, model, user_id=None):
+        """
+        Node URLs that can serve the model, best first. Falls back to every node when none is known to be healthy.
+        """
+        healthy = [backend for backend in self.backends.values() if backend.healthy]
+        if not healthy:
+            return list(self.backends)
+        having = [backend for backend in healthy if model in backend.models] or healthy
+        having.sort(key=lambda backend: (model not in backend.loaded, backend.in_flight))
+        urls = [backend.url for backend in having]
+        preferred = self.affinity.get((user_id, model))
+        if preferred in urls:
+            urls.remove(preferred)
+            urls.insert(0, preferred)
+        return urls
+
+    def remember(self, user_id, model, url):
+        if user_id is None:
+            return
+        self.affinity[(user_id, model)] = url
+        self.affinity.move_to_end((user_id, model))
+        while len(self.affinity) > self.max_affinity:
+            self.affinity.popitem(last=False)
+
+    def route(self, model, user_id, backend):
+        urls = self.candidates(model, user_id)
+        if backend in urls:
+            urls.remove(backend)
+            urls.insert(0, backend)
+        return [self.backends[url] for url in urls]
+
+    def mark_failed(self, backend, error):
+        logger.warning(f"Request to Ollama node {backend.url} failed, failing over: {str(error)}")
+        backend.healthy = False
+
+    async def chat(self, payload, user_id=None, backend=None):
+        """
+        Run a non-streaming /api/chat request, starting on the given node if any.
+        """
+        return await self.post('/api/chat', payload, user_id, backend)
+
+    async def embed(self, model, inputs):
+        """
+        Return the embedding vectors of a list of texts from /api/embed.
+        """
+        data = await self.post('/api/embed', {'model': model, 'input': inputs})
+        return data['embeddings']
+
+    async def post(self, path, payload, user_id=None, backend=None):
+        """
+        POST a request for payload['model'] to the best node, failing over to the next one on connection errors.
+        """
+        model = payload['model']
+        nodes = self.route(model, user_id, backend)
+        for i, node in enumerate(nodes):
+            node.in_flight += 1
+            try:
+                data = await node.client.post(path, payload)
+            except Exception as e:
+                if not is_failover(e) or i == len(nodes) - 1:
+                    raise
+                self.mark_failed(node, e)
+                continue
+            finally:
+                node.in_flight -= 1
+            node.loaded.add(model)
+            self.remember(user_id, model, node.url)
+            return data
+
+    async def stream_chat(self, payload, user_id=None, backend=None):
+        """
+        Stream a /api/chat request. Fails over to another node only if nothing has been received yet.
+        """
+        model = payload['model']
+        nodes = self.route(model, user_id, backend)
+        for i, node in enumerate(nodes):
+            started = False
+            node.in_flight += 1
+            try:
+                async for chunk in node.client.stream('/api/chat', payload):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if started or not is_failover(e) or i == len(nodes) - 1:
+                    raise
+                self.mark_failed(node, e)
+                continue
+            finally:
+                node.in_flight -= 1
+            node.loaded.add(model)
+            self.remember(user_id, model, node.url)
+            return
+
+    async def load_model(self, model, keep_alive):
+        """
+        Load the model into memory on its best node without generating anything.
+        """
+        await self.post('/api/chat', {'model': model, 'messages': [], 'keep_alive': keep_alive})
+
+    async def unload_model(self, model):
+        """
+        Unload the model from every node that has it in memory.
+        """
+        nodes = [backend for backend in self.backends.values() if model in backend.loaded]
+        results = await asyncio.gather(*(node.client.post('/api/chat', {'model': model, 'messages': [], 'keep_alive': 0}) for node in nodes), return_exceptions=True)
+        for node, result in zip(nodes, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to unload model '{model}' from {node.url}: {str(result)}")
+            else:
+                node.loaded.discard(model)
+
+    async def create_model(self, data):
+        """
+        Create the model on every healthy node. Raises the first error if no node succeeded.
+        """
+        nodes = [backend for backend in self.backends.values() if backend.healthy] or list(self.backends.values())
+        results = await asyncio.gather(*(node.client.post('/api/create', data) for node in nodes), return_exceptions=True)
+        response = None
+        for node, result in zip(nodes, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to create model '{data['name']}' on {node.url}: {str(result)}")
+            else:
+                node.models.add(data['name'])
+                response = response or result
+        if response is None:
+            raise results[0]
+        return response
+
+    async def delete_model(self, name):
+        """
+        Delete the model from every node that has it. Raises OllamaError(404) if no node had it.
+        """
+        nodes = [backend for backend in self.backends.values() if name in backend.models] or list(self.backends.values())
+        results = await asyncio.gather(*(node.client.delete('/api/delete', {"name": name}) for node in nodes), return_exceptions=True)
+        errors = []
+        for node, result in zip(nodes, results):
+            if isinstance(result, Exception):
+                errors.append(result)
+            else:
+                node.models.discard(name)
+                node.loaded.discard(name)
+        if len(errors) == len(nodes):
+            raise errors[0]
+        for error in errors:
+            logger.warning(f"Failed to delete model '{name}' from a node: {str(error)}")
+
+    async def close(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+            await asyncio.gather(self.health_task, return_exceptions=True)
+            self.health_task = None
+        for backend in self.backends.values():
+            await backend.client.close()
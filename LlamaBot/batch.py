@@ -0,0 +1,289 @@
+"""
+Run a file of prompts against one model, for evals or generating FAQ answers, without touching
+anyone's chat history. Prompts are either plain text, one per line, or JSON lines:
+
+    {"id": "q1", "prompt": "What is a llama?", "system": "Answer in one sentence."}
+
+Results are appended to a JSON lines file as they arrive, one line per prompt with its id, the
+response (or the error) and Ollama's token counts. Used by /batch, and from the command line:
+
+    python batch.py prompts.txt results.jsonl --model dolphin-mistral --concurrency 8
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+import aiofiles
+import aiohttp
+from dotenv import load_dotenv
+
+from backend_pool import BackendPool
+from history_store import estimate_tokens
+from ollama_client import OllamaError
+from quota import QuotaExceeded
+from scheduler import QueueFull, RequestScheduler
+
+logger = logging.getLogger(__name__)
+
+
+def read_prompts(text, max_prompts=None):
+    """
+    Parse a prompts file into a list of (id, prompt, system) tuples. Lines starting with '{' are
+    JSON objects with a 'prompt' and optionally an 'id' and a 'system' prompt; any other line is a
+    prompt on its own, with its line number as id. Raises ValueError naming the first bad line,
+    or as soon as there are more than max_prompts prompts.
+    """
+    prompts = []
+    ids = set()
+    for number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"Line {number} is not valid JSON: {str(e)}") from None
+            if not isinstance(record, dict) or not isinstance(record.get('prompt'), str):
+                raise ValueError(f"Line {number} has no 'prompt'")
+            prompt = (str(record.get('id', number)), record['prompt'], record.get('system'))
+        else:
+            prompt = (str(number), line, None)
+        if prompt[0] in ids:
+            raise ValueError(f"Line {number} repeats the id '{prompt[0]}'")
+        ids.add(prompt[0])
+        prompts.append(prompt)
+        if max_prompts is not None and len(prompts) > max_prompts:
+            raise ValueError(f"The file has more than {max_prompts} prompts")
+    return prompts
+
+
+def batch_key(user_id, model, prompts):
+    """
+    Name for the results of a batch, the same whenever the same user runs the same prompts against the same model.
+    """
+    digest = hashlib.sha256(json.dumps([user_id, model, prompts], ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def answered(path):
+    """
+    Ids of the prompts with a response in an existing results file. Failed prompts are run again.
+    """
+    ids = set()
+    if not os.path.exists(path):
+        return ids
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may have been cut short by a crash.
+                continue
+            if 'response' in record:
+                ids.add(record['id'])
+    return ids
+
+
+def ends_with_newline(path):
+    """
+    Whether a results file is missing, empty or ends with a complete line.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return True
+    with open(path, 'rb') as file:
+        file.seek(-1, os.SEEK_END)
+        return file.read(1) == b'\n'
+
+
+class BatchRunner:
+    """
+    Runs prompts against one model with up to concurrency requests in flight and a single writer
+    appending each result to the results file as soon as it arrives. Prompts already answered in
+    the file are skipped, so running an interrupted batch again picks up where it stopped.
+
+    Requests go through the scheduler like chat requests, on behalf of the user who started the
+    batch, so a batch gets that user's fair share of the GPUs rather than all of them; when the
+    user's queue is full a request waits retry_delay seconds and tries again. With quotas (a
+    quota.QuotaManager) each prompt is admitted and charged against that user's and guild's token
+    budgets like a chat message; a prompt over budget is recorded as failed and runs again next time.
+    Budgets kept elsewhere are checked with admit, an async function of the prompt's estimated
+    tokens that answers like QuotaManager.admit (a worker process asks the gateway about guilds).
+    """
+    def __init__(self, scheduler, client, model, user_id=None, guild_id=None, metrics=None, keep_alive=None,
+                 options=None, concurrency=4, retry_delay=2.0, quotas=None, admit=None):
+        self.scheduler = scheduler
+        self.client = client
+        self.model = model
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.metrics = metrics
+        self.keep_alive = keep_alive
+        self.options = options or {}
+        self.concurrency = concurrency
+        self.retry_delay = retry_delay
+        self.quotas = quotas
+        self.admit = admit
+        self.total = 0
+        self.skipped = 0
+        self.completed = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.tokens = 0
+        self.started = None
+
+    def stats(self):
+        seconds = time.perf_counter() - self.started if self.started is not None else 0.0
+        return {
+            'model': self.model,
+            'total': self.total,
+            'skipped': self.skipped,
+            'completed': self.completed,
+            'failed': self.failed,
+            'prompt_tokens': self.prompt_tokens,
+            'tokens': self.tokens,
+            'seconds': seconds,
+            'tokens_per_second': self.tokens / seconds if seconds else 0.0
+        }
+
+    async def run(self, prompts, path, on_progress=None, progress_interval=5.0):
+        """
+        Run the prompts not yet answered in the results file at path and return the final stats().
+        on_progress is awaited with stats() at most every progress_interval seconds while it runs.
+        """
+        done = answered(path)
+        pending = asyncio.Queue()
+        for prompt in prompts:
+            if prompt[0] not in done:
+                pending.put_nowait(prompt)
+        self.total = len(prompts)
+        self.skipped = self.total - pending.qsize()
+        self.started = time.perf_counter()
+        results = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        generators = [asyncio.create_task(self.generate_loop(pending, results)) for _ in range(min(self.concurrency, pending.qsize()))]
+        writer = asyncio.create_task(self.write_loop(results, path, on_progress, progress_interval))
+
+        async def generate_all():
+            await asyncio.gather(*generators)
+            await results.put(None)
+
+        try:
+            await asyncio.gather(generate_all(), writer)
+        finally:
+            for task in generators + [writer]:
+                task.cancel()
+            await asyncio.gather(*generators, writer, return_exceptions=True)
+        return self.stats()
+
+    async def generate_loop(self, pending, results):
+        while not pending.empty():
+            await results.put(await self.generate(*pending.get_nowait()))
+
+    async def generate(self, prompt_id, prompt, system=None):
+        """
+        Run one prompt and return its result record.
+        """
+        messages = [{'role': 'system', 'content': system}] if system else []
+        messages.append({'role': 'user', 'content': prompt})
+        payload = {'model': self.model, 'messages': messages, 'stream': False, 'options': self.options}
+        if self.keep_alive is not None:
+            payload['keep_alive'] = self.keep_alive
+        started = time.perf_counter()
+        low_priority = False
+        tokens = sum(estimate_tokens(message['content']) for message in messages)
+        try:
+            if self.quotas is not None and not self.quotas.admit(self.user_id, self.guild_id, tokens):
+                low_priority = True
+            if self.admit is not None and not await self.admit(tokens):
+                low_priority = True
+            while True:
+                try:
+                    async with self.scheduler.slot(self.model, self.user_id, self.guild_id, low_priority=low_priority) as backend:
+                        data = await self.client.chat(payload, self.user_id, backend)
+                    break
+                except QueueFull:
+                    await asyncio.sleep(self.retry_delay)
+        except QuotaExceeded as e:
+            return {'id': prompt_id, 'prompt': prompt, 'error': str(e)}
+        except OllamaError as e:
+            return {'id': prompt_id, 'prompt': prompt, 'error': f"HTTP {e.status}: {e.details}"}
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return {'id': prompt_id, 'prompt': prompt, 'error': str(e) or type(e).__name__}
+        if self.metrics is not None:
+            self.metrics.record_generation(self.model, data)
+        if self.quotas is not None:
+            self.quotas.charge(self.user_id, self.guild_id, data)
+        return {
+            'id': prompt_id,
+            'prompt': prompt,
+            'response': data['message']['content'],
+            'prompt_tokens': data.get('prompt_eval_count') or 0,
+            'tokens': data.get('eval_count') or 0,
+            'seconds': round(time.perf_counter() - started, 3)
+        }
+
+    async def write_loop(self, results, path, on_progress, progress_interval):
+        reported = time.perf_counter()
+        torn = not ends_with_newline(path)
+        async with aiofiles.open(path, 'a', encoding='utf-8') as file:
+            if torn:
+                # Start on a new line after the half of one an interrupted run left behind.
+                await file.write('\n')
+            while (record := await results.get()) is not None:
+                await file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                if 'response' in record:
+                    self.completed += 1
+                    self.prompt_tokens += record['prompt_tokens']
+                    self.tokens += record['tokens']
+                else:
+                    self.failed += 1
+                if on_progress is not None and time.perf_counter() - reported >= progress_interval:
+                    await file.flush()
+                    reported = time.perf_counter()
+                    try:
+                        await on_progress(self.stats())
+                    except Exception as e:
+                        logger.warning(f"Failed to report batch progress: {str(e)}")
+
+
+async def main(args):
+    async with aiofiles.open(args.prompts, encoding='utf-8') as file:
+        prompts = read_prompts(await file.read())
+    pool = BackendPool([url.strip() for url in args.ollama.split(',') if url.strip()])
+    scheduler = RequestScheduler(max_per_model=args.concurrency, max_per_backend=args.concurrency, max_queued_per_user=args.concurrency, router=pool.candidates)
+    runner = BatchRunner(scheduler, pool, args.model, options={'num_ctx': args.num_ctx}, concurrency=args.concurrency)
+
+    async def on_progress(stats):
+        logger.info(f"{stats['skipped'] + stats['completed'] + stats['failed']}/{stats['total']} prompts, {stats['tokens_per_second']:.1f} tokens/s")
+
+    try:
+        try:
+            await pool.refresh()
+        except (OllamaError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"No Ollama node answered the health check, trying anyway: {str(e)}")
+        stats = await runner.run(prompts, args.results, on_progress, args.progress_interval)
+    finally:
+        await pool.close()
+    logger.info(
+        f"Ran {stats['completed']} prompts ({stats['failed']} failed, {stats['skipped']} already answered) in {stats['seconds']:.1f}s: "
+        f"{stats['prompt_tokens']} prompt and {stats['tokens']} generated tokens, {stats['tokens_per_second']:.1f} tokens/s"
+    )
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Run a file of prompts against one model, appending the results to a JSON lines file.")
+    parser.add_argument('prompts', help="one prompt per line, or JSON lines with 'prompt' and optional 'id' and 'system'")
+    parser.add_argument('results', help="results file; prompts already answered in it are skipped")
+    parser.add_argument('--model', default='dolphin-mistral', help="(default: %(default)s)")
+    parser.add_argument('--concurrency', type=int, default=4, help="requests in flight (default: %(default)s)")
+    parser.add_argument('--ollama', default=os.getenv('OLLAMA_IP', 'http://localhost:11434'), help="Ollama servers, separated by commas (default: OLLAMA_IP)")
+    parser.add_argument('--num-ctx', type=int, default=16384, help="(default: %(default)s)")
+    parser.add_argument('--progress-interval', type=float, default=5.0, help="seconds between progress lines (default: %(default)s)")
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(main(parser.parse_args()))
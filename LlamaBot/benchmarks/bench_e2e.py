@@ -0,0 +1,305 @@
+"""
+End-to-end benchmark of the bot's own overhead, without Discord or a GPU.
+
+A local fake Ollama server (see fake_ollama.py) answers with a fixed latency and token rate,
+and ChatCog.chat, the regenerate button and HistoryCog.clear_history are driven through fake
+interactions by a number of simulated users at once. Reports p50/p95/p99 latency per command,
+throughput and peak memory, and writes the results as JSON so runs can be compared between
+commits.
+
+Run from the LlamaBot directory:
+
+    python benchmarks/bench_e2e.py --users 20 --turns 5
+    python benchmarks/bench_e2e.py --compare benchmarks/results/<earlier run>.json
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend_pool import BackendPool
+from context_builder import ContextBuilder
+from history_store import HistoryStore
+from model_catalogue import ModelCatalogue
+from response_cache import ResponseCache
+from scheduler import RequestScheduler
+from metrics import Metrics
+from residency import ResidencyManager
+from prefetch import Prefetcher
+from fake_ollama import FakeOllama
+from bot import CONFIG
+
+chat_cog = importlib.import_module('cogs.llm-cogs.chat_cog')
+history_cog = importlib.import_module('cogs.llm-cogs.history_cog')
+utility_cog = importlib.import_module('cogs.llm-cogs.utility_cog')
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MODEL = 'bench-model'
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+class FakeMessage:
+    def __init__(self, view=None):
+        self.view = view
+        self.edits = 0
+
+    async def edit(self, **kwargs):
+        self.edits += 1
+        if 'view' in kwargs:
+            self.view = kwargs['view']
+
+
+class FakeFollowup:
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, **kwargs):
+        message = FakeMessage(kwargs.get('view'))
+        self.messages.append(message)
+        return message
+
+
+class FakeResponse:
+    def __init__(self, message=None):
+        self.message = message
+
+    async def defer(self):
+        pass
+
+    async def edit_message(self, **kwargs):
+        await self.message.edit(**kwargs)
+
+
+class FakeInteraction:
+    """
+    Just enough of discord.Interaction for the chat, button and clear_history paths.
+    message is the message a pressed button is on.
+    """
+    def __init__(self, client, user_id, guild_id=1, message=None):
+        self.client = client
+        self.user = SimpleNamespace(id=user_id)
+        self.guild_id = guild_id
+        self.message = message
+        self.response = FakeResponse(message)
+        self.followup = FakeFollowup()
+
+    async def delete_original_response(self):
+        pass
+
+    def button(self, action):
+        """
+        Return (message, button) for the given paginator button on the latest response, or (None, None).
+        """
+        for message in reversed(self.followup.messages):
+            if message.view is not None:
+                for item in message.view.children:
+                    if item.custom_id.endswith(f':{action}'):
+                        return message, item
+        return None, None
+
+
+def percentile(samples, q):
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, max(0, round(q / 100 * len(samples)) - 1))
+    return samples[index]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples) if samples else 0.0,
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def build_bot(url, directory, args):
+    """
+    Wire up the bot's services the same way bot.py does, against the fake server.
+    """
+    config = dict(CONFIG, stream_responses=not args.no_stream, stream_edit_interval=args.edit_interval)
+    bot = SimpleNamespace(config=config, metrics=Metrics())
+    bot.ollama = BackendPool([url], health_interval=3600)
+    bot.catalogue = ModelCatalogue(bot.ollama, os.path.join(directory, 'available_models.txt'))
+    bot.scheduler = RequestScheduler(
+        max_per_model=args.max_per_model,
+        max_per_backend=args.max_per_model,
+        max_queued=args.users * 2,
+        max_queued_per_user=3,
+        router=bot.ollama.candidates
+    )
+    bot.history = HistoryStore(os.path.join(directory, 'conversation_history.db'), durability=args.durability)
+    bot.residency = ResidencyManager(bot.ollama, bot.history, bot.metrics)
+    bot.response_cache = ResponseCache() if args.response_cache else None
+    bot.prefetcher = Prefetcher(bot.scheduler, bot.ollama, bot.metrics, count=args.prefetch) if args.prefetch else None
+    bot.context = ContextBuilder(bot.history, bot.ollama, bot.scheduler)
+    bot.quotas = None
+    bot.jobs = utility_cog.LocalJobs(bot)
+    bot.paginators = utility_cog.PaginatorCache(config['paginator_cache_entries'])
+    await bot.history.open()
+    await bot.catalogue.refresh()
+    if bot.response_cache is not None:
+        await bot.response_cache.open()
+    return bot
+
+
+async def close_bot(bot):
+    if bot.prefetcher is not None:
+        await bot.prefetcher.close()
+    await bot.context.close()
+    await bot.history.close()
+    if bot.response_cache is not None:
+        await bot.response_cache.close()
+    await bot.ollama.close()
+    await bot.jobs.close()
+
+
+async def timed(latencies, name, coroutine):
+    started = time.perf_counter()
+    await coroutine
+    latencies.setdefault(name, []).append(time.perf_counter() - started)
+
+
+async def run_user(bot, chat, history, user_id, args, latencies):
+    for turn in range(args.turns):
+        interaction = FakeInteraction(bot, user_id)
+        message = f"Benchmark question {turn} from user {user_id}: explain the Fibonacci sequence."
+        await timed(latencies, 'chat', chat.chat.callback(chat, interaction, message, MODEL))
+        await asyncio.sleep(args.think_time)
+        if args.regenerate_every and (turn + 1) % args.regenerate_every == 0:
+            message, button = interaction.button('regenerate')
+            if button is not None:
+                await timed(latencies, 'regenerate', button.callback(FakeInteraction(bot, user_id, message=message)))
+    await timed(latencies, 'clear_history', history.clear_history.callback(history, FakeInteraction(bot, user_id), MODEL))
+
+
+async def run(args):
+    server = FakeOllama(
+        models=[MODEL],
+        latency=args.latency,
+        token_rate=args.token_rate,
+        response_tokens=args.response_tokens,
+        code_every=args.code_every,
+        load_time=args.load_time
+    )
+    url = await server.start()
+    with tempfile.TemporaryDirectory() as directory:
+        bot = await build_bot(url, directory, args)
+        chat = chat_cog.ChatCog(bot)
+        history = history_cog.HistoryCog(bot)
+        latencies = {}
+        if args.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(run_user(bot, chat, history, 1000 + i, args, latencies) for i in range(args.users)))
+        finally:
+            wall_time = time.perf_counter() - started
+            traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+            tracemalloc.stop()
+            await close_bot(bot)
+            await server.stop()
+
+    operations = sum(len(samples) for samples in latencies.values())
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': vars(args),
+        'wall_time': wall_time,
+        'operations': operations,
+        'throughput': operations / wall_time if wall_time else 0.0,
+        'ollama_requests': server.requests,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+        'traced_peak_bytes': traced_peak,
+        'latency': {name: summarize(samples) for name, samples in latencies.items()},
+        'stages': bot.metrics.snapshot()['stages']
+    }
+
+
+def report(results, baseline=None):
+    print(f"commit {results['commit']}  {results['operations']} operations in {results['wall_time']:.2f}s"
+          f"  ({results['throughput']:.1f} ops/s, {results['ollama_requests']} Ollama requests)")
+    if results['peak_rss_kb'] is not None:
+        print(f"peak RSS {results['peak_rss_kb'] / 1024:.1f} MiB", end='')
+        if results['traced_peak_bytes'] is not None:
+            print(f", traced peak {results['traced_peak_bytes'] / 1024 / 1024:.1f} MiB", end='')
+        print()
+    print(f"{'command':>14} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, stats in results['latency'].items():
+        line = f"{name:>14} {stats['count']:>6} {stats['p50'] * 1000:>9.1f} {stats['p95'] * 1000:>9.1f} {stats['p99'] * 1000:>9.1f}"
+        old = (baseline or {}).get('latency', {}).get(name)
+        if old:
+            changes = [f"{key} {(stats[key] - old[key]) / old[key]:+.1%}" for key in ('p50', 'p95', 'p99') if old[key]]
+            line += f"   vs {baseline['commit']}: {', '.join(changes)}"
+        print(line)
+    if baseline:
+        print(f"throughput vs {baseline['commit']}: {(results['throughput'] - baseline['throughput']) / baseline['throughput']:+.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10, help="simulated users running at once")
+    parser.add_argument('--turns', type=int, default=5, help="/chat commands per user")
+    parser.add_argument('--regenerate-every', type=int, default=2, help="regenerate every Nth response (0 to never)")
+    parser.add_argument('--latency', type=float, default=0.05, help="fake server time to first token, in seconds")
+    parser.add_argument('--token-rate', type=float, default=500.0, help="fake server tokens per second")
+    parser.add_argument('--response-tokens', type=int, default=300, help="words per fake response")
+    parser.add_argument('--load-time', type=float, default=0.0, help="fake server seconds to load a model on first use")
+    parser.add_argument('--code-every', type=int, default=3, help="include a code block in every Nth response (0 to never)")
+    parser.add_argument('--max-per-model', type=int, default=4, help="concurrent generations the scheduler allows")
+    parser.add_argument('--edit-interval', type=float, default=1.5, help="seconds between streamed message edits")
+    parser.add_argument('--no-stream', action='store_true', help="wait for whole responses instead of streaming")
+    parser.add_argument('--durability', choices=('immediate', 'batched', 'deferred'), default='batched', help="history write durability")
+    parser.add_argument('--response-cache', action='store_true', help="enable the response cache")
+    parser.add_argument('--prefetch', type=int, default=0, help="alternatives to prefetch per response for regenerate")
+    parser.add_argument('--think-time', type=float, default=0.0, help="seconds a user reads a response before acting on it")
+    parser.add_argument('--trace-memory', action='store_true', help="also measure Python allocations with tracemalloc (slower)")
+    parser.add_argument('--output', help="where to write the JSON results (default: benchmarks/results/)")
+    parser.add_argument('--compare', help="earlier JSON results to compare against")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    report(results, baseline)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"e2e-{time.strftime('%Y%m%d-%H%M%S')}-{results['commit'] or 'unknown'}.json")
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
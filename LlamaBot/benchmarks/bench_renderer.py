@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of response rendering on large responses: the single-pass renderer against
+the regex chain ChatCog used before it.
+
+Run from the LlamaBot directory:
+
+    python benchmarks/bench_renderer.py
+"""
+import importlib
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+renderer = importlib.import_module('cogs.llm-cogs.renderer')
+
+MAX_LENGTH = 2048
+SIZES = [10_000, 100_000, 1_000_000]
+
+PARAGRAPH = (
+    "The **quick** brown fox jumps over the __lazy__ dog. It then considers its options<br>"
+    "and writes a [short note](https://example.com) about the experience! Why? Because it can.\n\n"
+)
+CODE = "```python\ndef fox(n):\n    return [i ** 2 for i in range(n)]\n```\n\n"
+
+
+def legacy_render(response, max_length):
+    """
+    The pre-renderer pipeline: format_response, code block findall/sub and split_into_chunks.
+    """
+    response = response.replace('**', '*').replace('__', '_')
+    response = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', r'[\1](\2)', response)
+    response = response.replace('<br>', '\n')
+    code_blocks = re.findall(r'```(\w+)?\n([\s\S]*?)\n```', response)
+    response = re.sub(r'```(\w+)?\n([\s\S]*?)\n```', '', response)
+    if len(response) <= max_length:
+        return [response], code_blocks
+    chunks = []
+    current_chunk = ""
+    for sentence in re.findall(r'(?s)(.*?(?<=[.!?])\s+)', response):
+        if len(current_chunk) + len(sentence) <= max_length:
+            current_chunk += sentence
+        else:
+            if current_chunk:
+                chunks.append(current_chunk.strip())
+            current_chunk = sentence
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+    return chunks, code_blocks
+
+
+def new_render(response, max_length):
+    rendered = renderer.render(response, max_length)
+    return rendered.pages, rendered.code_blocks
+
+
+def make_response(size):
+    text = []
+    length = 0
+    i = 0
+    while length < size:
+        piece = CODE if i % 5 == 4 else PARAGRAPH
+        text.append(piece)
+        length += len(piece)
+        i += 1
+    # A trailing sentence without punctuation, which the legacy chunker drops.
+    return ''.join(text) + "and it ends without punctuation"
+
+
+def bench(function, response, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(response, MAX_LENGTH)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print(f"{'size':>10} {'legacy ms':>10} {'renderer ms':>12} {'speedup':>8} {'legacy lost':>12} {'renderer lost':>14}")
+    for size in SIZES:
+        response = make_response(size)
+        repeat = max(3, 3_000_000 // size)
+        legacy = bench(legacy_render, response, repeat)
+        new = bench(new_render, response, repeat)
+        prose_length = len(''.join(renderer.render(response, MAX_LENGTH).pages).replace(' ', '').replace('\n', ''))
+        legacy_length = len(''.join(legacy_render(response, MAX_LENGTH)[0]).replace(' ', '').replace('\n', ''))
+        expected = len(''.join(
+            renderer.fix_markdown(segment[1]) for segment in renderer.tokenize(response) if segment[0] == 'prose'
+        ).replace(' ', '').replace('\n', ''))
+        print(f"{size:>10} {legacy * 1000:>10.2f} {new * 1000:>12.2f} {legacy / new:>7.1f}x {expected - legacy_length:>12} {expected - prose_length:>14}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+A local stand-in for an Ollama server, for benchmarking the bot without a GPU.
+
+Serves /api/chat (streaming and non-streaming), /api/embed, /api/tags, /api/ps, /api/create
+and /api/delete. Chat responses arrive after a fixed latency and are produced at a fixed
+token rate, so the bot's own overhead can be measured against a known baseline. Models are
+loaded on first use, taking load_time seconds, and unloaded by keep_alive 0, so /api/ps and
+load_duration behave like a real server's.
+"""
+import asyncio
+import hashlib
+import json
+import time
+
+from aiohttp import web
+
+CODE_BLOCK = "```python\ndef fib(n):\n    a, b = 0, 1\n    for _ in range(n):\n        a, b = b, a + b\n    return a\n```\n"
+
+
+class FakeOllama:
+    def __init__(self, models=('bench-model',), latency=0.05, token_rate=200.0, response_tokens=200, chunk_tokens=4, code_every=0, load_time=0.0):
+        """
+        latency is the time to first token in seconds and token_rate the tokens generated per
+        second after it. Each response is response_tokens words, streamed chunk_tokens at a time;
+        every code_every-th response also contains a code block.
+        """
+        self.models = list(models)
+        self.latency = latency
+        self.token_rate = token_rate
+        self.response_tokens = response_tokens
+        self.chunk_tokens = chunk_tokens
+        self.code_every = code_every
+        self.load_time = load_time
+        self.loaded = set()
+        self.embedding_size = 256
+        self.requests = 0
+        self.runner = None
+        self.url = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_post('/api/chat', self.chat)
+        app.router.add_post('/api/embed', self.embed)
+        app.router.add_get('/api/tags', self.tags)
+        app.router.add_get('/api/ps', self.ps)
+        app.router.add_post('/api/create', self.create)
+        app.router.add_delete('/api/delete', self.delete)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def words(self):
+        self.requests += 1
+        words = [f"word{i}" for i in range(self.response_tokens)]
+        if self.code_every and self.requests % self.code_every == 0:
+            words.insert(len(words) // 2, "\n" + CODE_BLOCK)
+        return words
+
+    async def load(self, model):
+        """
+        Load the model if it isn't loaded and return the time spent in nanoseconds.
+        """
+        if model in self.loaded:
+            return 0
+        await asyncio.sleep(self.load_time)
+        self.loaded.add(model)
+        return int(self.load_time * 1e9)
+
+    def metrics(self, payload, started, eval_count):
+        prompt_tokens = sum(len(message.get('content', '')) for message in payload.get('messages', [])) // 4
+        elapsed = time.perf_counter() - started
+        return {
+            'done': True,
+            'total_duration': int(elapsed * 1e9),
+            'prompt_eval_count': prompt_tokens,
+            'prompt_eval_duration': int(self.latency * 1e9),
+            'eval_count': eval_count,
+            'eval_duration': int(max(elapsed - self.latency, 0) * 1e9)
+        }
+
+    async def chat(self, request):
+        payload = await request.json()
+        model = payload.get('model')
+        if model not in self.models:
+            return web.json_response({'error': f"model '{model}' not found"}, status=404)
+        if payload.get('keep_alive') == 0:
+            self.loaded.discard(model)
+            return web.json_response({'model': model, 'done': True, 'done_reason': 'unload'})
+        started = time.perf_counter()
+        load_duration = await self.load(model)
+        if not payload.get('messages'):
+            return web.json_response({'model': model, 'done': True, 'done_reason': 'load'})
+        words = self.words()
+        await asyncio.sleep(self.latency)
+
+        if not payload.get('stream', True):
+            await asyncio.sleep(len(words) / self.token_rate)
+            data = {'model': model, 'message': {'role': 'assistant', 'content': ' '.join(words)}}
+            data.update(self.metrics(payload, started, len(words)), load_duration=load_duration)
+            return web.json_response(data)
+
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        for i in range(0, len(words), self.chunk_tokens):
+            chunk = words[i:i + self.chunk_tokens]
+            await asyncio.sleep(len(chunk) / self.token_rate)
+            content = ' '.join(chunk) + ' '
+            line = {'model': model, 'message': {'role': 'assistant', 'content': content}, 'done': False}
+            await response.write(json.dumps(line).encode() + b'\n')
+        final = {'model': model, 'message': {'role': 'assistant', 'content': ''}}
+        final.update(self.metrics(payload, started, len(words)), load_duration=load_duration)
+        await response.write(json.dumps(final).encode() + b'\n')
+        await response.write_eof()
+        return response
+
+    async def embed(self, request):
+        """
+        Bag-of-words embeddings: each word adds to a dimension picked by its hash, so texts sharing words are similar.
+        """
+        payload = await request.json()
+        inputs = payload['input'] if isinstance(payload['input'], list) else [payload['input']]
+        embeddings = []
+        for text in inputs:
+            vector = [0.0] * self.embedding_size
+            for word in text.lower().split():
+                vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.embedding_size] += 1.0
+            embeddings.append(vector)
+        return web.json_response({'model': payload['model'], 'embeddings': embeddings})
+
+    async def tags(self, request):
+        return web.json_response({'models': [{'name': model, 'model': model} for model in self.models]})
+
+    async def ps(self, request):
+        return web.json_response({'models': [{'name': model, 'model': model} for model in sorted(self.loaded)]})
+
+    async def create(self, request):
+        data = await request.json()
+        name = data.get('name') or data.get('model')
+        if name and name not in self.models:
+            self.models.append(name)
+        return web.json_response({'status': 'success'})
+
+    async def delete(self, request):
+        data = await request.json()
+        name = data.get('name') or data.get('model')
+        if name not in self.models:
+            return web.json_response({'error': f"model '{name}' not found"}, status=404)
+        self.models.remove(name)
+        return web.json_response({})
@@ -1,21 +1,130 @@
+import time
+# Startup is timed from here, so the time logged once ready includes the imports.
+startup_started = time.perf_counter()
 import os
+import hashlib
+import importlib
+import json
+import shutil
+import tempfile
+from types import SimpleNamespace
 from dotenv import load_dotenv
 import discord
 from discord.ext import commands
 import logging
-import aiosqlite
 import asyncio
-import aiofiles
 import aiohttp
-import json
+import aiofiles
+from ollama_client import OllamaError
+from backend_pool import BackendPool
+from history_store import HistoryStore
+from context_builder import ContextBuilder
+from scheduler import RequestScheduler
+from response_cache import ResponseCache
+from model_catalogue import ModelCatalogue
+from metrics import Metrics, MetricsServer
+from maintenance import HistoryMaintenance
+from residency import ResidencyManager
+from prefetch import Prefetcher
+from quota import QuotaManager, SCOPES
+from workers import WorkerPool, WorkerServer
 
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
-OLLAMA_URL = os.getenv('OLLAMA_IP')
+# One or more Ollama servers, separated by commas.
+OLLAMA_URLS = [url.strip() for url in os.getenv('OLLAMA_IP', '').split(',') if url.strip()]
 
 CONFIG = {
     'default_model': 'dolphin-mistral',
-    'max_response_length': 2048
+    'max_response_length': 2048,
+    # Show responses while they are generated, editing the message at most once per interval.
+    'stream_responses': True,
+    'stream_edit_interval': 1.5,
+    # 'plain' sends fenced code for Discord to highlight itself; 'ansi' highlights with Pygments.
+    'code_highlighting': 'plain',
+    'highlight_workers': 2,
+    # Code blocks longer than this are sent as file attachments.
+    'code_attachment_size': 8000,
+    # Paginators kept in memory; others are loaded from the database when their buttons are pressed.
+    'paginator_cache_entries': 256,
+    # How stale a paginator's last-used time may get before a button press writes it back.
+    'paginator_touch_interval': 3600,
+    # /batch: requests in flight per batch, the most prompts and bytes per file, where results are kept until
+    # they are sent (so an interrupted batch resumes when run again) and seconds between progress updates.
+    'batch_concurrency': 4,
+    'batch_max_prompts': 1000,
+    'batch_max_bytes': 4 * 1024 * 1024,
+    'batch_dir': 'batches',
+    'batch_progress_interval': 5,
+    'ollama_pool_size': 16,
+    'ollama_retries': 3,
+    'health_check_interval': 30,
+    # Context window (num_ctx) per model; models not listed use num_ctx. Of each window, response_tokens
+    # are kept free for the response and the rest is the prompt's token budget.
+    'num_ctx': 16384,
+    'num_ctx_per_model': {},
+    'response_tokens': 4096,
+    'history_cache_entries': 1024,
+    'history_cache_bytes': 64 * 1024 * 1024,
+    # When a reply counts as saved: 'immediate' or 'batched' once committed (batched shares commits
+    # between concurrent replies), 'deferred' as soon as it is queued, risking the last flush interval on a crash.
+    'history_durability': 'batched',
+    'history_batch_size': 64,
+    'history_flush_interval': 0.05,
+    # Archive old turns per conversation by age, turn count or bytes; looked up by guild id, then model, then 'default'.
+    # e.g. {'default': {'max_age_days': 90}, 'models': {'llama3': {'max_turns': 500}}, 'guilds': {1234: {'max_bytes': 1000000}}}
+    'history_retention': {},
+    'maintenance_interval': 3600,
+    # Local hours in which the database may be vacuumed and analyzed, once a day.
+    'maintenance_hours': (3, 4, 5),
+    'vacuum_pages': 2000,
+    # Allow a one-off full VACUUM to switch an existing database to incremental vacuuming.
+    'full_vacuum': False,
+    # Response pages are kept so their buttons work after a restart, until unused for this many days. None keeps them forever.
+    'paginator_expiry_days': 30,
+    'max_concurrent_per_model': 2,
+    'max_concurrent_per_backend': 4,
+    'max_queued_requests': 100,
+    'max_queued_per_user': 3,
+    'max_queue_wait': 300,
+    # Answer identical requests (same model, options and messages) from a cache. Kept on disk when a path is set.
+    'response_cache_enabled': False,
+    'response_cache_entries': 1024,
+    'response_cache_ttl': 3600,
+    'response_cache_path': None,
+    # Generate this many alternatives to each response while the GPUs are idle, so regenerate is instant. 0 disables.
+    'prefetch_alternatives': 0,
+    'prefetch_ttl': 600,
+    'prefetch_bytes': 16 * 1024 * 1024,
+    # Recall relevant older exchanges by embedding similarity. Needs NumPy and an embedding model on the Ollama servers.
+    'memory_enabled': False,
+    'memory_model': 'nomic-embed-text',
+    'memory_top_k': 4,
+    'memory_tokens': 1024,
+    # How many models the Ollama nodes can keep in memory at once; the most requested ones stay loaded.
+    'resident_models': 2,
+    'demand_half_life': 3600,
+    'hot_keep_alive': '24h',
+    'warm_keep_alive': '30m',
+    'cold_keep_alive': '5m',
+    # Token budgets per window ('minute', 'hour' or 'day') for each user and each guild, counting prompt and
+    # generated tokens, e.g. {'user': {'hour': 50000}, 'guild': {'day': 2000000}}. /set_quota overrides them.
+    # A request over budget is rejected ('reject') or served after everyone else's ('deprioritize').
+    'quota_limits': {},
+    'quota_action': 'reject',
+    # Run history, context building, Ollama calls and rendering in this many worker processes, talking
+    # to the Discord process over Unix sockets in worker_socket_dir (a temporary directory if None).
+    # 0 does everything in one process. Concurrency and queue limits are split between the workers.
+    'worker_processes': 0,
+    'worker_socket_dir': None,
+    # Use discord.py's AutoShardedBot; shard_count None lets Discord pick it.
+    'auto_shard': False,
+    'shard_count': None,
+    # Hash of the application commands last synced with Discord. Delete the file to force a sync.
+    'command_sync_file': 'command_tree.sha256',
+    # Serve Prometheus metrics on this port when set.
+    'metrics_port': None,
+    'metrics_host': '127.0.0.1'
 }
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -27,69 +136,261 @@ intents.guilds = True
 intents.message_content = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix='/', intents=intents)
-bot.available_models = []
+if CONFIG['auto_shard']:
+    bot = commands.AutoShardedBot(command_prefix='/', intents=intents, shard_count=CONFIG['shard_count'])
+else:
+    bot = commands.Bot(command_prefix='/', intents=intents)
 
 async def load_models():
     """
-    Fetch the list of available models from the Ollama server.
-    If an error occurs, return the default model specified in the CONFIG.
+    Fetch the list of available models from the Ollama servers into the model catalogue.
+    If an error occurs and no models are known, fall back to the default model specified in the CONFIG.
     """
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f'{OLLAMA_URL}/api/tags') as response:
-                if response.status == 200:
-                    data = await response.json()
-                    #print("Response from Ollama server:")
-                    #print(data)
-                    if 'models' in data:
-                        models = [model['name'] for model in data['models']]
-                        return models
-                    else:
-                        logger.error("Unexpected response format from the Ollama server")
-                else:
-                    logger.error(f"Error fetching models: HTTP {response.status}")
-                    logger.error(f"Response from Ollama server: {await response.text()}")
-    except aiohttp.ClientError as e:
+        await bot.catalogue.refresh()
+    except OllamaError as e:
+        logger.error(f"Error fetching models: HTTP {e.status}")
+        logger.error(f"Response from Ollama server: {e.details}")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logger.exception(f"Error fetching models: {str(e)}")
 
-    return [CONFIG['default_model']]
+    if not bot.catalogue.models:
+        logger.error("No models found on the Ollama servers")
+        bot.catalogue.update_index([CONFIG['default_model']])
+
+def command_tree_hash():
+    """
+    Hash of the application commands as they would be sent to Discord, to tell whether they changed since the last sync.
+    """
+    definitions = [command.to_dict(bot.tree) for command_type in discord.AppCommandType for command in bot.tree.get_commands(type=command_type)]
+    definitions.sort(key=lambda command: (command['type'], command['name']))
+    payload = json.dumps({'application_id': bot.application_id, 'commands': definitions}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
-async def save_models(models):
+async def sync_commands():
     """
-    Save the list of available models to the 'available_models.txt' file.
+    Sync the application commands with Discord, but only if they changed since the last successful sync.
+    Syncing is a slow, rate limited call, and the commands only change when the code does.
     """
-    async with aiofiles.open('available_models.txt', 'w') as file:
-        await file.write('\n'.join(models))
+    path = CONFIG['command_sync_file']
+    tree_hash = command_tree_hash()
+    if os.path.exists(path):
+        async with aiofiles.open(path) as file:
+            if (await file.read()).strip() == tree_hash:
+                logger.info("Application commands unchanged, not syncing")
+                return
+    try:
+        synced = await bot.tree.sync()
+    except discord.HTTPException as e:
+        logger.error(f"Error syncing application commands: {str(e)}")
+        return
+    async with aiofiles.open(path, 'w') as file:
+        await file.write(tree_hash)
+    logger.info(f"Synced {len(synced)} application commands")
+
+async def start_bot_services():
+    await bot.catalogue.load()
+    if bot.jobs is not None:
+        bot.ollama.start()
+        await bot.jobs.start()
+    else:
+        await start_services(bot)
+    await load_models()
+
+async def load_extensions():
+    # utility_cog first: the other cogs import from it and must share the loaded module.
+    await bot.load_extension('cogs.llm-cogs.utility_cog')
+    await bot.load_extension('cogs.llm-cogs.chat_cog')
+    await bot.load_extension('cogs.llm-cogs.history_cog')
+    await bot.load_extension('cogs.llm-cogs.model_cog')
+    await sync_commands()
+
+async def setup_hook():
+    """
+    Runs once after logging in, before connecting to the gateway: start the services and load
+    the cogs side by side, so reconnects don't repeat any of it.
+    """
+    started = time.perf_counter()
+    await asyncio.gather(start_bot_services(), load_extensions())
+    logger.info(f"Setup finished in {time.perf_counter() - started:.2f}s")
+
+bot.setup_hook = setup_hook
 
 @bot.event
 async def on_ready():
     """
-    Event handler for when the bot is ready.
-    Loads the available models, syncs the application commands, and creates the database table if it doesn't exist.
+    Event handler for when the bot is ready. Fires again after every reconnect.
     """
+    global startup_started
     logger.info(f'Logged in as {bot.user.name} (ID: {bot.user.id})')
-    global AVAILABLE_MODELS
-    bot.available_models = await load_models()
-    await bot.tree.sync()
-
-    async with aiosqlite.connect('conversation_history.db') as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS history (
-                model TEXT,
-                user_id INTEGER,
-                message TEXT,
-                timestamp INTEGER
-            )
-        ''')
-        await db.commit()
+    if startup_started is not None:
+        logger.info(f"Ready {time.perf_counter() - startup_started:.2f}s after starting")
+        startup_started = None
+
+def paginator_expiry():
+    return CONFIG['paginator_expiry_days'] * 86400 if CONFIG['paginator_expiry_days'] is not None else None
+
+def share(limit, count):
+    """
+    One worker's part of a limit split between count workers, rounded up.
+    """
+    return max(1, -(-limit // count))
+
+def create_pool():
+    return BackendPool(
+        OLLAMA_URLS,
+        health_interval=CONFIG['health_check_interval'],
+        pool_size=CONFIG['ollama_pool_size'],
+        retries=CONFIG['ollama_retries']
+    )
+
+def create_services(services, worker=None):
+    """
+    Build the services that do the bot's work (Ollama pool, scheduler, history, caches, ...) as
+    attributes of services: the bot itself, or a worker process's namespace when worker is
+    (index, count). Workers split the scheduler's limits between them, each owns the users whose
+    id modulo count is its index, and only worker 0 preloads models and vacuums the database.
+    """
+    index, count = worker or (0, 1)
+    services.config = CONFIG
+    services.metrics = Metrics()
+    services.ollama = create_pool()
+    services.catalogue = ModelCatalogue(services.ollama, 'available_models.txt')
+    if worker is None:
+        services.ollama.on_refresh = services.catalogue.update
+    services.scheduler = RequestScheduler(
+        max_per_model=share(CONFIG['max_concurrent_per_model'], count),
+        max_per_backend=share(CONFIG['max_concurrent_per_backend'], count),
+        max_queued=share(CONFIG['max_queued_requests'], count),
+        max_queued_per_user=CONFIG['max_queued_per_user'],
+        max_wait=CONFIG['max_queue_wait'],
+        router=services.ollama.candidates
+    )
+    services.history = HistoryStore(
+        'conversation_history.db',
+        cache_entries=CONFIG['history_cache_entries'],
+        cache_bytes=CONFIG['history_cache_bytes'],
+        durability=CONFIG['history_durability'],
+        batch_size=CONFIG['history_batch_size'],
+        flush_interval=CONFIG['history_flush_interval'],
+        paginator_expiry=paginator_expiry()
+    )
+    # A guild's users are spread over the workers, so its budget is enforced by the gateway (see WorkerPool).
+    services.quotas = QuotaManager(services.history, CONFIG['quota_limits'], CONFIG['quota_action'], scopes=('user',) if worker is not None else SCOPES)
+    services.residency = ResidencyManager(
+        services.ollama,
+        services.history,
+        services.metrics,
+        resident_models=CONFIG['resident_models'],
+        half_life=CONFIG['demand_half_life'],
+        hot_keep_alive=CONFIG['hot_keep_alive'],
+        warm_keep_alive=CONFIG['warm_keep_alive'],
+        cold_keep_alive=CONFIG['cold_keep_alive'],
+        pinned=[CONFIG['memory_model']] if CONFIG['memory_enabled'] else [],
+        preload=index == 0
+    )
+    services.maintenance = HistoryMaintenance(
+        services.history,
+        retention=CONFIG['history_retention'],
+        interval=CONFIG['maintenance_interval'],
+        off_peak_hours=CONFIG['maintenance_hours'],
+        vacuum_pages=CONFIG['vacuum_pages'],
+        full_vacuum=CONFIG['full_vacuum'],
+        owns=lambda user_id: user_id % count == index,
+        primary=index == 0
+    )
+    services.response_cache = None
+    if CONFIG['response_cache_enabled']:
+        services.response_cache = ResponseCache(max_entries=CONFIG['response_cache_entries'], ttl=CONFIG['response_cache_ttl'], path=CONFIG['response_cache_path'])
+    services.prefetcher = None
+    if CONFIG['prefetch_alternatives'] and count > 1:
+        # A worker's scheduler can't see the other workers' requests, so it can't tell when a GPU is idle.
+        if index == 0:
+            logger.warning("Prefetching alternative responses is disabled with more than one worker process")
+    elif CONFIG['prefetch_alternatives']:
+        services.prefetcher = Prefetcher(services.scheduler, services.ollama, services.metrics, count=CONFIG['prefetch_alternatives'], ttl=CONFIG['prefetch_ttl'], max_bytes=CONFIG['prefetch_bytes'], quotas=services.quotas)
+    services.memory = None
+    if CONFIG['memory_enabled']:
+        from memory import MemoryIndex
+        services.memory = MemoryIndex(services.history, services.ollama, CONFIG['memory_model'], top_k=CONFIG['memory_top_k'], max_tokens=CONFIG['memory_tokens'])
+    services.context = ContextBuilder(services.history, services.ollama, services.scheduler, num_ctx=CONFIG['num_ctx'], num_ctx_per_model=CONFIG['num_ctx_per_model'], response_tokens=CONFIG['response_tokens'], memory=services.memory, quotas=services.quotas)
+
+async def start_services(services):
+    await services.history.open()
+    await services.quotas.start()
+    if services.response_cache is not None:
+        await services.response_cache.open()
+    services.ollama.start()
+    services.maintenance.start()
+    services.residency.start()
+
+async def close_services(services):
+    await services.maintenance.close()
+    await services.residency.close()
+    if services.prefetcher is not None:
+        await services.prefetcher.close()
+    await services.context.close()
+    if services.memory is not None:
+        await services.memory.close()
+    await services.quotas.close()
+    await services.history.close()
+    if services.response_cache is not None:
+        await services.response_cache.close()
+    await services.ollama.close()
+
+def run_worker(index, count, path):
+    """
+    Entry point of a worker process: do the gateway's jobs, received on the Unix socket at path.
+    """
+    asyncio.run(serve_worker(index, count, path))
+
+async def serve_worker(index, count, path):
+    services = SimpleNamespace()
+    create_services(services, (index, count))
+    try:
+        await start_services(services)
+        utility_cog = importlib.import_module('cogs.llm-cogs.utility_cog')
+        jobs = utility_cog.LocalJobs(services)
+        try:
+            await WorkerServer(jobs, path).serve()
+        finally:
+            await jobs.close()
+    finally:
+        await close_services(services)
 
 async def main():
-    await bot.load_extension('cogs.llm-cogs.chat_cog')
-    await bot.load_extension('cogs.llm-cogs.history_cog')
-    await bot.load_extension('cogs.llm-cogs.utility_cog')
-    await bot.load_extension('cogs.llm-cogs.model_cog')
-    await bot.start(TOKEN)
+    if not OLLAMA_URLS:
+        raise SystemExit("OLLAMA_IP is not set: give the URL of at least one Ollama server, e.g. OLLAMA_IP=http://localhost:11434")
+    # The cogs read their settings from bot.config rather than keeping their own.
+    bot.config = CONFIG
+    bot.jobs = None
+    socket_dir = None
+    if CONFIG['worker_processes']:
+        # This process only handles Discord; history, context, Ollama calls and rendering happen in the workers.
+        bot.metrics = Metrics()
+        bot.ollama = create_pool()
+        bot.catalogue = ModelCatalogue(bot.ollama, 'available_models.txt')
+        bot.ollama.on_refresh = bot.catalogue.update
+        socket_dir = CONFIG['worker_socket_dir'] or tempfile.mkdtemp(prefix='llamabot-')
+        bot.jobs = WorkerPool(CONFIG['worker_processes'], run_worker, bot.metrics, bot.catalogue, socket_dir, paginator_expiry=paginator_expiry(), quota_limits=CONFIG['quota_limits'], quota_action=CONFIG['quota_action'])
+        metrics_server = MetricsServer(bot.metrics, CONFIG['metrics_host'], CONFIG['metrics_port'], collect=bot.jobs.collect_metrics) if CONFIG['metrics_port'] else None
+    else:
+        create_services(bot)
+        metrics_server = MetricsServer(bot.metrics, CONFIG['metrics_host'], CONFIG['metrics_port']) if CONFIG['metrics_port'] else None
+    try:
+        if metrics_server is not None:
+            await metrics_server.start()
+        await bot.start(TOKEN)
+    finally:
+        if metrics_server is not None:
+            await metrics_server.close()
+        if CONFIG['worker_processes']:
+            await bot.jobs.close()
+            await bot.ollama.close()
+            if not CONFIG['worker_socket_dir']:
+                shutil.rmtree(socket_dir, ignore_errors=True)
+        else:
+            await close_services(bot)
 
 if __name__ == "__main__":
     asyncio.run(main())
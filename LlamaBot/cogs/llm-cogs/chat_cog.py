@@ -2,43 +2,12 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 import logging
-from .utility_cog import format_response, model_autocomplete, Paginator, CONFIG, generate_response, get_last_used_model
-from .utils import split_into_chunks
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters import HtmlFormatter
-import re
+import os
+from batch import batch_key, read_prompts
+from .utility_cog import model_autocomplete, Paginator, StreamingEmbed, queue_position_updater
 
 logger = logging.getLogger(__name__)
 
-def format_code(code, language):
-    try:
-        lexer = get_lexer_by_name(language, stripall=True)
-        formatter = HtmlFormatter(style='colorful')
-        formatted_code = highlight(code, lexer, formatter)
-        return formatted_code
-    except ValueError:
-        return code
-
-def split_into_chunks(text, max_length):
-    chunks = []
-    current_chunk = ""
-
-    sentences = re.findall(r'(?s)(.*?(?<=[.!?])\s+)', text)
-
-    for sentence in sentences:
-        if len(current_chunk) + len(sentence) <= max_length:
-            current_chunk += sentence
-        else:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = sentence
-
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-
-    return chunks
-
 def truncate_field(value, max_length=1024):
     if len(value) > max_length:
         return value[:max_length - 3] + "..."
@@ -49,9 +18,20 @@ def get_user_input_embed(message):
     embed.add_field(name="", value=message, inline=False)
     return embed
 
+def get_batch_embed(title, stats, color):
+    done = stats['skipped'] + stats['completed'] + stats['failed']
+    embed = discord.Embed(title=title, description=f"{done}/{stats['total']} prompts with '{stats['model']}'", color=color)
+    embed.add_field(name="Answered", value=str(stats['completed']), inline=True)
+    embed.add_field(name="Failed", value=str(stats['failed']), inline=True)
+    embed.add_field(name="From Earlier Run", value=str(stats['skipped']), inline=True)
+    embed.add_field(name="Tokens", value=f"{stats['prompt_tokens']} prompt · {stats['tokens']} generated", inline=False)
+    embed.add_field(name="Throughput", value=f"{stats['tokens_per_second']:.1f} tokens/s over {stats['seconds']:.0f}s", inline=False)
+    return embed
+
 class ChatCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.batches = set()
 
     @app_commands.command(name='chat', description='Generate a response based on the input message using AI')
     @app_commands.describe(message="The message to process with the AI model")
@@ -60,47 +40,39 @@ class ChatCog(commands.Cog):
     @app_commands.describe(temperature="Temperature setting for the model (optional)")
     @app_commands.autocomplete(model=model_autocomplete)
     async def chat(self, interaction: discord.Interaction, message: str, model: str = None, system_prompt: str = None, temperature: float = 0.5):
-        await interaction.response.defer()
+        with self.bot.metrics.span('chat'):
+            await self.respond(interaction, message, model)
+
+    async def respond(self, interaction, message, model):
+        """
+        Handle a /chat request, timing each stage of it.
+        """
+        metrics = self.bot.metrics
+        with metrics.span('discord'):
+            await interaction.response.defer()
 
         if model is None:
-            model = await get_last_used_model(interaction.user.id)
+            model = await self.bot.jobs.last_used_model(interaction.user.id)
 
         try:
             user_id = interaction.user.id
 
-            user_input_embed = get_user_input_embed(message)
-            await interaction.followup.send(embed=user_input_embed)
-
-            loading_embed = discord.Embed(title="Processing...", description="Your request is being processed. Please wait.", color=discord.Color.blurple())
-            loading_message = await interaction.followup.send(embed=loading_embed)
-
-            response = await generate_response(model, user_id, message)
-            response = format_response(response)
+            with metrics.span('discord'):
+                user_input_embed = get_user_input_embed(message)
+                await interaction.followup.send(embed=user_input_embed)
 
-            code_blocks = re.findall(r'```(\w+)?\n([\s\S]*?)\n```', response)
-            code_embeds = []
+                loading_embed = discord.Embed(title="Processing...", description="Your request is being processed. Please wait.", color=discord.Color.blurple())
+                loading_message = await interaction.followup.send(embed=loading_embed)
 
-            for language, code in code_blocks:
-                formatted_code = format_code(code, language)
-                code_embed = discord.Embed(title=f"Code Block ({language})", color=discord.Color.blue())
-                code_embed.description = formatted_code
-                code_embeds.append(code_embed)
+            on_position = queue_position_updater(loading_message, loading_embed.title)
+            config = self.bot.config
+            async with StreamingEmbed(loading_message, config['stream_edit_interval'], config['max_response_length']) as streamer:
+                on_token = streamer.add if config['stream_responses'] else None
+                embeds, files = await self.bot.jobs.respond(model, user_id, message, interaction.guild_id, on_token=on_token, on_position=on_position)
 
-            response = re.sub(r'```(\w+)?\n([\s\S]*?)\n```', '', response)
-
-            await loading_message.delete()  # Delete the loading message
-
-            max_length = CONFIG['max_response_length']
-            if len(response) > max_length:
-                chunks = split_into_chunks(response, max_length)
-                embeds = [discord.Embed(title=f"AI Response (Part {i+1})", description=chunk, color=discord.Color.green()) for i, chunk in enumerate(chunks)]
-            else:
-                embeds = [discord.Embed(title="AI Response", description=response, color=discord.Color.green())]
-
-            embeds.extend(code_embeds)
-
-            paginator = Paginator(interaction, embeds, model, user_id, message)
-            await paginator.start()
+            paginator = Paginator(interaction, embeds, model, user_id, message, files)
+            with metrics.span('discord'):
+                await paginator.start(loading_message)  # Replace the loading message with the response
 
         except Exception as e:
             logger.exception(f"Error in '/chat' command: {str(e)}")
@@ -108,5 +80,73 @@ class ChatCog(commands.Cog):
             embed.add_field(name="Details", value=str(e), inline=False)
             await interaction.followup.send(embed=embed)
 
+    @app_commands.command(name='batch', description='Run a file of prompts against a model and get the responses as JSON lines')
+    @app_commands.describe(prompts="A text file with one prompt per line, or JSON lines with 'prompt' and optional 'id' and 'system'")
+    @app_commands.describe(model="The AI model to run the prompts against")
+    @app_commands.autocomplete(model=model_autocomplete)
+    @app_commands.default_permissions(administrator=True)
+    async def batch(self, interaction: discord.Interaction, prompts: discord.Attachment, model: str = None):
+        """
+        Command handler for the '/batch' command.
+        Runs every prompt on its own, without conversation history, and sends the results once all are done.
+        Running the same file with the same model again resumes an interrupted batch.
+        """
+        await interaction.response.defer()
+        config = self.bot.config
+        model = model or config['default_model']
+        user_id = interaction.user.id
+        if prompts.size > config['batch_max_bytes']:
+            description = f"The file is {prompts.size / 1024 / 1024:.1f} MiB; prompts files can be up to {config['batch_max_bytes'] / 1024 / 1024:.1f} MiB."
+            await interaction.followup.send(embed=discord.Embed(title="Prompts File Too Large", description=description, color=discord.Color.red()))
+            return
+        try:
+            parsed = read_prompts((await prompts.read()).decode('utf-8'), config['batch_max_prompts'])
+        except (ValueError, UnicodeDecodeError) as e:
+            embed = discord.Embed(title="Invalid Prompts File", description=str(e)[:4096], color=discord.Color.red())
+            await interaction.followup.send(embed=embed)
+            return
+        if not parsed:
+            await interaction.followup.send(embed=discord.Embed(title="Invalid Prompts File", description="The file has no prompts.", color=discord.Color.red()))
+            return
+
+        key = batch_key(user_id, model, parsed)
+        if key in self.batches:
+            await interaction.followup.send(embed=discord.Embed(title="Already Running", description="This batch is already running.", color=discord.Color.orange()))
+            return
+        self.batches.add(key)
+        try:
+            os.makedirs(config['batch_dir'], exist_ok=True)
+            path = os.path.abspath(os.path.join(config['batch_dir'], f"{key}.jsonl"))
+            stats = {'model': model, 'total': len(parsed), 'skipped': 0, 'completed': 0, 'failed': 0, 'prompt_tokens': 0, 'tokens': 0, 'seconds': 0, 'tokens_per_second': 0.0}
+            progress = await interaction.followup.send(embed=get_batch_embed("Batch Running...", stats, discord.Color.blurple()), wait=True)
+
+            async def on_progress(stats):
+                await progress.edit(embed=get_batch_embed("Batch Running...", stats, discord.Color.blurple()))
+
+            stats = await self.bot.jobs.run_batch(model, user_id, interaction.guild_id, parsed, path, on_progress)
+            embed = get_batch_embed("Batch Finished", stats, discord.Color.green() if not stats['failed'] else discord.Color.orange())
+            limit = interaction.guild.filesize_limit if interaction.guild else discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+            if os.path.getsize(path) > limit:
+                embed.add_field(name="Results", value=f"Too large to upload; kept on the bot's host as `{os.path.basename(path)}`.", inline=False)
+                await progress.edit(embed=embed)
+                return
+            filename = f"batch-{model.replace(':', '-')}-{key}.jsonl"
+            try:
+                await progress.edit(embed=embed, attachments=[discord.File(path, filename=filename)])
+            except discord.HTTPException:
+                # The interaction's webhook expires after 15 minutes; long batches report in the channel instead.
+                await interaction.channel.send(content=interaction.user.mention, embed=embed, file=discord.File(path, filename=filename))
+            os.remove(path)
+        except Exception as e:
+            logger.exception(f"Error in '/batch' command: {str(e)}")
+            embed = discord.Embed(title="Error", description="An error occurred while running the batch. Run it again to resume.", color=discord.Color.red())
+            embed.add_field(name="Details", value=str(e)[:1024], inline=False)
+            try:
+                await interaction.followup.send(embed=embed)
+            except discord.HTTPException:
+                await interaction.channel.send(content=interaction.user.mention, embed=embed)
+        finally:
+            self.batches.discard(key)
+
 async def setup(bot):
     await bot.add_cog(ChatCog(bot))
@@ -0,0 +1,118 @@
+import asyncio
+import io
+import re
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import discord
+from .renderer import FENCE, EMBED_DESCRIPTION_LIMIT, split_code
+
+logger = logging.getLogger(__name__)
+
+# Discord's ANSI code blocks only know the basic 8 colors, bold and underline.
+BRIGHT_COLOR = re.compile(r'\x1b\[9([0-7])m')
+RESET = re.compile(r'\x1b\[39;49;00m|\x1b\[39m')
+
+
+@lru_cache(maxsize=128)
+def get_lexer(language):
+    """
+    Cached lexer lookup; None when Pygments doesn't know the language.
+    """
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+    try:
+        return get_lexer_by_name(language, stripall=True)
+    except ClassNotFound:
+        return None
+
+
+@lru_cache(maxsize=1)
+def get_formatter():
+    from pygments.formatters import TerminalFormatter
+    return TerminalFormatter(bg='dark')
+
+
+def highlight_ansi(code, language):
+    """
+    Highlight code as an ANSI code block Discord can color. Returns None if the language is unknown.
+    """
+    lexer = get_lexer(language)
+    if lexer is None:
+        return None
+    from pygments import highlight
+    highlighted = highlight(code, lexer, get_formatter()).rstrip('\n')
+    highlighted = RESET.sub('\x1b[0m', BRIGHT_COLOR.sub('\x1b[3\\1m', highlighted))
+    return f"{FENCE}ansi\n{highlighted}\n{FENCE}"
+
+
+def file_extension(language):
+    lexer = get_lexer(language) if language else None
+    if lexer is not None and lexer.filenames:
+        extension = lexer.filenames[0].rsplit('.', 1)[-1]
+        if extension.isalnum():
+            return extension
+    return 'txt'
+
+
+class CodeHighlighter:
+    """
+    Turns fenced code blocks into embeds Discord can render.
+
+    In 'plain' mode code is sent as a fenced block with its language tag and Discord highlights it
+    client-side, costing the bot nothing. In 'ansi' mode Pygments produces an ANSI code block;
+    lexers and the formatter are cached, blocks above offload_size are highlighted in a small
+    thread pool so they don't stall the event loop, and blocks above max_highlight_size are sent
+    plain. Blocks longer than attachment_size are sent as a file attachment instead of a long run
+    of embeds.
+    """
+    def __init__(self, mode='plain', max_workers=2, offload_size=2000, max_highlight_size=50000, attachment_size=8000):
+        self.mode = mode
+        self.max_workers = max_workers
+        self.offload_size = offload_size
+        self.max_highlight_size = max_highlight_size
+        self.attachment_size = attachment_size
+        self.executor = None
+
+    async def format_piece(self, code, language):
+        plain = f"{FENCE}{language}\n{code}\n{FENCE}"
+        if self.mode != 'ansi' or not language or len(code) > self.max_highlight_size:
+            return plain
+        if len(code) <= self.offload_size:
+            highlighted = highlight_ansi(code, language)
+        else:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='highlight')
+            highlighted = await asyncio.get_running_loop().run_in_executor(self.executor, highlight_ansi, code, language)
+        # Escape codes make the block longer; fall back to plain if it no longer fits.
+        if highlighted is None or len(highlighted) > EMBED_DESCRIPTION_LIMIT:
+            return plain
+        return highlighted
+
+    async def build_embeds(self, code_blocks):
+        """
+        Return (embeds, files) for a response's (language, code) blocks.
+        """
+        embeds = []
+        files = []
+        for number, (language, code) in enumerate(code_blocks, start=1):
+            label = language or "text"
+            if len(code) > self.attachment_size:
+                filename = f"code_{number}.{file_extension(language)}"
+                files.append(discord.File(io.BytesIO(code.encode('utf-8')), filename=filename))
+                description = f"This code block is {code.count(chr(10)) + 1} lines long and is attached as `{filename}`."
+                embeds.append(discord.Embed(title=f"Code Block ({label})", description=description, color=discord.Color.blue()))
+                continue
+
+            overhead = len(FENCE) * 2 + max(len(language), len('ansi')) + 2
+            pieces = split_code(code, EMBED_DESCRIPTION_LIMIT - overhead)
+            for i, piece in enumerate(pieces):
+                title = f"Code Block ({label})" if len(pieces) == 1 else f"Code Block ({label}, Part {i+1})"
+                description = await self.format_piece(piece, language)
+                embeds.append(discord.Embed(title=title, description=description, color=discord.Color.blue()))
+        return embeds, files
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -2,13 +2,27 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 
-import aiosqlite
 import logging
+import os
+import tempfile
+import aiofiles
+import aiohttp
 
 from .utility_cog import model_autocomplete
 
 logger = logging.getLogger(__name__)
 
+async def download(url, path):
+    """
+    Save a Discord attachment to a file in chunks, without holding it in memory.
+    """
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            async with aiofiles.open(path, 'wb') as file:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    await file.write(chunk)
+
 class HistoryCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -22,13 +36,12 @@ class HistoryCog(commands.Cog):
         try:
             user_id = interaction.user.id
 
-            async with aiosqlite.connect('conversation_history.db', isolation_level=None) as db:
-                if model:
-                    await db.execute("DELETE FROM history WHERE user_id = ? AND model = ?", (user_id, model))
-                    embed = discord.Embed(title="History Cleared", description=f"Your conversation history with the model '{model}' has been cleared.", color=discord.Color.green())
-                else:
-                    await db.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
-                    embed = discord.Embed(title="History Cleared", description="Your entire conversation history has been cleared.", color=discord.Color.green())
+            await self.bot.jobs.clear_history(user_id, model)
+            self.bot.paginators.discard_user(user_id, model)
+            if model:
+                embed = discord.Embed(title="History Cleared", description=f"Your conversation history with the model '{model}' has been cleared.", color=discord.Color.green())
+            else:
+                embed = discord.Embed(title="History Cleared", description="Your entire conversation history has been cleared.", color=discord.Color.green())
 
             await interaction.followup.send(embed=embed)
 
@@ -38,5 +51,114 @@ class HistoryCog(commands.Cog):
             embed.add_field(name="Details", value=str(e), inline=False)
             await interaction.followup.send(embed=embed)
 
+    @app_commands.command(name='history_size')
+    @app_commands.default_permissions(administrator=True)
+    async def history_size(self, interaction: discord.Interaction):
+        """
+        Command handler for the '/history_size' command.
+        Shows how big the history database is and how much space a vacuum could reclaim.
+        """
+        await interaction.response.defer(ephemeral=True)
+        report = await self.bot.jobs.size_report()
+
+        def mib(size):
+            return f"{size / 1024 / 1024:.1f} MiB"
+
+        embed = discord.Embed(title="History Database", color=discord.Color.blue())
+        embed.add_field(name="File", value=mib(report['file_bytes']), inline=True)
+        embed.add_field(name="Reclaimable", value=mib(report['free_bytes']), inline=True)
+        embed.add_field(name="WAL", value=mib(report['wal_bytes']), inline=True)
+        embed.add_field(name="History", value=f"{report['history_rows']} rows · {mib(report['history_text_bytes'])} of text", inline=False)
+        embed.add_field(name="Archive", value=f"{report['archived_rows']} rows in {report['archives']} archives · {mib(report['archive_bytes'])} compressed", inline=False)
+        if report['tables']:
+            tables = '\n'.join(f"{name}: {mib(size)}" for name, size in list(report['tables'].items())[:10])
+            embed.add_field(name="Largest Tables and Indexes", value=tables, inline=False)
+        embed.set_footer(text=f"Auto-vacuum: {report['auto_vacuum']}")
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    @app_commands.command(name='compact_history')
+    @app_commands.default_permissions(administrator=True)
+    async def compact_history(self, interaction: discord.Interaction):
+        """
+        Command handler for the '/compact_history' command.
+        Applies the retention policies, deletes expired paginators and vacuums the database now instead of waiting for off-peak hours.
+        """
+        await interaction.response.defer(ephemeral=True)
+        try:
+            conversations, rows = await self.bot.jobs.compact()
+            report = await self.bot.jobs.size_report()
+            description = f"Archived {rows} rows from {conversations} conversations. The database is now {report['file_bytes'] / 1024 / 1024:.1f} MiB with {report['free_bytes'] / 1024 / 1024:.1f} MiB reclaimable."
+            embed = discord.Embed(title="History Compacted", description=description, color=discord.Color.green())
+        except Exception as e:
+            logger.exception(f"Error in '/compact_history' command: {str(e)}")
+            embed = discord.Embed(title="Error", description="An error occurred while compacting the history database.", color=discord.Color.red())
+            embed.add_field(name="Details", value=str(e), inline=False)
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    @app_commands.command(name='export_history')
+    @app_commands.describe(model="Only export history with this model (optional)", everyone="Export every user's history (bot owner only)")
+    @app_commands.autocomplete(model=model_autocomplete)
+    async def export_history(self, interaction: discord.Interaction, model: str = None, everyone: bool = False):
+        """
+        Command handler for the '/export_history' command.
+        Sends the user's conversation history, archived turns included, as a gzip-compressed JSON lines file.
+        """
+        await interaction.response.defer(ephemeral=True)
+        try:
+            if everyone and not await self.bot.is_owner(interaction.user):
+                embed = discord.Embed(title="Not Allowed", description="Only the bot's owner can export everyone's history.", color=discord.Color.red())
+                await interaction.followup.send(embed=embed, ephemeral=True)
+                return
+            user_id = None if everyone else interaction.user.id
+            limit = interaction.guild.filesize_limit if interaction.guild else discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+            with tempfile.TemporaryDirectory(prefix='llamabot-export-') as directory:
+                filename = f"history-{user_id or 'all'}{'-' + model if model else ''}.jsonl.gz"
+                path = os.path.join(directory, filename)
+                turns = await self.bot.jobs.export_history(path, user_id, model)
+                size = os.path.getsize(path)
+                if not turns:
+                    embed = discord.Embed(title="Nothing to Export", description="There is no conversation history to export.", color=discord.Color.orange())
+                    await interaction.followup.send(embed=embed, ephemeral=True)
+                elif size > limit:
+                    description = f"The export is {size / 1024 / 1024:.1f} MiB, more than Discord allows here ({limit / 1024 / 1024:.0f} MiB). Run `python history_transfer.py export` on the bot's host instead."
+                    embed = discord.Embed(title="Export Too Large", description=description, color=discord.Color.orange())
+                    await interaction.followup.send(embed=embed, ephemeral=True)
+                else:
+                    embed = discord.Embed(title="History Exported", description=f"{turns} messages, {size / 1024:.0f} KiB compressed.", color=discord.Color.green())
+                    await interaction.followup.send(embed=embed, file=discord.File(path, filename=filename), ephemeral=True)
+        except Exception as e:
+            logger.exception(f"Error in '/export_history' command: {str(e)}")
+            embed = discord.Embed(title="Error", description="An error occurred while exporting the history.", color=discord.Color.red())
+            embed.add_field(name="Details", value=str(e), inline=False)
+            await interaction.followup.send(embed=embed, ephemeral=True)
+
+    @app_commands.command(name='import_history')
+    @app_commands.describe(file="A file from /export_history or history_transfer.py, plain or gzip-compressed")
+    @app_commands.default_permissions(administrator=True)
+    async def import_history(self, interaction: discord.Interaction, file: discord.Attachment):
+        """
+        Command handler for the '/import_history' command.
+        Loads exported history into the database, skipping messages it already has. Bot owner only.
+        """
+        await interaction.response.defer(ephemeral=True)
+        if not await self.bot.is_owner(interaction.user):
+            embed = discord.Embed(title="Not Allowed", description="Only the bot's owner can import history.", color=discord.Color.red())
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
+        try:
+            with tempfile.TemporaryDirectory(prefix='llamabot-import-') as directory:
+                path = os.path.join(directory, 'history.jsonl')
+                await download(file.url, path)
+                read, inserted, conflicts = await self.bot.jobs.import_history(path)
+            description = f"Imported {inserted} messages; {read - inserted} were already in the history."
+            if conflicts:
+                description += f" {conflicts} conversations were left out because they already exist here with different messages."
+            embed = discord.Embed(title="History Imported", description=description, color=discord.Color.green())
+        except Exception as e:
+            logger.exception(f"Error in '/import_history' command: {str(e)}")
+            embed = discord.Embed(title="Error", description="An error occurred while importing the history. Messages imported before it are kept.", color=discord.Color.red())
+            embed.add_field(name="Details", value=str(e)[:1024], inline=False)
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
 async def setup(bot):
     await bot.add_cog(HistoryCog(bot))
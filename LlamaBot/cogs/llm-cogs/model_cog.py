@@ -1,13 +1,11 @@
 import discord
 from discord.ext import commands
 from discord import app_commands
-import aiohttp
 import logging
-from .utility_cog import model_autocomplete, delete_model_autocomplete, CONFIG, save_models
-import os
+from .utility_cog import model_autocomplete, delete_model_autocomplete
+from ollama_client import OllamaError
 
 logger = logging.getLogger(__name__)
-OLLAMA_URL = os.getenv('OLLAMA_IP')
 
 class ModelCog(commands.Cog):
     def __init__(self, bot):
@@ -30,7 +28,7 @@ class ModelCog(commands.Cog):
             # Replace spaces with underscores in the model name
             name = name.replace(" ", "_")
 
-            if name in interaction.client.available_models:
+            if name in interaction.client.catalogue.models:
                 raise ValueError(f"A model with the name '{name}' already exists.")
 
             if not modelfile and base_model:
@@ -38,28 +36,24 @@ class ModelCog(commands.Cog):
             elif not modelfile:
                 modelfile = f"SYSTEM {system_prompt}\nTEMPERATURE {temperature}"
 
-            api_url = f'{OLLAMA_URL}/api/create'
             data = {
                 "name": name,
                 "modelfile": modelfile,
                 "stream": False
             }
 
-            async with aiohttp.ClientSession() as session:
-                async with session.post(api_url, json=data) as response:
-                    creation_response = await response.json()
-                    if response.status == 200:
-                        if 'status' in creation_response and creation_response['status'] == 'success':
-                            interaction.client.available_models.append(name)
-                            await save_models(interaction.client.available_models)
-                            embed = discord.Embed(title="Model Created", description=f"Model '{name}' created successfully and added to available models!", color=discord.Color.green())
-                            await interaction.followup.send(embed=embed)
-                        else:
-                            raise ValueError("Model created, but the response format was not as expected.")
-                    else:
-                        error_message = f"Failed to create the model due to HTTP {response.status}."
-                        error_details = await response.text()
-                        raise ValueError(f"{error_message} Details: {error_details}")
+            try:
+                creation_response = await self.bot.ollama.create_model(data)
+            except OllamaError as e:
+                raise ValueError(f"Failed to create the model due to HTTP {e.status}. Details: {e.details}")
+
+            if 'status' in creation_response and creation_response['status'] == 'success':
+                await interaction.client.catalogue.add(name)
+                await self.bot.jobs.warm()
+                embed = discord.Embed(title="Model Created", description=f"Model '{name}' created successfully and added to available models!", color=discord.Color.green())
+                await interaction.followup.send(embed=embed)
+            else:
+                raise ValueError("Model created, but the response format was not as expected.")
         except Exception as e:
             logger.exception(f"Error in '/create_model' command: {str(e)}")
             embed = discord.Embed(title="Error", description="An error occurred while creating the model.", color=discord.Color.red())
@@ -72,7 +66,7 @@ class ModelCog(commands.Cog):
         Command handler for the '/list_models' command.
         Lists all available models.
         """
-        models = '\n'.join(interaction.client.available_models)
+        models = '\n'.join(interaction.client.catalogue.models)
         embed = discord.Embed(title="Available Models", description=models, color=discord.Color.blue())
         await interaction.response.send_message(embed=embed)
 
@@ -90,25 +84,19 @@ class ModelCog(commands.Cog):
             # Replace spaces with underscores in the model name
             name = name.replace(" ", "_")
 
-            if name not in interaction.client.available_models:
+            if name not in interaction.client.catalogue.models:
                 raise ValueError(f"Model '{name}' not found.")
             else:
-                api_url = f'{OLLAMA_URL}/api/delete'
-                data = {"name": name}
-
-                async with aiohttp.ClientSession() as session:
-                    async with session.delete(api_url, json=data) as response:
-                        if response.status == 200:
-                            interaction.client.available_models.remove(name)
-                            await save_models(interaction.client.available_models)
-                            embed = discord.Embed(title="Model Deleted", description=f"Model '{name}' deleted successfully.", color=discord.Color.green())
-                            await interaction.followup.send(embed=embed)
-                        elif response.status == 404:
-                            raise ValueError(f"Model '{name}' not found on the Ollama server.")
-                        else:
-                            error_message = f"Failed to delete the model due to HTTP {response.status}."
-                            error_details = await response.text()
-                            raise ValueError(f"{error_message} Details: {error_details}")
+                try:
+                    await self.bot.ollama.delete_model(name)
+                except OllamaError as e:
+                    if e.status == 404:
+                        raise ValueError(f"Model '{name}' not found on the Ollama server.")
+                    raise ValueError(f"Failed to delete the model due to HTTP {e.status}. Details: {e.details}")
+
+                await interaction.client.catalogue.remove(name)
+                embed = discord.Embed(title="Model Deleted", description=f"Model '{name}' deleted successfully.", color=discord.Color.green())
+                await interaction.followup.send(embed=embed)
         except Exception as e:
             logger.exception(f"Error in '/delete_model' command: {str(e)}")
             embed = discord.Embed(title="Error", description="An error occurred while deleting the model.", color=discord.Color.red())
@@ -119,29 +107,22 @@ class ModelCog(commands.Cog):
     async def refresh_models(self, interaction: discord.Interaction):
         """
         Command handler for the '/refresh_models' command.
-        Refreshes the list of available models from the Ollama server.
+        Refreshes the list of available models from the Ollama servers.
         """
         await interaction.response.defer()
 
         try:
-            api_url = f'{OLLAMA_URL}/api/tags'
-
-            async with aiohttp.ClientSession() as session:
-                async with session.get(api_url) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if 'models' in data:
-                            models = [model['name'] for model in data['models']]
-                            interaction.client.available_models = models
-                            await save_models(interaction.client.available_models)
-                            embed = discord.Embed(title="Models Refreshed", description="Available models have been refreshed from the Ollama server.", color=discord.Color.green())
-                            await interaction.followup.send(embed=embed)
-                        else:
-                            raise ValueError("Unexpected response format from the Ollama server.")
-                    else:
-                        error_message = f"Failed to refresh models due to HTTP {response.status}."
-                        error_details = await response.text()
-                        raise ValueError(f"{error_message} Details: {error_details}")
+            try:
+                models = await self.bot.ollama.refresh()
+            except OllamaError as e:
+                raise ValueError(f"Failed to refresh models due to HTTP {e.status}. Details: {e.details}")
+
+            if models:
+                await interaction.client.catalogue.update(models)
+                embed = discord.Embed(title="Models Refreshed", description="Available models have been refreshed from the Ollama server.", color=discord.Color.green())
+                await interaction.followup.send(embed=embed)
+            else:
+                raise ValueError("No models were found on the Ollama servers.")
         except Exception as e:
             logger.exception(f"Error in '/refresh_models' command: {str(e)}")
             embed = discord.Embed(title="Error", description="An error occurred while refreshing the list of available models.", color=discord.Color.red())
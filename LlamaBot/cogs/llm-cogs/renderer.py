@@ -0,0 +1,156 @@
+import re
+import discord
+
+FENCE = '```'
+# Discord's limit on an embed description.
+EMBED_DESCRIPTION_LIMIT = 4096
+
+LANGUAGE_PATTERN = re.compile(r'[\w+#.-]*')
+MARKDOWN_FIXES = {'**': '*', '__': '_', '<br>': '\n'}
+MARKDOWN_PATTERN = re.compile('|'.join(re.escape(token) for token in MARKDOWN_FIXES))
+
+# Preferred places to end a page, best first. Each is searched for only in the back half of the page.
+BREAKS = ('\n\n', '\n', '. ', '! ', '? ', ' ')
+
+
+class Rendered:
+    """
+    A response split into prose pages and (language, code) blocks, ready to become embeds.
+    """
+    __slots__ = ('pages', 'code_blocks')
+
+    def __init__(self, pages, code_blocks):
+        self.pages = pages
+        self.code_blocks = code_blocks
+
+
+def tokenize(text):
+    """
+    Split a response into ('prose', text) and ('code', language, code) segments in one pass.
+    An unclosed fence at the end, as seen while streaming, is treated as code up to the end.
+    """
+    segments = []
+    pos = 0
+    while True:
+        start = text.find(FENCE, pos)
+        if start == -1:
+            break
+        header_end = text.find('\n', start + 3)
+        if header_end == -1:
+            break
+        language = text[start + 3:header_end].strip()
+        if not LANGUAGE_PATTERN.fullmatch(language):
+            # Not a fence opening (e.g. ``` in the middle of a sentence); keep it as prose.
+            segments.append(('prose', text[pos:start + 3]))
+            pos = start + 3
+            continue
+        if start > pos:
+            segments.append(('prose', text[pos:start]))
+        end = text.find(FENCE, header_end + 1)
+        if end == -1:
+            segments.append(('code', language, text[header_end + 1:]))
+            return segments
+        segments.append(('code', language, text[header_end + 1:end].rstrip('\n')))
+        pos = end + 3
+    if pos < len(text):
+        segments.append(('prose', text[pos:]))
+    return segments
+
+
+def fix_markdown(text):
+    """
+    Adapt model markdown to what Discord renders, in a single pass over the text.
+    """
+    return MARKDOWN_PATTERN.sub(lambda match: MARKDOWN_FIXES[match.group()], text)
+
+
+def paginate(text, max_length):
+    """
+    Split text into pages of at most max_length characters without dropping any of it.
+    Pages end at a paragraph, line, sentence or word boundary where one exists in the back
+    half of the page, otherwise the text is cut at max_length. Runs in linear time.
+    """
+    pages = []
+    pos = 0
+    length = len(text)
+    while length - pos > max_length:
+        limit = pos + max_length
+        cut = -1
+        for separator in BREAKS:
+            found = text.rfind(separator, pos + max_length // 2, limit)
+            if found != -1:
+                cut = found + len(separator)
+                break
+        if cut <= pos:
+            cut = limit
+        page = text[pos:cut].strip()
+        if page:
+            pages.append(page)
+        pos = cut
+    page = text[pos:].strip()
+    if page or not pages:
+        pages.append(page)
+    return pages
+
+
+def render(response, max_length):
+    """
+    Render a finished response: markdown fixes on the prose, which is packed into pages,
+    and the fenced code blocks separated out for their own embeds.
+    """
+    prose = []
+    code_blocks = []
+    for segment in tokenize(response):
+        if segment[0] == 'prose':
+            prose.append(fix_markdown(segment[1]))
+        else:
+            code_blocks.append((segment[1], segment[2]))
+    return Rendered(paginate(''.join(prose), max_length), code_blocks)
+
+
+def render_preview(text, max_length):
+    """
+    Return (part, page) for the last page of a response that is still streaming. Code is kept
+    inline so it shows up as it is generated.
+    """
+    pieces = []
+    for segment in tokenize(text):
+        if segment[0] == 'prose':
+            pieces.append(fix_markdown(segment[1]))
+        else:
+            pieces.append(f"{FENCE}{segment[1]}\n{segment[2]}\n{FENCE}")
+    pages = paginate(''.join(pieces), max_length)
+    return len(pages), pages[-1]
+
+
+def split_code(code, max_length):
+    """
+    Split code into pieces of at most max_length characters, on line boundaries where possible.
+    """
+    pieces = []
+    current = []
+    size = 0
+    for line in code.split('\n'):
+        while len(line) > max_length:
+            if current:
+                pieces.append('\n'.join(current))
+                current, size = [], 0
+            pieces.append(line[:max_length])
+            line = line[max_length:]
+        if current and size + len(line) + 1 > max_length:
+            pieces.append('\n'.join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current or not pieces:
+        pieces.append('\n'.join(current))
+    return pieces
+
+
+def build_embeds(rendered, title="AI Response"):
+    """
+    Turn a rendered response's prose into numbered page embeds. Code blocks are left to the highlighter.
+    """
+    if len(rendered.pages) > 1:
+        return [discord.Embed(title=f"{title} (Part {i+1})", description=page, color=discord.Color.green()) for i, page in enumerate(rendered.pages)]
+    return [discord.Embed(title=title, description=rendered.pages[0], color=discord.Color.green())]
@@ -1,199 +1,712 @@
 import discord
 from discord.ext import commands
 from discord import app_commands
-import re
 import logging
+import asyncio
 import aiohttp
-import aiosqlite
 import time
-import os
-from dotenv import load_dotenv
-import aiofiles
-from .utils import split_into_chunks
+import json
+from collections import OrderedDict
+from .renderer import render, render_preview, build_embeds
+from .highlighter import CodeHighlighter
+from ollama_client import OllamaError
+from scheduler import QueueFull
+from history_store import estimate_tokens
+from quota import QuotaExceeded, WINDOWS
+from metrics import Metrics
+import history_transfer
+from batch import BatchRunner
 
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-OLLAMA_URL = os.getenv('OLLAMA_IP')
-
-CONFIG = {
-    'default_model': 'dolphin-mistral',
-    'max_response_length': 2048
-}
+def admit_request(bot, user_id, guild_id, messages):
+    """
+    Check a request before anything is done on its behalf: raises QuotaExceeded if the user or guild
+    has no token budget left for its prompt (see quota.QuotaManager) and QueueFull if the scheduler
+    would turn it away. Returns whether it should wait behind everyone else's requests.
+    """
+    low_priority = False
+    if bot.quotas is not None:
+        low_priority = not bot.quotas.admit(user_id, guild_id, sum(estimate_tokens(message['content']) for message in messages))
+    bot.scheduler.check(user_id)
+    return low_priority
 
-async def get_last_used_model(user_id):
-    async with aiosqlite.connect('conversation_history.db') as db:
-        async with db.execute("SELECT DISTINCT model FROM history WHERE user_id = ? ORDER BY timestamp DESC LIMIT 1", (user_id,)) as cursor:
-            result = await cursor.fetchone()
-            if result:
-                return result[0]
-    return CONFIG['default_model']
+async def chat_completion(bot, payload, user_id, guild_id=None, on_token=None, on_position=None, low_priority=False):
+    """
+    Run one /api/chat request through the scheduler and return the response text.
+    Streams when on_token is given, awaiting it with each new piece of text.
+    The user and guild are charged for the tokens Ollama reports.
+    """
+    model = payload['model']
+    queued = time.perf_counter()
+    async with bot.scheduler.slot(model, user_id, guild_id, on_position, low_priority) as backend:
+        bot.metrics.observe('queue', time.perf_counter() - queued)
+        with bot.metrics.span('ollama'):
+            if on_token is None:
+                data = await bot.ollama.chat(payload, user_id, backend)
+                bot.metrics.record_generation(model, data)
+                if bot.quotas is not None:
+                    bot.quotas.charge(user_id, guild_id, data)
+                return data['message']['content']
+            parts = []
+            async for chunk in bot.ollama.stream_chat(payload, user_id, backend):
+                content = chunk.get('message', {}).get('content', '')
+                if content:
+                    parts.append(content)
+                    await on_token(content)
+                if chunk.get('done'):
+                    bot.metrics.record_generation(model, chunk)
+                    if bot.quotas is not None:
+                        bot.quotas.charge(user_id, guild_id, chunk)
+            return ''.join(parts)
 
-async def save_models(models):
+async def generate_response(bot, model, user_id, message, regenerate=False, on_token=None, guild_id=None, on_position=None, low_priority=False):
     """
-    Save the list of available models to the 'available_models.txt' file.
+    Generate a response for the user's message using their history with the model.
+    When on_token is given the response is streamed and on_token is awaited with each new
+    piece of text. The turn is only saved to history once the full response has arrived.
+    The request waits for a slot in the bot's scheduler first; on_position is awaited with
+    the queue position while it waits.
+    Identical requests are answered from the response cache when it is enabled, except when
+    regenerating, which always samples a fresh response. Once saved, alternatives to the
+    response are prefetched in the background when the prefetcher is enabled.
+    A request turned away for its quota or a full queue leaves the conversation as it was;
+    low_priority puts it behind everyone else's even if its own quotas don't.
     """
-    async with aiofiles.open('available_models.txt', 'w') as file:
-        await file.write('\n'.join(models))
+    with bot.metrics.span('history'):
+        messages = await bot.context.build(user_id, model, message, regenerate, guild_id)
 
-async def generate_response(model, user_id, message, regenerate=False):
-    async with aiosqlite.connect('conversation_history.db') as db:
+    try:
+        low_priority = admit_request(bot, user_id, guild_id, messages) or low_priority
+        if bot.prefetcher is not None:
+            bot.prefetcher.discard(user_id, model)
         if regenerate:
-            async with db.execute("SELECT rowid FROM history WHERE model = ? AND user_id = ? ORDER BY timestamp DESC LIMIT 2", (model, user_id)) as cursor:
-                rows = await cursor.fetchall()
-                if rows:
-                    message_ids = [row[0] for row in rows]
-                    placeholders = ','.join('?' for _ in message_ids)
-                    await db.execute(f"DELETE FROM history WHERE rowid IN ({placeholders})", message_ids)
-                    await db.commit()
-
-        async with db.execute("SELECT message FROM history WHERE model = ? AND user_id = ? ORDER BY timestamp", (model, user_id)) as cursor:
-            history = [row[0] for row in await cursor.fetchall()]
-
-        messages = [
-            *[{"role": "user" if i % 2 == 0 else "assistant", "content": msg} for i, msg in enumerate(history)],
-            {"role": "user", "content": message}
-        ]
+            await bot.history.delete_last_turn(user_id, model)
+        bot.residency.record(model)
+        payload = {
+            'model': model,
+            'messages': messages,
+            'stream': on_token is not None,
+            'keep_alive': bot.residency.keep_alive(model),
+            'options': bot.context.options_for(model)
+        }
+        if bot.response_cache is not None and not regenerate:
+            response_message, cached = await bot.response_cache.get_or_generate(
+                payload, lambda: chat_completion(bot, payload, user_id, guild_id, on_token, on_position, low_priority)
+            )
+            if cached and on_token is not None:
+                await on_token(response_message)
+        else:
+            response_message = await chat_completion(bot, payload, user_id, guild_id, on_token, on_position, low_priority)
+        with bot.metrics.span('history_save'):
+            await bot.history.add_turn(user_id, model, message, response_message, guild_id)
+        bot.catalogue.record_use(user_id, model)
+        if bot.prefetcher is not None:
+            bot.prefetcher.schedule(user_id, model, message, payload, guild_id)
+        return response_message
+    except QueueFull as e:
+        logger.warning(f"Rejected request from user {user_id} for '{model}': {str(e)}")
+        return str(e)
+    except QuotaExceeded as e:
+        logger.info(f"Rejected request from user {user_id} for '{model}' over its {e.scope}'s {e.window} token quota")
+        return str(e)
+    except OllamaError as e:
+        logger.error(f"Error generating response: HTTP {e.status}")
+        return "An error occurred while generating the response."
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.exception(f"Error generating response: {str(e)}")
+        return "An error occurred while generating the response."
 
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f'{OLLAMA_URL}/api/chat', json={
-                    'model': model,
-                    'messages': messages,
-                    'stream': False,
-                    'keep_alive': '24h',
-                    'options': {
-                        'num_ctx': 16384
-                    }
-                }) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        response_message = data['message']['content']
-                        await db.execute("INSERT INTO history (model, user_id, message, timestamp) VALUES (?, ?, ?, ?)", (model, user_id, message, int(time.time())))
-                        await db.execute("INSERT INTO history (model, user_id, message, timestamp) VALUES (?, ?, ?, ?)", (model, user_id, response_message, int(time.time())))
-                        await db.commit()
-                        return response_message
-                    else:
-                        logger.error(f"Error generating response: HTTP {response.status}")
-                        return "An error occurred while generating the response."
-        except aiohttp.ClientError as e:
-            logger.exception(f"Error generating response: {str(e)}")
-            return "An error occurred while generating the response."
+async def replace_last_response(bot, model, user_id, message, response, guild_id=None):
+    """
+    Swap the response of the latest turn for another one, such as a prefetched alternative.
+    """
+    await bot.history.delete_last_turn(user_id, model)
+    await bot.history.add_turn(user_id, model, message, response, guild_id)
+    bot.catalogue.record_use(user_id, model)
+
+class LocalJobs:
+    """
+    Does the work behind the commands - history, context building, Ollama calls and rendering -
+    in this process. The cogs only talk to it through bot.jobs; workers.WorkerPool offers the
+    same methods and runs them in worker processes instead.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.config = bot.config
+        self.highlighter = CodeHighlighter(self.config['code_highlighting'], max_workers=self.config['highlight_workers'], attachment_size=self.config['code_attachment_size'])
+
+    async def close(self):
+        self.highlighter.close()
+
+    @property
+    def paginator_expiry(self):
+        return self.bot.history.paginator_expiry
+
+    async def last_used_model(self, user_id):
+        model = await self.bot.history.last_used_model(user_id)
+        return model or self.config['default_model']
+
+    async def build_response(self, response):
+        """
+        Render a finished response into (embeds, files): prose pages, then its code blocks.
+        """
+        rendered = render(response, self.config['max_response_length'])
+        code_embeds, files = await self.highlighter.build_embeds(rendered.code_blocks)
+        return build_embeds(rendered) + code_embeds, files
+
+    async def respond(self, model, user_id, message, guild_id=None, regenerate=False, on_token=None, on_position=None, low_priority=False):
+        """
+        Generate a response (see generate_response) and render it into (embeds, files).
+        """
+        response = await generate_response(self.bot, model, user_id, message, regenerate, on_token, guild_id, on_position, low_priority)
+        with self.bot.metrics.span('render'):
+            return await self.build_response(response)
+
+    async def take_alternative(self, model, user_id, message, guild_id=None):
+        """
+        Swap a prefetched alternative into history and return it rendered, or None if none is ready
+        or the user or guild is over budget (alternatives are paid for when generated, but aren't
+        handed out past the quota).
+        """
+        prefetcher = self.bot.prefetcher
+        quotas = self.bot.quotas
+        if quotas is not None and quotas.over_budget(user_id, guild_id, estimate_tokens(message)) is not None:
+            return None
+        alternative = prefetcher.take(user_id, model, message) if prefetcher is not None else None
+        if alternative is None:
+            return None
+        with self.bot.metrics.span('history_save'):
+            await replace_last_response(self.bot, model, user_id, message, alternative, guild_id)
+        with self.bot.metrics.span('render'):
+            return await self.build_response(alternative)
+
+    async def clear_history(self, user_id, model=None):
+        self.bot.context.cancel(user_id, model)
+        if self.bot.prefetcher is not None:
+            self.bot.prefetcher.discard(user_id, model)
+        await self.bot.history.clear(user_id, model)
+
+    async def export_history(self, path, user_id=None, model=None, compress=True):
+        """
+        Write history (everyone's, or one user's) as JSON lines to a file at path. Returns the number of turns written.
+        """
+        return await history_transfer.export_history(self.bot.history, path, user_id, model, compress)
+
+    async def import_history(self, path, shard=None):
+        """
+        Load history exported to the file at path. Returns (turns read, turns inserted, conversations left out).
+        With shard=(index, count), only the users whose id modulo count is index are loaded.
+        """
+        owns = None
+        if shard is not None:
+            index, count = shard
+            owns = lambda user_id: user_id % count == index
+        return await history_transfer.import_history(self.bot.history, path, owns)
+
+    async def run_batch(self, model, user_id, guild_id, prompts, path, on_progress=None, admit=None):
+        """
+        Run (id, prompt, system) prompts against the model, appending results to the file at path
+        (see batch.BatchRunner). on_progress is awaited with the stats now and then; returns the final stats.
+        admit checks each prompt against budgets kept outside this process.
+        """
+        bot = self.bot
+        bot.residency.record(model)
+        runner = BatchRunner(
+            bot.scheduler, bot.ollama, model, user_id, guild_id, bot.metrics,
+            keep_alive=bot.residency.keep_alive(model),
+            options=bot.context.options_for(model),
+            concurrency=self.config['batch_concurrency'],
+            quotas=bot.quotas,
+            admit=admit
+        )
+        return await runner.run(prompts, path, on_progress, self.config['batch_progress_interval'])
+
+    async def quota_report(self, scope, subject_id):
+        """
+        Return a user's ('user') or guild's ('guild') token limits, what is left of them and its usage over the last day.
+        """
+        return await self.bot.quotas.report(scope, subject_id)
+
+    async def set_quota(self, scope, subject_id, window, tokens):
+        await self.bot.quotas.set_limit(scope, subject_id, window, tokens)
+
+    async def get_quota_limits(self):
+        return await self.bot.history.get_quota_limits()
+
+    async def get_quota_usage(self, since, scope=None, subject_id=None):
+        return await self.bot.history.get_quota_usage(since, scope, subject_id)
+
+    async def drain_quota(self):
+        """
+        Save the token usage recorded so far and return what was charged to budgets enforced elsewhere (see QuotaManager.drain).
+        """
+        return self.bot.quotas.drain()
+
+    async def flush_quota(self):
+        await self.bot.quotas.flush()
+
+    async def save_paginator(self, user_id, model, message, pages):
+        return await self.bot.history.save_paginator(user_id, model, message, pages)
+
+    async def update_paginator(self, paginator_id, pages):
+        await self.bot.history.update_paginator(paginator_id, pages)
+
+    async def touch_paginator(self, paginator_id, used):
+        await self.bot.history.touch_paginator(paginator_id, used)
+
+    async def get_paginator(self, paginator_id):
+        return await self.bot.history.get_paginator(paginator_id)
+
+    async def warm(self):
+        """
+        Bring the loaded models in line with demand soon, e.g. after a model was created.
+        """
+        self.bot.residency.schedule_warm()
+
+    async def report(self):
+        """
+        Return the state behind /stats and /cache_stats as plain data. 'metrics' is a list of Metrics.state()s.
+        """
+        bot = self.bot
+        return {
+            'metrics': [bot.metrics.state()],
+            'residency': bot.residency.snapshot(),
+            'history_cache': bot.history.cache.stats(),
+            'response_cache': bot.response_cache.stats() if bot.response_cache is not None else None,
+            'prefetch': bot.prefetcher.stats() if bot.prefetcher is not None else None,
+            'quota': bot.quotas.stats() if bot.quotas is not None else None
+        }
+
+    async def size_report(self):
+        return await self.bot.history.size_report()
+
+    async def compact(self):
+        """
+        Apply the retention policies now, then expire paginators and vacuum. Returns (conversations, rows) archived.
+        """
+        maintenance = self.bot.maintenance
+        conversations, rows = await maintenance.apply_retention()
+        if maintenance.primary:
+            await maintenance.expire_paginators()
+            await maintenance.optimize()
+        return conversations, rows
 
 async def model_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
     """
     Autocomplete function for the 'model' parameter in the '/chat' and '/clear_history' commands.
-    Returns a list of available models that match the current input.
+    Returns up to 25 available models that match the current input, ranked for the user.
     """
     return [
         app_commands.Choice(name=model, value=model)
-        for model in interaction.client.available_models if current.lower() in model.lower()
+        for model in interaction.client.catalogue.search(current, interaction.user.id)
     ]
 
 async def delete_model_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
     """
     Autocomplete function for the 'name' parameter in the '/delete_model' command.
-    Returns a list of available models that match the current input.
+    Returns up to 25 available models that match the current input.
     """
     return [
         app_commands.Choice(name=model, value=model)
-        for model in interaction.client.available_models if current.lower() in model.lower()
+        for model in interaction.client.catalogue.search(current)
     ]
 
-def format_response(response):
-    formatted_response = response.replace('**', '*').replace('__', '_')
-    formatted_response = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', r'[\1](\2)', formatted_response)
-    formatted_response = formatted_response.replace('<br>', '\n')
-    return formatted_response
+def queue_position_updater(message, title):
+    """
+    Return a callback that shows the request's queue position on a status message.
+    """
+    async def on_position(position):
+        embed = discord.Embed(title=title, description=f"The server is busy. Your request is number {position} in the queue.", color=discord.Color.blurple())
+        await message.edit(embed=embed)
+    return on_position
+
+class StreamingEmbed:
+    """
+    Shows a response on an existing message while it is being streamed.
+    Edits run in a background task, so reading the stream never waits on Discord, and are
+    coalesced to at most one per interval with the latest text to stay inside Discord's rate
+    limits. Once the text outgrows max_response_length the message rolls over to the next page.
+    Use it as an async context manager, so no edit lands after the final response is shown.
+    """
+    def __init__(self, message, edit_interval, max_response_length, title="AI Response"):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.max_response_length = max_response_length
+        self.title = title
+        self.parts = []
+        self.shown = 0
+        self.last_edit = 0
+        self.task = None
+        self.editing = False
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def add(self, content):
+        self.parts.append(content)
+        if self.task is None and not self.closed:
+            self.task = asyncio.create_task(self.edit_loop())
+
+    async def edit_loop(self):
+        try:
+            while not self.closed and self.shown < len(self.parts):
+                delay = self.last_edit + self.edit_interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                self.last_edit = time.monotonic()
+                self.shown = len(self.parts)
+                self.editing = True
+                try:
+                    await self.message.edit(embed=self.render())
+                except discord.HTTPException as e:
+                    logger.warning(f"Failed to update streamed response: {str(e)}")
+                finally:
+                    self.editing = False
+        finally:
+            self.task = None
+
+    async def close(self):
+        """
+        Stop editing: a pending edit is dropped, one already sent to Discord is waited for.
+        """
+        self.closed = True
+        task = self.task
+        if task is not None:
+            if not self.editing:
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def render(self):
+        part, page = render_preview(''.join(self.parts), self.max_response_length)
+        title = self.title if part == 1 else f"{self.title} (Part {part})"
+        embed = discord.Embed(title=title, description=page, color=discord.Color.green())
+        embed.set_footer(text="Generating...")
+        return embed
+
+class PaginatorCache:
+    """
+    The most recently used paginators, by id. Older ones are dropped and reloaded from the history database on demand.
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.paginators = OrderedDict()
+
+    def get(self, paginator_id):
+        paginator = self.paginators.get(paginator_id)
+        if paginator is not None:
+            self.paginators.move_to_end(paginator_id)
+        return paginator
+
+    def put(self, paginator):
+        self.paginators[paginator.id] = paginator
+        self.paginators.move_to_end(paginator.id)
+        while len(self.paginators) > self.max_entries:
+            self.paginators.popitem(last=False)
+
+    def discard(self, paginator_id):
+        self.paginators.pop(paginator_id, None)
+
+    def discard_user(self, user_id, model=None):
+        for paginator_id in [key for key, paginator in self.paginators.items() if paginator.user_id == user_id and model in (None, paginator.model)]:
+            del self.paginators[paginator_id]
+
+async def get_paginator(bot, paginator_id):
+    """
+    Return the paginator with the given id from memory (bot.paginators) or the database, or None if it has expired.
+    """
+    now = time.time()
+    jobs = bot.jobs
+    paginator = bot.paginators.get(paginator_id)
+    if paginator is not None and jobs.paginator_expiry is not None and paginator.used < now - jobs.paginator_expiry:
+        bot.paginators.discard(paginator_id)
+        return None
+    if paginator is None:
+        row = await jobs.get_paginator(paginator_id)
+        if row is None:
+            return None
+        paginator = Paginator.from_row(row)
+        bot.paginators.put(paginator)
+    if now - paginator.used > bot.config['paginator_touch_interval']:
+        paginator.used = now
+        await jobs.touch_paginator(paginator_id, now)
+    return paginator
 
 class Paginator:
-    def __init__(self, interaction: discord.Interaction, embeds: list[discord.Embed], model: str, user_id: int, message: str):
+    """
+    A response split into pages of embeds, with buttons to page through and regenerate it.
+
+    The pages are saved to the history database when the response is first shown. The buttons'
+    custom_ids carry the paginator's id and the page on display, so they keep working after a
+    restart; only recently used paginators are kept in memory and the rest are loaded on click.
+    """
+    def __init__(self, interaction: discord.Interaction, embeds: list[discord.Embed], model: str, user_id: int, message: str, files=None, paginator_id=None, used=None):
         self.interaction = interaction
         self.embeds = embeds
+        self.files = files or []
         self.current_page = 0
         self.model = model
         self.user_id = user_id
         self.message_content = message.content if isinstance(message, discord.Message) else message
+        self.id = paginator_id
+        self.used = used or time.time()
 
-    async def start(self):
-        self.message = await self.interaction.followup.send(embed=self.embeds[0], view=PaginatorView(self))
+    @classmethod
+    def from_row(cls, row):
+        paginator_id, user_id, model, message, pages, used = row
+        embeds = [discord.Embed.from_dict(page) for page in json.loads(pages)]
+        return cls(None, embeds, model, user_id, message, paginator_id=paginator_id, used=used)
 
-    async def update(self):
-        await self.message.edit(embed=self.embeds[self.current_page], view=PaginatorView(self))
+    async def save(self, bot):
+        pages = json.dumps([embed.to_dict() for embed in self.embeds], ensure_ascii=False)
+        if self.id is None:
+            self.id = await bot.jobs.save_paginator(self.user_id, self.model, self.message_content, pages)
+        else:
+            await bot.jobs.update_paginator(self.id, pages)
+        self.used = time.time()
+        bot.paginators.put(self)
 
-    async def regenerate(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await interaction.response.defer()
-        await interaction.delete_original_response()
-        confirmation_embed = discord.Embed(
-            title="Regenerating Response",
-            description="Please wait while the response is being regenerated...",
-            color=discord.Color.blue()
-        )
-        confirmation_message = await interaction.followup.send(embed=confirmation_embed)
-        response = await generate_response(self.model, self.user_id, self.message_content, regenerate=True)
-        response = format_response(response)
-
-        max_length = CONFIG['max_response_length']
-        if len(response) > max_length:
-            chunks = split_into_chunks(response, max_length)
-            self.embeds = [discord.Embed(title=f"AI Response (Part {i+1})", description=chunk, color=discord.Color.green()) for i, chunk in enumerate(chunks)]
+    async def start(self, message=None):
+        """
+        Save the pages, then send the first page, or show it in place on an existing message such
+        as a streamed response. Attached code files go out with it and stay on the message while paging.
+        """
+        await self.save(self.interaction.client)
+        if message is None:
+            await self.interaction.followup.send(embed=self.embeds[0], view=PaginatorView(self), files=self.files)
         else:
-            self.embeds = [discord.Embed(title="AI Response", description=response, color=discord.Color.green())]
+            await message.edit(embed=self.embeds[self.current_page], view=PaginatorView(self), attachments=self.files)
+        # The files are on the message now; don't keep them in memory.
+        self.files = []
 
-        self.current_page = 0
-        await confirmation_message.delete()
-        await self.start()
+    async def show(self, interaction: discord.Interaction, page):
+        self.current_page = page
+        await interaction.response.edit_message(embed=self.embeds[page], view=PaginatorView(self))
 
-class PaginatorView(discord.ui.View):
-    def __init__(self, paginator: Paginator):
-        super().__init__(timeout=None)
-        self.paginator = paginator
+    async def regenerate(self, interaction: discord.Interaction, button: discord.ui.Button):
+        """
+        Show a prefetched alternative in place if one is ready, otherwise generate a new response.
+        """
+        self.interaction = interaction
+        jobs = interaction.client.jobs
+        config = interaction.client.config
+        metrics = interaction.client.metrics
+        with metrics.span('regenerate'):
+            with metrics.span('discord'):
+                await interaction.response.defer()
+            alternative = await jobs.take_alternative(self.model, self.user_id, self.message_content, interaction.guild_id)
+            if alternative is not None:
+                self.embeds, self.files = alternative
+                self.current_page = 0
+                with metrics.span('discord'):
+                    await self.start(interaction.message)
+                return
 
-        self.update_button_states()
+            with metrics.span('discord'):
+                await interaction.delete_original_response()
+                confirmation_embed = discord.Embed(
+                    title="Regenerating Response",
+                    description="Please wait while the response is being regenerated...",
+                    color=discord.Color.blue()
+                )
+                confirmation_message = await interaction.followup.send(embed=confirmation_embed)
+            on_position = queue_position_updater(confirmation_message, confirmation_embed.title)
+            async with StreamingEmbed(confirmation_message, config['stream_edit_interval'], config['max_response_length']) as streamer:
+                on_token = streamer.add if config['stream_responses'] else None
+                self.embeds, self.files = await jobs.respond(self.model, self.user_id, self.message_content, interaction.guild_id, regenerate=True, on_token=on_token, on_position=on_position)
 
-    def update_button_states(self):
-        if len(self.paginator.embeds) == 1:
-            self.previous_page.disabled = True
-            self.next_page.disabled = True
-        else:
-            if self.paginator.current_page == 0:
-                self.previous_page.disabled = True
-            else:
-                self.previous_page.disabled = False
-
-            if self.paginator.current_page == len(self.paginator.embeds) - 1:
-                self.next_page.disabled = True
-            else:
-                self.next_page.disabled = False
-
-    @discord.ui.button(label='⬅️ ', style=discord.ButtonStyle.blurple)
-    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.paginator.current_page > 0:
-            self.paginator.current_page -= 1
-            self.update_button_states()
-            await self.paginator.update()
-        await interaction.response.defer()
-
-    @discord.ui.button(label='➡️', style=discord.ButtonStyle.blurple)
-    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.paginator.current_page < len(self.paginator.embeds) - 1:
-            self.paginator.current_page += 1
-            self.update_button_states()
-            await self.paginator.update()
-        await interaction.response.defer()
-
-    @discord.ui.button(label='♻️', style=discord.ButtonStyle.green)
-    async def regenerate(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await self.paginator.regenerate(interaction, button)
+            self.current_page = 0
+            with metrics.span('discord'):
+                await self.start(confirmation_message)
+
+PAGINATOR_BUTTONS = {
+    'previous': ('⬅️ ', discord.ButtonStyle.blurple),
+    'next': ('➡️', discord.ButtonStyle.blurple),
+    'regenerate': ('♻️', discord.ButtonStyle.green)
+}
+
+class PaginatorButton(discord.ui.DynamicItem[discord.ui.Button], template=r'paginator:(?P<id>[0-9]+):(?P<page>[0-9]+):(?P<action>previous|next|regenerate)'):
+    """
+    A paginator button that works on any message, after restarts too: its custom_id names the paginator, the page shown and the action.
+    """
+    def __init__(self, paginator_id, page, action, disabled=False):
+        label, style = PAGINATOR_BUTTONS[action]
+        super().__init__(discord.ui.Button(label=label, style=style, custom_id=f'paginator:{paginator_id}:{page}:{action}', disabled=disabled))
+        self.paginator_id = paginator_id
+        self.page = page
+        self.action = action
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(int(match['id']), int(match['page']), match['action'])
 
-    async def on_timeout(self):
-        for child in self.children:
-            child.disabled = True
-        await self.paginator.message.edit(view=self)
+    async def callback(self, interaction: discord.Interaction):
+        paginator = await get_paginator(interaction.client, self.paginator_id)
+        if paginator is None:
+            embed = discord.Embed(title="Response Expired", description="This response is no longer available. Use /chat to continue the conversation.", color=discord.Color.red())
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
+        if self.action == 'regenerate':
+            await paginator.regenerate(interaction, self.item)
+            return
+        page = self.page - 1 if self.action == 'previous' else self.page + 1
+        await paginator.show(interaction, min(max(page, 0), len(paginator.embeds) - 1))
+
+class PaginatorView(discord.ui.View):
+    """
+    The buttons under a response. The view itself holds no state; each press is handled by PaginatorButton.
+    """
+    def __init__(self, paginator: Paginator):
+        super().__init__(timeout=None)
+        page = paginator.current_page
+        last = len(paginator.embeds) - 1
+        self.add_item(PaginatorButton(paginator.id, page, 'previous', disabled=page == 0))
+        self.add_item(PaginatorButton(paginator.id, page, 'next', disabled=page >= last))
+        self.add_item(PaginatorButton(paginator.id, page, 'regenerate'))
 
 class UtilityCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        bot.paginators = PaginatorCache(bot.config['paginator_cache_entries'])
+        self.owns_jobs = bot.jobs is None
+        if self.owns_jobs:
+            # No worker processes: do the work in this process.
+            bot.jobs = LocalJobs(bot)
+
+    async def cog_load(self):
+        self.bot.add_dynamic_items(PaginatorButton)
+
+    async def cog_unload(self):
+        self.bot.remove_dynamic_items(PaginatorButton)
+        if self.owns_jobs:
+            await self.bot.jobs.close()
+
+    @app_commands.command(name='cache_stats')
+    @app_commands.default_permissions(administrator=True)
+    async def cache_stats(self, interaction: discord.Interaction):
+        """
+        Command handler for the '/cache_stats' command.
+        Shows hit/miss counters and sizes of the history and response caches and of the prefetched alternatives.
+        """
+        report = await self.bot.jobs.report()
+        stats = report['history_cache']
+        history_embed = discord.Embed(title="History Cache", color=discord.Color.blue())
+        history_embed.add_field(name="Hit Rate", value=f"{stats['hit_rate']:.1%}", inline=True)
+        history_embed.add_field(name="Hits / Misses", value=f"{stats['hits']} / {stats['misses']}", inline=True)
+        history_embed.add_field(name="Evictions", value=str(stats['evictions']), inline=True)
+        history_embed.add_field(name="Conversations", value=str(stats['entries']), inline=True)
+        history_embed.add_field(name="Users", value=str(stats['users']), inline=True)
+        history_embed.add_field(name="Size", value=f"{stats['bytes'] / 1024:.1f} KiB", inline=True)
+        embeds = [history_embed]
+
+        if report['response_cache'] is not None:
+            stats = report['response_cache']
+            response_embed = discord.Embed(title="Response Cache", color=discord.Color.blue())
+            response_embed.add_field(name="Hit Rate", value=f"{stats['hit_rate']:.1%}", inline=True)
+            response_embed.add_field(name="Hits (Memory / Disk)", value=f"{stats['hits']} / {stats['disk_hits']}", inline=True)
+            response_embed.add_field(name="Misses", value=str(stats['misses']), inline=True)
+            response_embed.add_field(name="Coalesced", value=str(stats['coalesced']), inline=True)
+            response_embed.add_field(name="Entries in Memory", value=str(stats['entries']), inline=True)
+            embeds.append(response_embed)
+
+        if report['prefetch'] is not None:
+            stats = report['prefetch']
+            prefetch_embed = discord.Embed(title="Prefetched Alternatives", color=discord.Color.blue())
+            prefetch_embed.add_field(name="Served / Generated", value=f"{stats['served']} / {stats['generated']}", inline=True)
+            prefetch_embed.add_field(name="Preempted", value=str(stats['preempted']), inline=True)
+            prefetch_embed.add_field(name="Ready", value=f"{stats['ready']} for {stats['entries']} conversations", inline=True)
+            prefetch_embed.add_field(name="Size", value=f"{stats['bytes'] / 1024:.1f} KiB", inline=True)
+            embeds.append(prefetch_embed)
+
+        await interaction.response.send_message(embeds=embeds, ephemeral=True)
+
+    @app_commands.command(name='stats')
+    @app_commands.default_permissions(administrator=True)
+    async def stats(self, interaction: discord.Interaction):
+        """
+        Command handler for the '/stats' command.
+        Shows where requests spend their time and how fast each model generates.
+        """
+        report = await self.bot.jobs.report()
+        snapshot = Metrics.merged(report['metrics']).snapshot()
+        stage_embed = discord.Embed(title="Request Stages", description=f"Recent latency per stage, over {snapshot['uptime'] / 3600:.1f} hours of uptime.", color=discord.Color.blue())
+        for stage, stats in sorted(snapshot['stages'].items()):
+            value = f"p50 {stats['p50'] * 1000:.0f} ms · p95 {stats['p95'] * 1000:.0f} ms · p99 {stats['p99'] * 1000:.0f} ms\n{stats['count']} samples"
+            stage_embed.add_field(name=stage, value=value, inline=True)
+        if not snapshot['stages']:
+            stage_embed.description = "No requests have been handled yet."
+        embeds = [stage_embed]
+
+        if snapshot['models']:
+            model_embed = discord.Embed(title="Models", color=discord.Color.blue())
+            busiest = sorted(snapshot['models'].items(), key=lambda item: item[1]['requests'], reverse=True)[:24]
+            for model, stats in busiest:
+                value = (
+                    f"{stats['requests']} responses · {stats['cold_loads']} cold loads (p50 {stats['cold_load_seconds']:.1f}s)\n"
+                    f"{stats['tokens_per_second']:.1f} tokens/s · prompt {stats['prompt_tokens_per_second']:.0f} tokens/s\n"
+                    f"{stats['generated_tokens']} tokens generated"
+                )
+                model_embed.add_field(name=model, value=value, inline=False)
+            embeds.append(model_embed)
+
+        residency = report['residency'][:24]
+        if residency:
+            residency_embed = discord.Embed(title="Model Residency", description="Demand is requests per half-life, decaying over time.", color=discord.Color.blue())
+            for model, demand, keep_alive, loaded in residency:
+                residency_embed.add_field(name=model, value=f"demand {demand:.1f} · keep alive {keep_alive} · {'loaded' if loaded else 'not loaded'}", inline=False)
+            embeds.append(residency_embed)
+
+        await interaction.response.send_message(embeds=embeds, ephemeral=True)
+
+    @app_commands.command(name='quota')
+    @app_commands.describe(user="The user to show (optional, defaults to this server)")
+    @app_commands.default_permissions(administrator=True)
+    async def quota(self, interaction: discord.Interaction, user: discord.User = None):
+        """
+        Command handler for the '/quota' command.
+        Shows a user's or this server's token limits, how much of them is left and the tokens used over the last day.
+        """
+        if user is None and interaction.guild is None:
+            user = interaction.user
+        scope, subject_id, name = ('user', user.id, user.display_name) if user else ('guild', interaction.guild_id, interaction.guild.name)
+        report = await self.bot.jobs.quota_report(scope, subject_id)
+        embed = discord.Embed(title=f"Token Quota: {name}", color=discord.Color.blue())
+        for window in WINDOWS:
+            if window in report['limits']:
+                remaining = max(0, report['remaining'].get(window, report['limits'][window]))
+                embed.add_field(name=f"Per {window.capitalize()}", value=f"{remaining:,.0f} of {report['limits'][window]:,} tokens left", inline=True)
+        if not report['limits']:
+            embed.description = "No limits."
+        embed.add_field(name="Last 24 Hours", value=f"{report['requests']} responses · {report['prompt_tokens']:,} prompt and {report['tokens']:,} generated tokens", inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command(name='set_quota')
+    @app_commands.describe(window="The window the limit applies to")
+    @app_commands.describe(tokens="Prompt and generated tokens allowed per window (leave out to go back to the default)")
+    @app_commands.describe(user="The user to limit (optional, defaults to this server)")
+    @app_commands.choices(window=[app_commands.Choice(name=window, value=window) for window in WINDOWS])
+    @app_commands.default_permissions(administrator=True)
+    async def set_quota(self, interaction: discord.Interaction, window: app_commands.Choice[str], tokens: app_commands.Range[int, 0] = None, user: discord.User = None):
+        """
+        Command handler for the '/set_quota' command.
+        Sets a user's or this server's token limit for a window. Bot owner only.
+        """
+        if not await self.bot.is_owner(interaction.user):
+            embed = discord.Embed(title="Not Allowed", description="Only the bot's owner can change quotas.", color=discord.Color.red())
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
+        if user is None and interaction.guild is None:
+            user = interaction.user
+        scope, subject_id, name = ('user', user.id, user.display_name) if user else ('guild', interaction.guild_id, interaction.guild.name)
+        await self.bot.jobs.set_quota(scope, subject_id, window.value, tokens)
+        limit = f"{tokens:,} tokens" if tokens is not None else "the default"
+        embed = discord.Embed(title="Quota Updated", description=f"{name}'s limit per {window.value} is now {limit}.", color=discord.Color.green())
+        await interaction.response.send_message(embed=embed, ephemeral=True)
 
 async def setup(bot):
     await bot.add_cog(UtilityCog(bot))
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+
+import aiohttp
+
+from history_store import estimate_tokens
+from ollama_client import OllamaError
+from scheduler import QueueFull
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Merge the existing summary with the new turns into a single updated summary. "
+    "Keep names, facts, preferences, decisions and open questions; drop small talk. "
+    "Write plain prose in the third person and answer with the summary only."
+)
+
+
+class ContextBuilder:
+    """
+    Builds the message list sent to Ollama from a user's stored history.
+
+    Only the newest turns that fit the model's token budget, its context window (num_ctx) less the
+    response_tokens kept free for the response, are sent verbatim. Turns that fall
+    out of the window are folded into a rolling summary in the background; the summary is stored
+    with the history and reused until enough new turns have overflowed to fold again, so the
+    prompt stays roughly the same size however long the conversation gets.
+
+    With a MemoryIndex, the older exchanges most relevant to the new message are also recalled
+    and sent verbatim, within the memory's own share of the budget.
+
+    Summaries queue and are charged (with a QuotaManager) as requests of the conversation's user
+    and guild, like the chat requests they are made for.
+    """
+    def __init__(self, history, client, scheduler, num_ctx=16384, num_ctx_per_model=None, response_tokens=4096, keep_ratio=0.5, summary_options=None, memory=None, quotas=None):
+        self.history = history
+        self.client = client
+        self.scheduler = scheduler
+        self.num_ctx = num_ctx
+        self.num_ctx_per_model = num_ctx_per_model or {}
+        self.response_tokens = response_tokens
+        self.keep_ratio = keep_ratio
+        self.summary_options = summary_options or {}
+        self.memory = memory
+        self.quotas = quotas
+        self.pending = {}
+
+    def num_ctx_for(self, model):
+        return self.num_ctx_per_model.get(model, self.num_ctx)
+
+    def budget_for(self, model):
+        return self.num_ctx_for(model) - self.response_tokens
+
+    def options_for(self, model):
+        """
+        Ollama options for requests to the model, with the context window its prompts are budgeted for.
+        """
+        return {'num_ctx': self.num_ctx_for(model)}
+
+    async def build(self, user_id, model, message, regenerate=False, guild_id=None):
+        """
+        Return the messages for a new user message, starting with the summary of older turns if there is one.
+        When regenerating, the latest exchange is left out, as it will be replaced.
+        """
+        conversation = await self.history.get_conversation(user_id, model)
+        summary_text, _, summary_tokens = conversation.summary if conversation.summary else (None, 0, 0)
+        rows = conversation.rows
+        next_turn = conversation.last_turn + 1
+        if regenerate and rows:
+            # The same two rows HistoryStore.delete_last_turn removes.
+            rows = rows[:-2]
+            next_turn = conversation.rows[-2:][0][0]
+
+        available = self.budget_for(model) - estimate_tokens(message) - summary_tokens
+        if self.memory is not None:
+            available -= self.memory.max_tokens
+        start = len(rows)
+        used = 0
+        while start > 0 and used + rows[start - 1][3] <= available:
+            start -= 1
+            used += rows[start][3]
+        # Never open the window on an assistant reply without the message it answers.
+        while start < len(rows) and rows[start][1] != 'user':
+            start += 1
+
+        if start > 0:
+            self.schedule_fold(user_id, model, guild_id)
+
+        messages = []
+        if summary_text:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary_text}"})
+        if self.memory is not None:
+            before_turn = rows[start][0] if start < len(rows) else next_turn
+            recalled = await self.memory.recall(user_id, model, message, before_turn)
+            if recalled:
+                excerpts = '\n\n'.join(f"User: {question}\nAssistant: {answer}" for _, question, answer in recalled)
+                messages.append({"role": "system", "content": f"Relevant excerpts from earlier in the conversation:\n{excerpts}"})
+            self.memory.schedule_index(user_id, model)
+        messages.extend({"role": role, "content": content} for _, role, content, _ in rows[start:])
+        messages.append({"role": "user", "content": message})
+        return messages
+
+    def schedule_fold(self, user_id, model, guild_id=None):
+        """
+        Fold overflowing turns into the summary in the background, at most once at a time per conversation.
+        """
+        key = (user_id, model)
+        if key in self.pending:
+            return
+        task = asyncio.create_task(self.fold(user_id, model, guild_id))
+        self.pending[key] = task
+        task.add_done_callback(lambda _: self.pending.pop(key, None))
+
+    async def fold(self, user_id, model, guild_id=None):
+        """
+        Summarize older turns until the unsummarized tail fits in keep_ratio of the budget.
+        The newest exchange is always left out of the summary so regenerate can still remove it.
+        """
+        try:
+            summary = await self.history.get_summary(user_id, model)
+            summary_text, through_turn, _ = summary if summary else ("", 0, 0)
+            rows = await self.history.get_turns(user_id, model, after_turn=through_turn)
+
+            target = int(self.budget_for(model) * self.keep_ratio)
+            keep = len(rows)
+            kept = 0
+            while keep > 0 and kept + rows[keep - 1][3] <= target:
+                keep -= 1
+                kept += rows[keep][3]
+            keep = min(keep, len(rows) - 2)
+            # Only fold whole exchanges, so the summary always ends after an assistant reply.
+            while keep > 0 and rows[keep][1] != 'user':
+                keep -= 1
+            if keep <= 0:
+                return
+
+            # Fold in chunks that fit the budget, so a long backlog never produces an oversized prompt.
+            chunk, chunk_tokens = [], 0
+            for turn, role, content, tokens in rows[:keep]:
+                chunk.append(f"{role}: {content}")
+                chunk_tokens += tokens
+                if chunk_tokens >= target or turn == rows[keep - 1][0]:
+                    summary_text = await self.summarize(user_id, guild_id, model, summary_text, chunk)
+                    through_turn = turn
+                    chunk, chunk_tokens = [], 0
+
+            await self.history.save_summary(user_id, model, summary_text, through_turn)
+            logger.info(f"Folded history of user {user_id} with '{model}' into summary through turn {through_turn}")
+        except (OllamaError, QueueFull, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Failed to summarize history of user {user_id} with '{model}': {str(e)}")
+        except Exception as e:
+            logger.exception(f"Unexpected error summarizing history: {str(e)}")
+
+    async def summarize(self, user_id, guild_id, model, summary_text, lines):
+        transcript = '\n'.join(lines)
+        content = f"Existing summary:\n{summary_text or '(none)'}\n\nNew turns:\n{transcript}"
+        async with self.scheduler.slot(model, user_id, guild_id) as backend:
+            data = await self.client.chat({
+                'model': model,
+                'messages': [
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": content}
+                ],
+                'stream': False,
+                'options': {**self.options_for(model), **self.summary_options}
+            }, user_id, backend)
+        if self.quotas is not None:
+            self.quotas.charge(user_id, guild_id, data)
+        return data['message']['content'].strip()
+
+    def cancel(self, user_id, model=None):
+        """
+        Cancel pending summaries for a user's conversation with one model, or with every model.
+        Called before history is cleared so a late summary can't be saved over the fresh conversation.
+        """
+        if self.memory is not None:
+            self.memory.discard(user_id, model)
+        for (pending_user, pending_model), task in list(self.pending.items()):
+            if pending_user == user_id and model in (None, pending_model):
+                task.cancel()
+
+    async def close(self):
+        """
+        Cancel summaries still running at shutdown; they will be redone on the next request.
+        """
+        for task in list(self.pending.values()):
+            task.cancel()
+        await asyncio.gather(*self.pending.values(), return_exceptions=True)
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+# Rough per-row overhead of the tuple and its boxed fields, on top of the message text.
+ROW_OVERHEAD = 96
+
+MISSING = object()
+
+
+class Conversation:
+    """
+    The part of a conversation the context builder needs: the stored summary, if any,
+    and the (turn, role, message, tokens) rows after it. Treated as immutable; writers
+    replace it with a new instance.
+    """
+    __slots__ = ('summary', 'rows', 'size')
+
+    def __init__(self, summary, rows):
+        self.summary = summary
+        self.rows = rows
+        self.size = (len(summary[0]) if summary else 0) + sum(len(row[2]) + ROW_OVERHEAD for row in rows)
+
+    @property
+    def last_turn(self):
+        if self.rows:
+            return self.rows[-1][0]
+        return self.summary[1] if self.summary else 0
+
+
+class HistoryCache:
+    """
+    LRU cache of recent conversations keyed by (user_id, model), bounded by entry count and by
+    the approximate bytes of message text held, plus each user's last-used model.
+    All operations are synchronous, so they are atomic with respect to other coroutines.
+    """
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.conversations = OrderedDict()
+        self.last_models = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        conversation = self.conversations.get(key)
+        if conversation is None:
+            self.misses += 1
+            return None
+        self.conversations.move_to_end(key)
+        self.hits += 1
+        return conversation
+
+    def put(self, key, conversation):
+        self.discard(key)
+        if conversation.size > self.max_bytes:
+            return
+        self.conversations[key] = conversation
+        self.bytes += conversation.size
+        while len(self.conversations) > self.max_entries or self.bytes > self.max_bytes:
+            _, evicted = self.conversations.popitem(last=False)
+            self.bytes -= evicted.size
+            self.evictions += 1
+
+    def discard(self, key):
+        conversation = self.conversations.pop(key, None)
+        if conversation is not None:
+            self.bytes -= conversation.size
+
+    def discard_user(self, user_id):
+        for key in [key for key in self.conversations if key[0] == user_id]:
+            self.discard(key)
+        self.last_models.pop(user_id, None)
+
+    def get_last_model(self, user_id):
+        model = self.last_models.get(user_id, MISSING)
+        if model is MISSING:
+            self.misses += 1
+        else:
+            self.last_models.move_to_end(user_id)
+            self.hits += 1
+        return model
+
+    def set_last_model(self, user_id, model):
+        self.last_models[user_id] = model
+        self.last_models.move_to_end(user_id)
+        while len(self.last_models) > self.max_entries:
+            self.last_models.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.conversations),
+            'users': len(self.last_models),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,841 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import zlib
+from urllib.request import pathname2url
+
+import aiosqlite
+
+from history_cache import Conversation, HistoryCache, MISSING
+
+logger = logging.getLogger(__name__)
+
+# Schema migrations, applied in order at startup. The version reached is kept in PRAGMA user_version,
+# so every migration runs exactly once per database. Never edit a migration that has shipped; add a new one.
+MIGRATIONS = [
+    # 1: the original table created inline by on_ready.
+    '''
+    CREATE TABLE IF NOT EXISTS history (
+        model TEXT,
+        user_id INTEGER,
+        message TEXT,
+        timestamp INTEGER
+    );
+    ''',
+    # 2: integer primary key, explicit turn order and role, and indexes for the hot queries.
+    # Existing rows are numbered by their old (timestamp, rowid) order; roles alternate starting with the user.
+    '''
+    CREATE TABLE history_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        turn INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        message TEXT NOT NULL,
+        timestamp REAL NOT NULL
+    );
+    INSERT INTO history_new (user_id, model, turn, role, message, timestamp)
+    SELECT user_id, model, turn, CASE WHEN turn % 2 = 1 THEN 'user' ELSE 'assistant' END, COALESCE(message, ''), COALESCE(timestamp, 0)
+    FROM (
+        SELECT user_id, model, message, timestamp,
+               ROW_NUMBER() OVER (PARTITION BY user_id, model ORDER BY timestamp, rowid) AS turn
+        FROM history
+    )
+    ORDER BY user_id, model, turn;
+    DROP TABLE history;
+    ALTER TABLE history_new RENAME TO history;
+    CREATE UNIQUE INDEX idx_history_conversation ON history (user_id, model, turn);
+    CREATE INDEX idx_history_user_recent ON history (user_id, timestamp);
+    ''',
+    # 3: estimated token counts per message and the rolling summary of turns that fell out of the context window.
+    '''
+    ALTER TABLE history ADD COLUMN tokens INTEGER NOT NULL DEFAULT 0;
+    UPDATE history SET tokens = LENGTH(message) / 4 + 4;
+    CREATE TABLE summaries (
+        user_id INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        through_turn INTEGER NOT NULL,
+        summary TEXT NOT NULL,
+        tokens INTEGER NOT NULL,
+        timestamp REAL NOT NULL,
+        PRIMARY KEY (user_id, model)
+    );
+    ''',
+    # 4: embedding of each exchange for long-term memory, stored on its user row as float32 bytes.
+    '''
+    ALTER TABLE history ADD COLUMN embedding BLOB;
+    ALTER TABLE history ADD COLUMN embedding_model TEXT;
+    ''',
+    # 5: the guild each turn was sent from, for per-guild retention, and compressed archives of turns past retention.
+    '''
+    ALTER TABLE history ADD COLUMN guild_id INTEGER;
+    CREATE TABLE history_archive (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        guild_id INTEGER,
+        first_turn INTEGER NOT NULL,
+        last_turn INTEGER NOT NULL,
+        turns INTEGER NOT NULL,
+        archived REAL NOT NULL,
+        data BLOB NOT NULL
+    );
+    CREATE INDEX idx_history_archive_user ON history_archive (user_id, model);
+    ''',
+    # 6: the pages of every response shown with paginator buttons, so the buttons keep working after a restart.
+    '''
+    CREATE TABLE paginators (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        message TEXT NOT NULL,
+        pages TEXT NOT NULL,
+        created REAL NOT NULL,
+        used REAL NOT NULL
+    );
+    CREATE INDEX idx_paginators_used ON paginators (used);
+    CREATE INDEX idx_paginators_user ON paginators (user_id, model);
+    ''',
+    # 7: tokens used per user and per guild, one row per subject and hour, and limits set by admins.
+    '''
+    CREATE TABLE quota_usage (
+        scope TEXT NOT NULL,
+        subject_id INTEGER NOT NULL,
+        period REAL NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        tokens INTEGER NOT NULL,
+        requests INTEGER NOT NULL,
+        PRIMARY KEY (scope, subject_id, period)
+    );
+    CREATE INDEX idx_quota_usage_period ON quota_usage (period);
+    CREATE TABLE quota_limits (
+        scope TEXT NOT NULL,
+        subject_id INTEGER NOT NULL,
+        window_name TEXT NOT NULL,
+        tokens INTEGER NOT NULL,
+        PRIMARY KEY (scope, subject_id, window_name)
+    );
+    ''',
+]
+
+
+def estimate_tokens(text):
+    """
+    Cheap token estimate for a chat message: about four characters per token plus per-message overhead.
+    Kept in step with the backfill in migration 3.
+    """
+    return len(text) // 4 + 4
+
+
+class HistoryStore:
+    """
+    Conversation history backed by a single long-lived SQLite connection in WAL mode.
+    Reads share the connection freely; writes are serialized through a lock so each
+    one runs in its own explicit transaction.
+
+    Recent conversations and each user's last-used model are kept in an LRU cache.
+    Writes go to the database and the cache together, and concurrent misses for the
+    same conversation share a single load.
+
+    New turns are written behind: add_turn queues them and a background writer commits
+    everything queued in one transaction once batch_size turns are waiting or flush_interval
+    has passed. Until then the queued rows are merged into reads of their conversation.
+    durability picks when add_turn returns:
+      'immediate' - after its rows are committed, flushing the queue right away;
+      'batched'   - after its rows are committed, sharing the commit with other turns in the batch;
+      'deferred'  - as soon as the rows are queued; a crash can lose the last flush_interval of turns.
+
+    The pages of responses shown with paginator buttons are kept here too, and expire once they
+    haven't been used for paginator_expiry seconds (never if None).
+    """
+    def __init__(self, path='conversation_history.db', cache_entries=1024, cache_bytes=64 * 1024 * 1024,
+                 durability='batched', batch_size=64, flush_interval=0.05, paginator_expiry=30 * 86400):
+        self.path = path
+        self.db = None
+        self.write_lock = asyncio.Lock()
+        self.cache = HistoryCache(cache_entries, cache_bytes)
+        self.loading = {}
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.paginator_expiry = paginator_expiry
+        self.queue = []
+        self.queued_rows = {}
+        self.append_lock = asyncio.Lock()
+        self.queued = asyncio.Event()
+        self.full = asyncio.Event()
+        self.writer = None
+
+    async def open(self):
+        """
+        Open the connection, switch to WAL journaling and bring the schema up to date.
+        """
+        self.db = await aiosqlite.connect(self.path, isolation_level=None)
+        await self.db.execute("PRAGMA journal_mode=WAL")
+        await self.db.execute("PRAGMA synchronous=NORMAL")
+        await self.migrate()
+        self.writer = asyncio.create_task(self.write_loop())
+
+    async def migrate(self):
+        async with self.db.execute("PRAGMA user_version") as cursor:
+            version = (await cursor.fetchone())[0]
+
+        for target, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"Migrating history database to schema version {target}")
+            await self.db.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {target};\nCOMMIT;")
+
+    async def close(self):
+        """
+        Stop the background writer, commit whatever is still queued and close the connection.
+        """
+        if self.writer is not None:
+            self.writer.cancel()
+            await asyncio.gather(self.writer, return_exceptions=True)
+            self.writer = None
+        if self.db is not None:
+            await self.flush()
+            await self.db.close()
+            self.db = None
+
+    async def write_loop(self):
+        while True:
+            await self.queued.wait()
+            if not self.full.is_set():
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self.queued.clear()
+            self.full.clear()
+            await self.flush()
+
+    async def flush(self):
+        """
+        Commit every queued turn in a single transaction. Cancelling the caller doesn't interrupt the commit.
+        """
+        await asyncio.shield(self.commit_queued())
+
+    async def commit_queued(self):
+        async with self.write_lock:
+            batch, self.queue = self.queue, []
+            if not batch:
+                return
+            try:
+                await self.db.execute("BEGIN")
+                try:
+                    await self.db.executemany(
+                        "INSERT INTO history (user_id, model, turn, role, message, tokens, timestamp, guild_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(*key, *row, now, guild_id) for key, rows, now, guild_id, _ in batch for row in rows]
+                    )
+                    await self.db.execute("COMMIT")
+                except BaseException:
+                    await self.db.execute("ROLLBACK")
+                    raise
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} turns to history, they are lost: {str(e)}")
+                error = e
+            else:
+                error = None
+
+            for key, rows, _, _, done in batch:
+                queued = self.queued_rows.get(key)
+                if queued is not None:
+                    del queued[:len(rows)]
+                    if not queued:
+                        del self.queued_rows[key]
+                if error is not None:
+                    self.invalidate(key)
+                if done is not None and not done.done():
+                    if error is None:
+                        done.set_result(None)
+                    else:
+                        done.set_exception(error)
+
+    def with_queued(self, rows, queued):
+        """
+        Append queued rows that aren't in the database yet to rows read from it.
+        queued must be captured before the read, so rows committed meanwhile aren't missed.
+        """
+        last_turn = rows[-1][0] if rows else 0
+        return rows + [row for row in queued if row[0] > last_turn]
+
+    async def get_messages(self, user_id, model):
+        """
+        Return the conversation with a model as a list of chat messages, oldest first.
+        """
+        rows = await self.get_turns(user_id, model)
+        return [{"role": role, "content": message} for _, role, message, _ in rows]
+
+    async def get_conversation(self, user_id, model):
+        """
+        Return the cached Conversation for a user and model, loading it from the database on a miss.
+        """
+        key = (user_id, model)
+        conversation = self.cache.get(key)
+        if conversation is not None:
+            return conversation
+
+        task = self.loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.load_conversation(key))
+            self.loading[key] = task
+            task.add_done_callback(lambda done: self.loading.get(key) is done and self.loading.pop(key))
+        return await asyncio.shield(task)
+
+    async def load_conversation(self, key):
+        summary = await self.get_summary(*key)
+        rows = await self.get_turns(*key, after_turn=summary[1] if summary else 0)
+        conversation = Conversation(summary, rows)
+        # A write while we were reading drops us from self.loading; don't cache what may be stale.
+        if self.loading.get(key) is asyncio.current_task():
+            self.cache.put(key, conversation)
+        return conversation
+
+    def invalidate(self, key):
+        self.cache.discard(key)
+        self.loading.pop(key, None)
+
+    async def get_turns(self, user_id, model, after_turn=0):
+        """
+        Return (turn, role, message, tokens) rows of a conversation after the given turn, oldest first,
+        including turns still queued for writing.
+        """
+        queued = list(self.queued_rows.get((user_id, model), ()))
+        async with self.db.execute(
+            "SELECT turn, role, message, tokens FROM history WHERE user_id = ? AND model = ? AND turn > ? ORDER BY turn",
+            (user_id, model, after_turn)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        return self.with_queued(rows, [row for row in queued if row[0] > after_turn])
+
+    async def get_summary(self, user_id, model):
+        """
+        Return (summary, through_turn, tokens) for the conversation, or None if nothing has been summarized yet.
+        """
+        async with self.db.execute("SELECT summary, through_turn, tokens FROM summaries WHERE user_id = ? AND model = ?", (user_id, model)) as cursor:
+            return await cursor.fetchone()
+
+    async def save_summary(self, user_id, model, summary, through_turn):
+        key = (user_id, model)
+        tokens = estimate_tokens(summary)
+        async with self.write_lock:
+            await self.db.execute(
+                "INSERT OR REPLACE INTO summaries (user_id, model, through_turn, summary, tokens, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, model, through_turn, summary, tokens, time.time())
+            )
+            self.loading.pop(key, None)
+            cached = self.cache.conversations.get(key)
+            if cached is not None:
+                rows = [row for row in cached.rows if row[0] > through_turn]
+                self.cache.put(key, Conversation((summary, through_turn, tokens), rows))
+
+    async def get_embeddings(self, user_id, model, embedding_model):
+        """
+        Return (turn, embedding) for the conversation's exchanges embedded with embedding_model, oldest first.
+        """
+        async with self.db.execute(
+            "SELECT turn, embedding FROM history WHERE user_id = ? AND model = ? AND embedding_model = ? ORDER BY turn",
+            (user_id, model, embedding_model)
+        ) as cursor:
+            return await cursor.fetchall()
+
+    async def get_unembedded(self, user_id, model, embedding_model, limit=32):
+        """
+        Return (turn, message, response) for exchanges not yet embedded with embedding_model, oldest first.
+        The newest exchange is left out until another one follows it, since regenerate may still replace it.
+        """
+        async with self.db.execute(
+            '''
+            SELECT question.turn, question.message, answer.message
+            FROM history AS question
+            JOIN history AS answer ON answer.user_id = question.user_id AND answer.model = question.model AND answer.turn = question.turn + 1
+            WHERE question.user_id = ? AND question.model = ? AND question.role = 'user'
+              AND question.embedding_model IS NOT ?
+              AND question.turn < (SELECT MAX(turn) - 1 FROM history WHERE user_id = ? AND model = ?)
+            ORDER BY question.turn LIMIT ?
+            ''',
+            (user_id, model, embedding_model, user_id, model, limit)
+        ) as cursor:
+            return await cursor.fetchall()
+
+    async def save_embeddings(self, user_id, model, embedding_model, embeddings):
+        """
+        Store (turn, embedding) pairs on the user rows of their exchanges.
+        """
+        async with self.write_lock:
+            await self.db.execute("BEGIN")
+            try:
+                await self.db.executemany(
+                    "UPDATE history SET embedding = ?, embedding_model = ? WHERE user_id = ? AND model = ? AND turn = ? AND role = 'user'",
+                    [(embedding, embedding_model, user_id, model, turn) for turn, embedding in embeddings]
+                )
+                await self.db.execute("COMMIT")
+            except BaseException:
+                await self.db.execute("ROLLBACK")
+                raise
+
+    async def get_exchanges(self, user_id, model, embedding_model, turns):
+        """
+        Return (turn, message, response) for the embedded exchanges starting at the given user turns, oldest first.
+        """
+        placeholders = ', '.join('?' * len(turns))
+        async with self.db.execute(
+            f'''
+            SELECT question.turn, question.message, answer.message
+            FROM history AS question
+            JOIN history AS answer ON answer.user_id = question.user_id AND answer.model = question.model AND answer.turn = question.turn + 1
+            WHERE question.user_id = ? AND question.model = ? AND question.embedding_model = ? AND question.turn IN ({placeholders})
+            ORDER BY question.turn
+            ''',
+            (user_id, model, embedding_model, *turns)
+        ) as cursor:
+            return await cursor.fetchall()
+
+    async def model_demand(self, since):
+        """
+        Return (model, hour timestamp, messages) counts of user messages per model and hour since the given time.
+        """
+        async with self.db.execute(
+            "SELECT model, CAST(timestamp / 3600 AS INTEGER) * 3600, COUNT(*) FROM history WHERE role = 'user' AND timestamp > ? GROUP BY 1, 2",
+            (since,)
+        ) as cursor:
+            return await cursor.fetchall()
+
+    async def last_used_model(self, user_id):
+        """
+        Return the model the user talked to most recently, or None if they have no history.
+        """
+        model = self.cache.get_last_model(user_id)
+        if model is not MISSING:
+            return model
+        for key, _, _, _, _ in reversed(self.queue):
+            if key[0] == user_id:
+                return key[1]
+        async with self.db.execute("SELECT model FROM history WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT 1", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+        model = row[0] if row else None
+        if user_id not in self.cache.last_models:
+            self.cache.set_last_model(user_id, model)
+        return model
+
+    async def add_turn(self, user_id, model, message, response, guild_id=None):
+        """
+        Append a user message and the model's response to the conversation.
+        The rows are queued for the background writer; see durability for when this returns.
+        """
+        key = (user_id, model)
+        async with self.append_lock:
+            queued = self.queued_rows.get(key)
+            if queued:
+                last_turn = queued[-1][0]
+            else:
+                async with self.db.execute("SELECT COALESCE(MAX(turn), 0) FROM history WHERE user_id = ? AND model = ?", key) as cursor:
+                    last_turn = (await cursor.fetchone())[0]
+            rows = [
+                (last_turn + 1, "user", message, estimate_tokens(message)),
+                (last_turn + 2, "assistant", response, estimate_tokens(response))
+            ]
+            done = None if self.durability == 'deferred' else asyncio.get_running_loop().create_future()
+            self.queue.append((key, rows, time.time(), guild_id, done))
+            self.queued_rows.setdefault(key, []).extend(rows)
+
+            self.loading.pop(key, None)
+            cached = self.cache.conversations.get(key)
+            if cached is not None and cached.last_turn == last_turn:
+                self.cache.put(key, Conversation(cached.summary, cached.rows + rows))
+            else:
+                self.cache.discard(key)
+            self.cache.set_last_model(user_id, model)
+
+        if self.durability == 'immediate' or len(self.queue) >= self.batch_size:
+            self.full.set()
+        self.queued.set()
+        if done is not None:
+            await asyncio.shield(done)
+
+    async def delete_last_turn(self, user_id, model):
+        """
+        Remove the latest message and response from the conversation, used when regenerating.
+        """
+        await self.flush()
+        async with self.write_lock:
+            await self.db.execute(
+                "DELETE FROM history WHERE id IN (SELECT id FROM history WHERE user_id = ? AND model = ? ORDER BY turn DESC LIMIT 2)",
+                (user_id, model)
+            )
+            self.invalidate((user_id, model))
+            self.cache.last_models.pop(user_id, None)
+
+    async def clear(self, user_id, model=None):
+        """
+        Delete the user's history with one model, or with every model if none is given, archives and paginators included.
+        """
+        await self.flush()
+        async with self.write_lock:
+            if model:
+                await self.db.execute("DELETE FROM history WHERE user_id = ? AND model = ?", (user_id, model))
+                await self.db.execute("DELETE FROM summaries WHERE user_id = ? AND model = ?", (user_id, model))
+                await self.db.execute("DELETE FROM history_archive WHERE user_id = ? AND model = ?", (user_id, model))
+                await self.db.execute("DELETE FROM paginators WHERE user_id = ? AND model = ?", (user_id, model))
+                self.invalidate((user_id, model))
+                self.cache.last_models.pop(user_id, None)
+            else:
+                await self.db.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+                await self.db.execute("DELETE FROM summaries WHERE user_id = ?", (user_id,))
+                await self.db.execute("DELETE FROM history_archive WHERE user_id = ?", (user_id,))
+                await self.db.execute("DELETE FROM paginators WHERE user_id = ?", (user_id,))
+                for key in [key for key in self.loading if key[0] == user_id]:
+                    self.loading.pop(key)
+                self.cache.discard_user(user_id)
+
+    async def save_paginator(self, user_id, model, message, pages):
+        """
+        Store the pages (JSON) of a newly shown response and return the paginator's id.
+        """
+        now = time.time()
+        async with self.write_lock:
+            async with self.db.execute(
+                "INSERT INTO paginators (user_id, model, message, pages, created, used) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, model, message, pages, now, now)
+            ) as cursor:
+                return cursor.lastrowid
+
+    async def update_paginator(self, paginator_id, pages):
+        async with self.write_lock:
+            await self.db.execute("UPDATE paginators SET pages = ?, used = ? WHERE id = ?", (pages, time.time(), paginator_id))
+
+    async def touch_paginator(self, paginator_id, used):
+        async with self.write_lock:
+            await self.db.execute("UPDATE paginators SET used = ? WHERE id = ?", (used, paginator_id))
+
+    async def get_paginator(self, paginator_id):
+        """
+        Return (id, user_id, model, message, pages, used) for a paginator, or None if it doesn't exist or has expired.
+        """
+        since = time.time() - self.paginator_expiry if self.paginator_expiry is not None else 0
+        async with self.db.execute(
+            "SELECT id, user_id, model, message, pages, used FROM paginators WHERE id = ? AND used >= ?",
+            (paginator_id, since)
+        ) as cursor:
+            return await cursor.fetchone()
+
+    async def expire_paginators(self):
+        """
+        Delete paginators that haven't been used within paginator_expiry and return how many were deleted.
+        """
+        if self.paginator_expiry is None:
+            return 0
+        async with self.write_lock:
+            async with self.db.execute("DELETE FROM paginators WHERE used < ?", (time.time() - self.paginator_expiry,)) as cursor:
+                return cursor.rowcount
+
+    async def add_quota_usage(self, rows):
+        """
+        Add (scope, subject_id, period, prompt_tokens, tokens, requests) rows to the hourly usage totals in one transaction.
+        """
+        async with self.write_lock:
+            await self.db.execute("BEGIN")
+            try:
+                await self.db.executemany(
+                    """
+                    INSERT INTO quota_usage (scope, subject_id, period, prompt_tokens, tokens, requests) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (scope, subject_id, period) DO UPDATE SET
+                        prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                        tokens = tokens + excluded.tokens,
+                        requests = requests + excluded.requests
+                    """,
+                    rows
+                )
+                await self.db.execute("COMMIT")
+            except BaseException:
+                await self.db.execute("ROLLBACK")
+                raise
+
+    async def get_quota_usage(self, since, scope=None, subject_id=None):
+        """
+        Return the (scope, subject_id, period, prompt_tokens, tokens, requests) usage rows of the hours since a time,
+        for everyone or for one subject.
+        """
+        query = "SELECT scope, subject_id, period, prompt_tokens, tokens, requests FROM quota_usage WHERE period > ?"
+        params = (since - 3600,)
+        if scope is not None:
+            query += " AND scope = ? AND subject_id = ?"
+            params += (scope, subject_id)
+        async with self.db.execute(query, params) as cursor:
+            return await cursor.fetchall()
+
+    async def prune_quota_usage(self, before):
+        async with self.write_lock:
+            await self.db.execute("DELETE FROM quota_usage WHERE period < ?", (before,))
+
+    async def get_quota_limits(self):
+        """
+        Return the (scope, subject_id, window_name, tokens) limits set for particular users and guilds.
+        """
+        async with self.db.execute("SELECT scope, subject_id, window_name, tokens FROM quota_limits") as cursor:
+            return await cursor.fetchall()
+
+    async def set_quota_limit(self, scope, subject_id, window_name, tokens):
+        """
+        Set a user's or guild's token limit for a window, or go back to the default one if tokens is None.
+        """
+        async with self.write_lock:
+            if tokens is None:
+                await self.db.execute("DELETE FROM quota_limits WHERE scope = ? AND subject_id = ? AND window_name = ?", (scope, subject_id, window_name))
+            else:
+                await self.db.execute(
+                    "INSERT OR REPLACE INTO quota_limits (scope, subject_id, window_name, tokens) VALUES (?, ?, ?, ?)",
+                    (scope, subject_id, window_name, tokens)
+                )
+
+    async def conversation_stats(self):
+        """
+        Return (user_id, model, guild_id, rows, bytes, oldest timestamp, last turn) for every conversation,
+        with the guild it was last used from.
+        """
+        async with self.db.execute(
+            """
+            SELECT stats.user_id, stats.model, last.guild_id, stats.rows, stats.bytes, stats.oldest, stats.turn
+            FROM (
+                SELECT user_id, model, COUNT(*) AS rows, SUM(LENGTH(CAST(message AS BLOB))) AS bytes, MIN(timestamp) AS oldest, MAX(turn) AS turn
+                FROM history GROUP BY user_id, model
+            ) AS stats
+            JOIN history AS last ON last.user_id = stats.user_id AND last.model = stats.model AND last.turn = stats.turn
+            """
+        ) as cursor:
+            return await cursor.fetchall()
+
+    async def retention_cutoff(self, user_id, model, before=None, keep_rows=None, keep_bytes=None):
+        """
+        Return the last turn to archive so that no turn is older than before and at most keep_rows rows
+        and keep_bytes bytes of message text remain; 0 if nothing needs archiving. Cuts fall between
+        exchanges: the age and row limits round towards keeping, the byte limit towards archiving.
+        """
+        key = (user_id, model)
+        cutoff = 0
+        if before is not None:
+            async with self.db.execute("SELECT COALESCE(MAX(turn), 0) FROM history WHERE user_id = ? AND model = ? AND timestamp < ?", (*key, before)) as cursor:
+                turn = (await cursor.fetchone())[0]
+            cutoff = max(cutoff, turn - turn % 2)
+        if keep_rows is not None:
+            async with self.db.execute("SELECT turn FROM history WHERE user_id = ? AND model = ? ORDER BY turn DESC LIMIT 1 OFFSET ?", (*key, keep_rows)) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                cutoff = max(cutoff, row[0] - row[0] % 2)
+        if keep_bytes is not None:
+            async with self.db.execute(
+                """
+                SELECT turn FROM (
+                    SELECT turn, SUM(LENGTH(CAST(message AS BLOB))) OVER (ORDER BY turn DESC) AS kept
+                    FROM history WHERE user_id = ? AND model = ?
+                ) WHERE kept > ? ORDER BY turn DESC LIMIT 1
+                """,
+                (*key, keep_bytes)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                cutoff = max(cutoff, row[0] + row[0] % 2)
+        return cutoff
+
+    async def archive_turns(self, user_id, model, through_turn):
+        """
+        Move a conversation's turns up to through_turn into a zlib-compressed JSON record in
+        history_archive. Returns the number of rows archived.
+        """
+        key = (user_id, model)
+        await self.flush()
+        async with self.write_lock:
+            async with self.db.execute(
+                "SELECT turn, role, message, timestamp, guild_id FROM history WHERE user_id = ? AND model = ? AND turn <= ? ORDER BY turn",
+                (*key, through_turn)
+            ) as cursor:
+                rows = await cursor.fetchall()
+            if not rows:
+                return 0
+            data = zlib.compress(json.dumps([row[:4] for row in rows], ensure_ascii=False).encode('utf-8'))
+            await self.db.execute("BEGIN")
+            try:
+                await self.db.execute(
+                    "INSERT INTO history_archive (user_id, model, guild_id, first_turn, last_turn, turns, archived, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (*key, rows[-1][4], rows[0][0], rows[-1][0], len(rows), time.time(), data)
+                )
+                await self.db.execute("DELETE FROM history WHERE user_id = ? AND model = ? AND turn <= ?", (*key, through_turn))
+                # Once nothing is left the conversation starts over from turn 1, so its summary must go too.
+                await self.db.execute(
+                    "DELETE FROM summaries WHERE user_id = ? AND model = ? AND NOT EXISTS (SELECT 1 FROM history WHERE user_id = ? AND model = ?)",
+                    (*key, *key)
+                )
+                await self.db.execute("COMMIT")
+            except BaseException:
+                await self.db.execute("ROLLBACK")
+                raise
+            finally:
+                self.invalidate(key)
+            return len(rows)
+
+    async def get_archive(self, user_id, model=None):
+        """
+        Return the archived (turn, role, message, timestamp) rows of a user's conversations as (model, rows) pairs.
+        """
+        query = "SELECT model, data FROM history_archive WHERE user_id = ?"
+        params = (user_id,)
+        if model:
+            query += " AND model = ?"
+            params += (model,)
+        async with self.db.execute(query + " ORDER BY model, first_turn", params) as cursor:
+            return [(model, json.loads(zlib.decompress(data))) for model, data in await cursor.fetchall()]
+
+    async def export_turns(self, user_id=None, model=None, batch_size=1000):
+        """
+        Yield the history as ('turns', rows) with lists of up to batch_size (user_id, model, guild_id, turn, role,
+        message, timestamp) rows, by conversation and turn, then as ('archives', rows) with lists of (user_id, model,
+        guild_id, first_turn, last_turn, archived, data) archive records. Reads through its own read-only connection in
+        one transaction, so the export is one consistent snapshot and doesn't hold up writes however long the consumer takes.
+        """
+        await self.flush()
+        conditions, params = [], ()
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            params += (user_id,)
+        if model:
+            conditions.append("model = ?")
+            params += (model,)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        queries = (
+            ('turns', f"SELECT user_id, model, guild_id, turn, role, message, timestamp FROM history{where} ORDER BY user_id, model, turn"),
+            ('archives', f"SELECT user_id, model, guild_id, first_turn, last_turn, archived, data FROM history_archive{where} ORDER BY user_id, model, first_turn")
+        )
+        uri = f"file:{pathname2url(os.path.abspath(self.path))}?mode=ro"
+        async with aiosqlite.connect(uri, uri=True) as db:
+            await db.execute("BEGIN")
+            for kind, query in queries:
+                async with db.execute(query, params) as cursor:
+                    while rows := await cursor.fetchmany(batch_size):
+                        yield kind, rows
+
+    async def import_turns(self, rows):
+        """
+        Insert exported (user_id, model, guild_id, turn, role, message, timestamp) rows in one transaction.
+        Turns a conversation already has with the same role and message are skipped, so importing the same
+        file twice is harmless, and new turns are only added where they carry on from its last turn. A
+        conversation that already has different turns here would get the two mixed up, so none of its
+        rows are inserted. Returns (rows inserted, the (user_id, model) of such conflicting conversations).
+        """
+        conversations = {}
+        for row in rows:
+            conversations.setdefault((row[0], row[1]), []).append(row)
+        async with self.append_lock:
+            await self.flush()
+            async with self.write_lock:
+                inserts, conflicts = [], set()
+                for key, turns in conversations.items():
+                    turns.sort(key=lambda row: row[3])
+                    async with self.db.execute(
+                        "SELECT turn, role, message FROM history WHERE user_id = ? AND model = ? AND turn BETWEEN ? AND ?",
+                        (*key, turns[0][3], turns[-1][3])
+                    ) as cursor:
+                        existing = {turn: (role, message) for turn, role, message in await cursor.fetchall()}
+                    async with self.db.execute("SELECT COALESCE(MAX(turn), 0) FROM history WHERE user_id = ? AND model = ?", key) as cursor:
+                        last = (await cursor.fetchone())[0]
+                    # Turns at or before the last one that aren't here were archived or deleted here; leave them out.
+                    new = [row for row in turns if row[3] > last]
+                    if any(existing[row[3]] != (row[4], row[5]) for row in turns if row[3] in existing) or (last and new and new[0][3] != last + 1):
+                        conflicts.add(key)
+                    else:
+                        inserts.extend(new)
+                before = self.db.total_changes
+                await self.db.execute("BEGIN")
+                try:
+                    # OR IGNORE for a file that has the same turn twice.
+                    await self.db.executemany(
+                        "INSERT OR IGNORE INTO history (user_id, model, guild_id, turn, role, message, timestamp, tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(*row, estimate_tokens(row[5])) for row in inserts]
+                    )
+                    await self.db.execute("COMMIT")
+                except BaseException:
+                    await self.db.execute("ROLLBACK")
+                    raise
+                finally:
+                    for key in conversations:
+                        self.invalidate(key)
+                        self.cache.last_models.pop(key[0], None)
+                return self.db.total_changes - before, conflicts
+
+    async def import_archives(self, rows):
+        """
+        Insert exported (user_id, model, guild_id, first_turn, last_turn, archived, data) archive records in one
+        transaction, skipping those already here. Returns the number of archived turns inserted.
+        """
+        inserted = 0
+        async with self.write_lock:
+            await self.db.execute("BEGIN")
+            try:
+                for user_id, model, guild_id, first_turn, last_turn, archived, data in rows:
+                    turns = len(json.loads(zlib.decompress(data)))
+                    cursor = await self.db.execute(
+                        """
+                        INSERT INTO history_archive (user_id, model, guild_id, first_turn, last_turn, turns, archived, data)
+                        SELECT ?, ?, ?, ?, ?, ?, ?, ?
+                        WHERE NOT EXISTS (SELECT 1 FROM history_archive WHERE user_id = ? AND model = ? AND first_turn = ? AND archived = ?)
+                        """,
+                        (user_id, model, guild_id, first_turn, last_turn, turns, archived, data, user_id, model, first_turn, archived)
+                    )
+                    if cursor.rowcount:
+                        inserted += turns
+                await self.db.execute("COMMIT")
+            except BaseException:
+                await self.db.execute("ROLLBACK")
+                raise
+        return inserted
+
+    async def size_report(self):
+        """
+        Return sizes of the database: file, free (reclaimable) pages, WAL, rows and bytes per table,
+        and per-table page usage where SQLite was built with the dbstat table.
+        """
+        async def scalar(query):
+            async with self.db.execute(query) as cursor:
+                return (await cursor.fetchone())[0]
+
+        page_size = await scalar("PRAGMA page_size")
+        report = {
+            'file_bytes': await scalar("PRAGMA page_count") * page_size,
+            'free_bytes': await scalar("PRAGMA freelist_count") * page_size,
+            'auto_vacuum': {0: 'none', 1: 'full', 2: 'incremental'}.get(await scalar("PRAGMA auto_vacuum")),
+            'wal_bytes': os.path.getsize(self.path + '-wal') if os.path.exists(self.path + '-wal') else 0
+        }
+        async with self.db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(message AS BLOB))), 0) FROM history") as cursor:
+            report['history_rows'], report['history_text_bytes'] = await cursor.fetchone()
+        async with self.db.execute("SELECT COUNT(*), COALESCE(SUM(turns), 0), COALESCE(SUM(LENGTH(data)), 0) FROM history_archive") as cursor:
+            report['archives'], report['archived_rows'], report['archive_bytes'] = await cursor.fetchone()
+        try:
+            async with self.db.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY 2 DESC") as cursor:
+                report['tables'] = dict(await cursor.fetchall())
+        except aiosqlite.OperationalError:
+            report['tables'] = None
+        return report
+
+    async def optimize(self, vacuum_pages=None, full_vacuum=False):
+        """
+        Return free pages to the file system and refresh the query planner's statistics.
+        An incremental vacuum frees up to vacuum_pages pages (all if None) and only works once the
+        database uses incremental auto-vacuum; full_vacuum switches it over with a one-off VACUUM,
+        which rewrites the whole file and blocks writes while it runs.
+        """
+        await self.flush()
+        async with self.write_lock:
+            async with self.db.execute("PRAGMA auto_vacuum") as cursor:
+                auto_vacuum = (await cursor.fetchone())[0]
+            if auto_vacuum != 2 and full_vacuum:
+                logger.info("Switching history database to incremental auto-vacuum, rewriting the file")
+                await self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                await self.db.execute("VACUUM")
+            elif auto_vacuum == 2:
+                pragma = "PRAGMA incremental_vacuum" if vacuum_pages is None else f"PRAGMA incremental_vacuum({int(vacuum_pages)})"
+                async with self.db.execute(pragma) as cursor:
+                    await cursor.fetchall()
+            await self.db.execute("ANALYZE")
+            async with self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cursor:
+                await cursor.fetchall()
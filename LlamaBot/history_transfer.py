@@ -0,0 +1,179 @@
+"""
+Export and import conversation history as JSON lines, one turn per line, optionally gzip-compressed:
+
+    {"user_id": 1234, "model": "llama3", "guild_id": 5678, "turn": 1, "role": "user", "message": "Hi", "timestamp": 1700000000.0}
+
+followed by the archived history (see HistoryStore.archive_turns), one archive per line with its turns:
+
+    {"user_id": 1234, "model": "llama3", "guild_id": 5678, "first_turn": 1, "last_turn": 2, "archived": 1700000000.0,
+     "turns": [[1, "user", "Hi", 1690000000.0], [2, "assistant", "Hello!", 1690000001.0]]}
+
+Rows stream between the database and the file in batches, so memory use doesn't grow with the
+size of the history. Used by /export_history and /import_history, and from the command line:
+
+    python history_transfer.py export backup.jsonl.gz
+    python history_transfer.py import backup.jsonl.gz
+
+Importing from the command line while the bot is running works, but the bot won't see imported
+turns of conversations it has cached until they are evicted; use /import_history instead.
+
+Imported turns are only added to a conversation that already exists when they carry on from
+its last turn and the turns both have match; conversations that differ are left out whole.
+"""
+import argparse
+import asyncio
+import gzip
+import itertools
+import json
+import logging
+import time
+import zlib
+
+from history_store import HistoryStore
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('user_id', 'model', 'guild_id', 'turn', 'role', 'message', 'timestamp')
+ARCHIVE_FIELDS = ('user_id', 'model', 'guild_id', 'first_turn', 'last_turn', 'archived')
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def encode_rows(rows):
+    return ''.join(json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False) + '\n' for row in rows).encode('utf-8')
+
+
+def encode_archives(rows):
+    return ''.join(
+        json.dumps({**dict(zip(ARCHIVE_FIELDS, row[:6])), 'turns': json.loads(zlib.decompress(row[6]))}, ensure_ascii=False) + '\n'
+        for row in rows
+    ).encode('utf-8')
+
+
+def write_rows(file, kind, rows):
+    file.write(encode_rows(rows) if kind == 'turns' else encode_archives(rows))
+
+
+def decode_line(line, number):
+    """
+    Turn one line of an export back into ('turn', row) or ('archive', row).
+    Raises ValueError naming the line if it isn't a valid turn or archive.
+    """
+    try:
+        record = json.loads(line)
+        if 'archived' in record:
+            turns = [(int(turn), role, str(message), float(timestamp)) for turn, role, message, timestamp in record['turns']]
+            if not turns or any(role not in ('user', 'assistant') for _, role, _, _ in turns):
+                raise ValueError("bad turns")
+            data = zlib.compress(json.dumps(turns, ensure_ascii=False).encode('utf-8'))
+            return 'archive', (int(record['user_id']), str(record['model']), record.get('guild_id'), int(record['first_turn']),
+                               int(record['last_turn']), float(record['archived']), data)
+        row = (int(record['user_id']), str(record['model']), record.get('guild_id'), int(record['turn']),
+               record['role'], str(record['message']), float(record['timestamp']))
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Line {number} is not a valid history turn: {str(e)}") from None
+    if row[4] not in ('user', 'assistant') or row[3] < 1:
+        raise ValueError(f"Line {number} is not a valid history turn")
+    return 'turn', row
+
+
+def read_batch(file, batch_size, first_line):
+    """
+    Read and decode up to batch_size lines. Returns (turn rows, archive rows, lines read); blank lines are skipped.
+    """
+    lines = list(itertools.islice(file, batch_size))
+    rows, archives = [], []
+    for number, line in enumerate(lines, start=first_line):
+        if line.strip():
+            kind, row = decode_line(line, number)
+            (rows if kind == 'turn' else archives).append(row)
+    return rows, archives, len(lines)
+
+
+def open_for_reading(path):
+    """
+    Open an export for reading, decompressing it if it starts with the gzip magic number.
+    """
+    with open(path, 'rb') as file:
+        compressed = file.read(2) == GZIP_MAGIC
+    return gzip.open(path, 'rb') if compressed else open(path, 'rb')
+
+
+async def export_history(history, path, user_id=None, model=None, compress=False, batch_size=1000):
+    """
+    Write the history (one user's, or one model's with them, if given) to a file, archived history included.
+    Returns the number of turns written. Encoding and compression run in a thread so a large export doesn't
+    stall the event loop.
+    """
+    count = 0
+    with (gzip.open(path, 'wb', compresslevel=6) if compress else open(path, 'wb')) as file:
+        async for kind, rows in history.export_turns(user_id, model, batch_size):
+            await asyncio.to_thread(write_rows, file, kind, rows)
+            count += len(rows) if kind == 'turns' else sum(row[4] - row[3] + 1 for row in rows)
+    return count
+
+
+async def import_history(history, path, owns=None, batch_size=5000):
+    """
+    Load an export into the history, one transaction per batch_size lines, skipping turns and archives that already
+    exist (see HistoryStore.import_turns). With owns, only the history of users for which owns(user_id) is true is
+    loaded. Returns (turns read, turns inserted, conversations left out because they differ from the ones here).
+    A bad line stops the import with a ValueError; the batches before it stay imported and running the import
+    again once the file is fixed only adds what is missing.
+    """
+    read = inserted = 0
+    conflicts = set()
+    line = 1
+    with open_for_reading(path) as file:
+        while True:
+            rows, archives, lines = await asyncio.to_thread(read_batch, file, batch_size, line)
+            if not lines:
+                break
+            line += lines
+            if owns is not None:
+                rows = [row for row in rows if owns(row[0])]
+                archives = [row for row in archives if owns(row[0])]
+            # A conversation found to conflict stays out, even where a later batch would happen to carry on from it.
+            rows = [row for row in rows if (row[0], row[1]) not in conflicts]
+            if rows:
+                read += len(rows)
+                count, found = await history.import_turns(rows)
+                inserted += count
+                conflicts |= found
+            if archives:
+                read += sum(row[4] - row[3] + 1 for row in archives)
+                inserted += await history.import_archives(archives)
+    if conflicts:
+        logger.warning(f"Left out {len(conflicts)} conversations that already exist with different turns")
+    return read, inserted, len(conflicts)
+
+
+async def main(args):
+    history = HistoryStore(args.db)
+    await history.open()
+    started = time.perf_counter()
+    try:
+        if args.command == 'export':
+            compress = args.gzip or args.path.endswith('.gz')
+            count = await export_history(history, args.path, args.user, args.model, compress)
+            logger.info(f"Exported {count} turns to {args.path} in {time.perf_counter() - started:.1f}s")
+        else:
+            read, inserted, conflicts = await import_history(history, args.path, batch_size=args.batch_size)
+            logger.info(f"Imported {inserted} of {read} turns from {args.path} in {time.perf_counter() - started:.1f}s ({read - inserted} already present or conflicting, {conflicts} conversations left out)")
+    finally:
+        await history.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export or import the bot's conversation history as JSON lines.")
+    parser.add_argument('--db', default='conversation_history.db', help="history database (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help="write history to a file")
+    export_parser.add_argument('path', help="output file; compressed with gzip if it ends in .gz")
+    export_parser.add_argument('--user', type=int, help="only this user's history")
+    export_parser.add_argument('--model', help="only history with this model")
+    export_parser.add_argument('--gzip', action='store_true', help="compress the output whatever its name")
+    import_parser = subparsers.add_parser('import', help="load history from a file, plain or gzip-compressed")
+    import_parser.add_argument('path', help="file written by export")
+    import_parser.add_argument('--batch-size', type=int, default=5000, help="turns per transaction (default: %(default)s)")
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(main(parser.parse_args()))
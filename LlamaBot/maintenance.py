@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+NO_LIMITS = {'max_age_days': None, 'max_turns': None, 'max_bytes': None}
+
+
+class HistoryMaintenance:
+    """
+    Background upkeep of the history database.
+
+    Every interval seconds, conversations that exceed their retention policy have their oldest
+    exchanges moved into compressed archives. Policies limit the age of turns, the number of turns
+    and the bytes of message text kept per conversation; retention looks one up by guild first,
+    then by model, then falls back to 'default':
+
+        {'default': {'max_age_days': 90}, 'models': {'llama3': {'max_turns': 500}}, 'guilds': {1234: {'max_bytes': 1000000}}}
+
+    Paginators that have expired are deleted on the same schedule. Once a day, during one of the
+    off_peak_hours (local time), freed pages are returned to the file system with an incremental
+    vacuum and the query planner statistics are refreshed.
+
+    With several worker processes sharing the database, each applies retention to the users it
+    owns (owns(user_id) is true) and only the primary one expires paginators and vacuums.
+    """
+    def __init__(self, history, retention=None, interval=3600, off_peak_hours=(3, 4, 5), vacuum_pages=2000, full_vacuum=False, owns=None, primary=True):
+        self.history = history
+        self.retention = retention or {}
+        self.interval = interval
+        self.off_peak_hours = set(off_peak_hours)
+        self.vacuum_pages = vacuum_pages
+        self.full_vacuum = full_vacuum
+        self.owns = owns or (lambda user_id: True)
+        self.primary = primary
+        self.last_optimized = None
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run_loop())
+
+    async def run_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.apply_retention()
+                if not self.primary:
+                    continue
+                await self.expire_paginators()
+                today = datetime.now().date()
+                if datetime.now().hour in self.off_peak_hours and self.last_optimized != today:
+                    await self.optimize()
+                    self.last_optimized = today
+            except (aiosqlite.Error, ValueError) as e:
+                logger.warning(f"History maintenance failed: {str(e)}")
+            except Exception as e:
+                logger.exception(f"Unexpected error in history maintenance: {str(e)}")
+
+    def policy_for(self, model, guild_id):
+        guild_policy = self.retention.get('guilds', {}).get(guild_id)
+        if guild_policy is not None:
+            return {**NO_LIMITS, **guild_policy}
+        model_policy = self.retention.get('models', {}).get(model)
+        if model_policy is not None:
+            return {**NO_LIMITS, **model_policy}
+        return {**NO_LIMITS, **self.retention.get('default', {})}
+
+    async def apply_retention(self):
+        """
+        Archive whatever falls outside each conversation's policy. Returns (conversations, rows) archived.
+        """
+        now = time.time()
+        conversations = archived = 0
+        for user_id, model, guild_id, rows, size, oldest, _ in await self.history.conversation_stats():
+            if not self.owns(user_id):
+                continue
+            policy = self.policy_for(model, guild_id)
+            before = now - policy['max_age_days'] * 86400 if policy['max_age_days'] is not None else None
+            over = (
+                (before is not None and oldest < before)
+                or (policy['max_turns'] is not None and rows > policy['max_turns'])
+                or (policy['max_bytes'] is not None and size > policy['max_bytes'])
+            )
+            if not over:
+                continue
+            cutoff = await self.history.retention_cutoff(user_id, model, before, policy['max_turns'], policy['max_bytes'])
+            if cutoff:
+                archived += await self.history.archive_turns(user_id, model, cutoff)
+                conversations += 1
+            # Give chat requests a turn at the database between conversations.
+            await asyncio.sleep(0)
+        if archived:
+            logger.info(f"Archived {archived} history rows from {conversations} conversations")
+        return conversations, archived
+
+    async def expire_paginators(self):
+        expired = await self.history.expire_paginators()
+        if expired:
+            logger.info(f"Deleted {expired} expired paginators")
+        return expired
+
+    async def optimize(self):
+        started = time.perf_counter()
+        before = await self.history.size_report()
+        await self.history.optimize(self.vacuum_pages, self.full_vacuum)
+        after = await self.history.size_report()
+        logger.info(
+            f"Optimized history database in {time.perf_counter() - started:.1f}s: "
+            f"{(before['file_bytes'] - after['file_bytes']) / 1024 / 1024:.1f} MiB released, "
+            f"{after['free_bytes'] / 1024 / 1024:.1f} MiB still free"
+        )
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+import aiohttp
+import numpy as np
+
+from history_store import estimate_tokens
+from ollama_client import OllamaError
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryIndex:
+    """
+    Long-term memory: finds the earlier exchanges of a conversation most relevant to a new message.
+
+    Each exchange (a user message and its reply) is embedded through Ollama's /api/embed in the
+    background and the normalized float32 vector is stored on its row in the history table.
+    A user's vectors with a model are loaded into one matrix, kept in an LRU cache bounded by
+    size, so a lookup is a single matrix-vector product plus a partial sort even at tens of
+    thousands of exchanges.
+    """
+    def __init__(self, history, client, model='nomic-embed-text', top_k=4, min_score=0.35, max_tokens=1024,
+                 cache_bytes=256 * 1024 * 1024, batch_size=32, max_chars=4000):
+        self.history = history
+        self.client = client
+        self.model = model
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_tokens = max_tokens
+        self.cache_bytes = cache_bytes
+        self.batch_size = batch_size
+        self.max_chars = max_chars
+        self.matrices = OrderedDict()
+        self.bytes = 0
+        self.pending = {}
+
+    async def embed(self, texts):
+        """
+        Return the unit-length embeddings of the texts as rows of a float32 matrix.
+        """
+        vectors = np.asarray(await self.client.embed(self.model, [text[:self.max_chars] for text in texts]), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    def store(self, key, turns, vectors):
+        self.discard_entry(key)
+        self.matrices[key] = (turns, vectors)
+        self.bytes += turns.nbytes + vectors.nbytes
+        while self.bytes > self.cache_bytes and len(self.matrices) > 1:
+            self.discard_entry(next(iter(self.matrices)))
+
+    def discard_entry(self, key):
+        entry = self.matrices.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[0].nbytes + entry[1].nbytes
+
+    async def get_matrix(self, user_id, model):
+        """
+        Return (turns, vectors) for the conversation's embedded exchanges, ordered by turn.
+        """
+        key = (user_id, model)
+        entry = self.matrices.get(key)
+        if entry is not None:
+            self.matrices.move_to_end(key)
+            return entry
+        rows = await self.history.get_embeddings(user_id, model, self.model)
+        turns = np.fromiter((turn for turn, _ in rows), dtype=np.int64, count=len(rows))
+        if rows:
+            vectors = np.frombuffer(b''.join(embedding for _, embedding in rows), dtype=np.float32).reshape(len(rows), -1)
+        else:
+            vectors = np.empty((0, 0), dtype=np.float32)
+        self.store(key, turns, vectors)
+        return turns, vectors
+
+    async def recall(self, user_id, model, message, before_turn):
+        """
+        Return (turn, message, response) for up to top_k exchanges before before_turn that are
+        most similar to the message, oldest first and within max_tokens. Returns nothing if
+        embedding fails, so memory never holds up a chat request.
+        """
+        try:
+            turns, vectors = await self.get_matrix(user_id, model)
+            count = int(np.searchsorted(turns, before_turn))
+            if count == 0:
+                return []
+            query = (await self.embed([message]))[0]
+            if query.shape[0] != vectors.shape[1]:
+                logger.warning(f"Embedding size of '{self.model}' changed; ignoring stored memories")
+                return []
+            scores = vectors[:count] @ query
+            k = min(self.top_k, count)
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[scores[best] >= self.min_score]
+            best = best[np.argsort(-scores[best])]
+            if not len(best):
+                return []
+
+            chosen = turns[best].tolist()
+            exchanges = {row[0]: row for row in await self.history.get_exchanges(user_id, model, self.model, chosen)}
+            selected = []
+            used = 0
+            for turn in chosen:
+                exchange = exchanges.get(turn)
+                if exchange is None:
+                    continue
+                tokens = estimate_tokens(exchange[1]) + estimate_tokens(exchange[2])
+                if used + tokens <= self.max_tokens:
+                    selected.append(exchange)
+                    used += tokens
+            return sorted(selected)
+        except (OllamaError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Failed to recall memories for user {user_id} with '{model}': {str(e)}")
+            return []
+
+    def schedule_index(self, user_id, model):
+        """
+        Embed the conversation's new exchanges in the background, at most once at a time per conversation.
+        """
+        key = (user_id, model)
+        if key in self.pending:
+            return
+        task = asyncio.create_task(self.index(user_id, model))
+        self.pending[key] = task
+        task.add_done_callback(lambda _: self.pending.pop(key, None))
+
+    async def index(self, user_id, model):
+        key = (user_id, model)
+        try:
+            while True:
+                rows = await self.history.get_unembedded(user_id, model, self.model, self.batch_size)
+                if not rows:
+                    return
+                vectors = await self.embed([f"{message}\n{response}" for _, message, response in rows])
+                await self.history.save_embeddings(user_id, model, self.model, [(row[0], vector.tobytes()) for row, vector in zip(rows, vectors)])
+                self.append(key, np.array([row[0] for row in rows], dtype=np.int64), vectors)
+                if len(rows) < self.batch_size:
+                    return
+        except (OllamaError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Failed to embed history of user {user_id} with '{model}': {str(e)}")
+        except Exception as e:
+            logger.exception(f"Unexpected error embedding history: {str(e)}")
+
+    def append(self, key, turns, vectors):
+        """
+        Add newly embedded exchanges to a cached matrix. If they don't follow on from it, the
+        history was rewritten underneath; drop the matrix so it is reloaded.
+        """
+        entry = self.matrices.get(key)
+        if entry is None:
+            return
+        cached_turns, cached_vectors = entry
+        if len(cached_turns) and (turns[0] <= cached_turns[-1] or vectors.shape[1] != cached_vectors.shape[1]):
+            self.discard_entry(key)
+            return
+        self.store(key, np.concatenate((cached_turns, turns)), np.vstack((cached_vectors.reshape(-1, vectors.shape[1]), vectors)))
+
+    def discard(self, user_id, model=None):
+        """
+        Forget cached matrices and cancel indexing for a user's conversation with one model, or with every model.
+        """
+        for key in [key for key in self.matrices if key[0] == user_id and model in (None, key[1])]:
+            self.discard_entry(key)
+        for (pending_user, pending_model), task in list(self.pending.items()):
+            if pending_user == user_id and model in (None, pending_model):
+                task.cancel()
+
+    async def close(self):
+        for task in list(self.pending.values()):
+            task.cancel()
+        await asyncio.gather(*self.pending.values(), return_exceptions=True)
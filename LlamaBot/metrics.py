@@ -0,0 +1,272 @@
+import logging
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the Prometheus histogram buckets.
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """
+    Observations of one value: a rolling window of recent samples for percentiles, plus
+    cumulative bucket counts, count and sum since startup for Prometheus.
+    """
+    def __init__(self, window=1000, buckets=STAGE_BUCKETS):
+        self.samples = deque(maxlen=window)
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.bucket_counts[index] += 1
+
+    def state(self):
+        return {'samples': list(self.samples), 'bucket_counts': self.bucket_counts, 'count': self.count, 'sum': self.sum}
+
+    def absorb(self, state):
+        """
+        Add the observations of another histogram, given by its state().
+        """
+        self.samples.extend(state['samples'])
+        self.bucket_counts = [a + b for a, b in zip(self.bucket_counts, state['bucket_counts'])]
+        self.count += state['count']
+        self.sum += state['sum']
+
+    def quantiles(self, quantiles=QUANTILES):
+        if not self.samples:
+            return [0.0 for _ in quantiles]
+        ordered = sorted(self.samples)
+        return [ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in quantiles]
+
+
+class ModelStats:
+    """
+    Generation counters for one model, from the metrics Ollama returns with each response.
+    """
+    COUNTERS = ('requests', 'cold_loads', 'prompt_tokens', 'generated_tokens')
+    HISTOGRAMS = ('tokens_per_second', 'prompt_tokens_per_second', 'cold_load_seconds')
+
+    def __init__(self, window):
+        self.requests = 0
+        self.cold_loads = 0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self.tokens_per_second = Histogram(window)
+        self.prompt_tokens_per_second = Histogram(window)
+        self.cold_load_seconds = Histogram(window)
+
+
+class Metrics:
+    """
+    Per-stage timings of requests and per-model generation statistics.
+
+    Code wraps each stage of a request in span(stage); the time spent goes into a rolling
+    histogram for that stage. record_generation() takes the eval_count, eval_duration,
+    prompt_eval_count and load_duration fields of an Ollama chat response and turns them into
+    tokens per second and cold-load counts per model. A load taking longer than
+    cold_load_threshold seconds counts as a cold load.
+
+    state() exports everything as plain data and merged() combines such states, so the metrics
+    of several worker processes can be shown together.
+    """
+    def __init__(self, window=1000, cold_load_threshold=0.5):
+        self.window = window
+        self.cold_load_threshold = cold_load_threshold
+        self.stages = {}
+        self.models = {}
+        self.started = time.time()
+
+    def observe(self, stage, seconds):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram(self.window)
+        histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def record_generation(self, model, data):
+        """
+        Record the metrics of a finished Ollama chat response (or the final chunk of a stream).
+        Durations from Ollama are in nanoseconds.
+        """
+        stats = self.model_stats(model)
+        stats.requests += 1
+
+        eval_count = data.get('eval_count') or 0
+        eval_duration = (data.get('eval_duration') or 0) / 1e9
+        prompt_count = data.get('prompt_eval_count') or 0
+        prompt_duration = (data.get('prompt_eval_duration') or 0) / 1e9
+        load_duration = (data.get('load_duration') or 0) / 1e9
+
+        stats.generated_tokens += eval_count
+        stats.prompt_tokens += prompt_count
+        if eval_count and eval_duration:
+            stats.tokens_per_second.observe(eval_count / eval_duration)
+            self.observe('generation', eval_duration)
+        if prompt_count and prompt_duration:
+            stats.prompt_tokens_per_second.observe(prompt_count / prompt_duration)
+            self.observe('prompt_eval', prompt_duration)
+        if load_duration > self.cold_load_threshold:
+            stats.cold_loads += 1
+            stats.cold_load_seconds.observe(load_duration)
+
+    def model_stats(self, model):
+        stats = self.models.get(model)
+        if stats is None:
+            stats = self.models[model] = ModelStats(self.window)
+        return stats
+
+    def state(self):
+        return {
+            'started': self.started,
+            'stages': {stage: histogram.state() for stage, histogram in self.stages.items()},
+            'models': {
+                model: {name: getattr(stats, name) for name in ModelStats.COUNTERS} | {name: getattr(stats, name).state() for name in ModelStats.HISTOGRAMS}
+                for model, stats in self.models.items()
+            }
+        }
+
+    @classmethod
+    def merged(cls, states, window=1000, cold_load_threshold=0.5):
+        """
+        Return a Metrics holding the observations of all the given states. Percentiles come from
+        the recent samples of all of them together.
+        """
+        metrics = cls(window * max(len(states), 1), cold_load_threshold)
+        for state in states:
+            metrics.started = min(metrics.started, state['started'])
+            for stage, histogram in state['stages'].items():
+                if stage not in metrics.stages:
+                    metrics.stages[stage] = Histogram(metrics.window)
+                metrics.stages[stage].absorb(histogram)
+            for model, data in state['models'].items():
+                stats = metrics.model_stats(model)
+                for name in ModelStats.COUNTERS:
+                    setattr(stats, name, getattr(stats, name) + data[name])
+                for name in ModelStats.HISTOGRAMS:
+                    getattr(stats, name).absorb(data[name])
+        return metrics
+
+    def snapshot(self):
+        """
+        Return a plain summary for display: per-stage percentiles and per-model statistics.
+        """
+        stages = {}
+        for stage, histogram in self.stages.items():
+            p50, p95, p99 = histogram.quantiles()
+            stages[stage] = {'count': histogram.count, 'p50': p50, 'p95': p95, 'p99': p99}
+        models = {}
+        for model, stats in self.models.items():
+            models[model] = {
+                'requests': stats.requests,
+                'cold_loads': stats.cold_loads,
+                'prompt_tokens': stats.prompt_tokens,
+                'generated_tokens': stats.generated_tokens,
+                'tokens_per_second': stats.tokens_per_second.quantiles((0.5,))[0],
+                'prompt_tokens_per_second': stats.prompt_tokens_per_second.quantiles((0.5,))[0],
+                'cold_load_seconds': stats.cold_load_seconds.quantiles((0.5,))[0]
+            }
+        return {'uptime': time.time() - self.started, 'stages': stages, 'models': models}
+
+    def prometheus(self):
+        """
+        Render the metrics in the Prometheus text exposition format.
+        """
+        lines = [
+            '# HELP llamabot_stage_seconds Time spent in each stage of handling a request.',
+            '# TYPE llamabot_stage_seconds histogram'
+        ]
+        for stage, histogram in sorted(self.stages.items()):
+            label = f'stage="{escape_label(stage)}"'
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                cumulative += count
+                lines.append(f'llamabot_stage_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'llamabot_stage_seconds_bucket{{{label},le="+Inf"}} {histogram.count}')
+            lines.append(f'llamabot_stage_seconds_sum{{{label}}} {histogram.sum}')
+            lines.append(f'llamabot_stage_seconds_count{{{label}}} {histogram.count}')
+
+        counters = (
+            ('llamabot_generations_total', 'Chat responses generated.', 'requests'),
+            ('llamabot_cold_loads_total', 'Responses that had to load the model first.', 'cold_loads'),
+            ('llamabot_prompt_tokens_total', 'Prompt tokens evaluated.', 'prompt_tokens'),
+            ('llamabot_generated_tokens_total', 'Tokens generated.', 'generated_tokens')
+        )
+        for name, help_text, attribute in counters:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for model, stats in sorted(self.models.items()):
+                lines.append(f'{name}{{model="{escape_label(model)}"}} {getattr(stats, attribute)}')
+
+        lines.append('# HELP llamabot_cold_load_seconds Time spent loading a model before responding.')
+        lines.append('# TYPE llamabot_cold_load_seconds summary')
+        for model, stats in sorted(self.models.items()):
+            label = f'model="{escape_label(model)}"'
+            for q, value in zip(QUANTILES, stats.cold_load_seconds.quantiles()):
+                lines.append(f'llamabot_cold_load_seconds{{{label},quantile="{q}"}} {value}')
+            lines.append(f'llamabot_cold_load_seconds_sum{{{label}}} {stats.cold_load_seconds.sum}')
+            lines.append(f'llamabot_cold_load_seconds_count{{{label}}} {stats.cold_load_seconds.count}')
+
+        lines.append('# HELP llamabot_tokens_per_second Generation speed over recent responses.')
+        lines.append('# TYPE llamabot_tokens_per_second summary')
+        for model, stats in sorted(self.models.items()):
+            label = f'model="{escape_label(model)}"'
+            for q, value in zip(QUANTILES, stats.tokens_per_second.quantiles()):
+                lines.append(f'llamabot_tokens_per_second{{{label},quantile="{q}"}} {value}')
+            lines.append(f'llamabot_tokens_per_second_sum{{{label}}} {stats.tokens_per_second.sum}')
+            lines.append(f'llamabot_tokens_per_second_count{{{label}}} {stats.tokens_per_second.count}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """
+    Serves Metrics.prometheus() at /metrics over HTTP for a Prometheus scraper.
+    When collect is given it is awaited for the Metrics to serve on each scrape instead.
+    """
+    def __init__(self, metrics, host='127.0.0.1', port=9090, collect=None):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.collect = collect
+        self.runner = None
+
+    async def start(self):
+        # aiohttp's server side is only imported when metrics are served.
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def handle(self, request):
+        metrics = await self.collect() if self.collect is not None else self.metrics
+        from aiohttp import web
+        return web.Response(text=metrics.prometheus(), content_type='text/plain', charset='utf-8')
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,146 @@
+import logging
+import os
+import re
+from bisect import bisect_left
+from collections import OrderedDict, deque
+
+import aiofiles
+
+logger = logging.getLogger(__name__)
+
+# Discord accepts at most 25 autocomplete choices.
+MAX_CHOICES = 25
+MAX_CACHED_QUERIES = 256
+WORD_SEPARATORS = re.compile(r'[-_:/.]')
+
+
+class ModelCatalogue:
+    """
+    The list of models available across the Ollama servers, with a precomputed search index
+    for autocomplete.
+
+    The backend pool's health check feeds it fresh model lists on a timer. Names are lowercased
+    once when the list changes; lookups use a sorted index for prefix matches and rank results:
+    name prefix first, then word prefix ("mis" finds "dolphin-mistral"), then plain substring,
+    with the user's recently used models ahead of the rest in each group. Matches per query are
+    memoized until the list changes, since autocomplete sends the same prefixes over and over.
+    """
+    def __init__(self, pool, path='available_models.txt', recent_per_user=5, max_users=10000):
+        self.pool = pool
+        self.path = path
+        self.recent_per_user = recent_per_user
+        self.max_users = max_users
+        self.recent = OrderedDict()
+        self.saved = None
+        self.models = []
+        self.index = []
+        self.words = {}
+        self.matches = OrderedDict()
+
+    async def load(self):
+        """
+        Read the last saved list, so the bot has models to offer before the first refresh
+        and an unchanged list isn't written back.
+        """
+        if not os.path.exists(self.path):
+            return
+        async with aiofiles.open(self.path) as file:
+            self.saved = await file.read()
+        self.update_index([line for line in self.saved.splitlines() if line])
+
+    async def refresh(self):
+        """
+        Fetch the models from the Ollama servers now. Errors are raised to the caller.
+        """
+        await self.update(await self.pool.refresh())
+
+    async def update(self, models):
+        """
+        Replace the catalogue with a fresh model list, rebuilding the index and saving only if it changed.
+        """
+        if models and sorted(set(models)) != self.models:
+            self.update_index(models)
+            await self.save()
+
+    def update_index(self, models):
+        self.models = sorted(set(models))
+        self.index = sorted((model.lower(), model) for model in self.models)
+        self.words = {model: [word for word in WORD_SEPARATORS.split(lowered) if word] for lowered, model in self.index}
+        self.matches.clear()
+
+    async def add(self, model):
+        if model not in self.models:
+            self.update_index(self.models + [model])
+            await self.save()
+
+    async def remove(self, model):
+        if model in self.models:
+            self.update_index([name for name in self.models if name != model])
+            await self.save()
+
+    async def save(self):
+        """
+        Save the model list to the models file, skipping the write if the contents are unchanged.
+        """
+        content = '\n'.join(self.models)
+        if content == self.saved:
+            return
+        async with aiofiles.open(self.path, 'w') as file:
+            await file.write(content)
+        self.saved = content
+
+    def record_use(self, user_id, model):
+        recent = self.recent.get(user_id)
+        if recent is None:
+            recent = self.recent[user_id] = deque(maxlen=self.recent_per_user)
+        elif model in recent:
+            recent.remove(model)
+        recent.appendleft(model)
+        self.recent.move_to_end(user_id)
+        while len(self.recent) > self.max_users:
+            self.recent.popitem(last=False)
+
+    def find(self, query):
+        """
+        Return (tier, model) matches for a lowercased query, in alphabetical order within each tier.
+        """
+        matches = self.matches.get(query)
+        if matches is not None:
+            self.matches.move_to_end(query)
+            return matches
+
+        if not query:
+            matches = [(0, model) for _, model in self.index]
+        else:
+            matches = []
+            start = bisect_left(self.index, (query,))
+            for lowered, model in self.index[start:]:
+                if not lowered.startswith(query):
+                    break
+                matches.append((0, model))
+            word_matches, substring_matches = [], []
+            for lowered, model in self.index:
+                if query not in lowered or lowered.startswith(query):
+                    continue
+                if any(word.startswith(query) for word in self.words[model]):
+                    word_matches.append((1, model))
+                else:
+                    substring_matches.append((2, model))
+            matches += word_matches + substring_matches
+
+        self.matches[query] = matches
+        while len(self.matches) > MAX_CACHED_QUERIES:
+            self.matches.popitem(last=False)
+        return matches
+
+    def search(self, current, user_id=None, limit=MAX_CHOICES):
+        """
+        Return up to limit model names matching the input, best first.
+        """
+        matches = self.find(current.lower().strip())
+        recent = self.recent.get(user_id)
+        if not recent:
+            return [model for _, model in matches[:limit]]
+        rank = {model: i for i, model in enumerate(recent)}
+        ordered = sorted(matches, key=lambda match: (match[0], rank.get(match[1], len(rank))))
+        return [model for _, model in ordered[:limit]]
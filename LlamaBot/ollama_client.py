@@ -0,0 +1,144 @@
+import asyncio
+import json
+import logging
+import random
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth retrying: the server is restarting, overloaded or a proxy in front of it timed out.
+TRANSIENT_STATUSES = {408, 429, 502, 503, 504}
+
+# Per-endpoint timeouts. Generation and model creation can legitimately take minutes,
+# catalogue lookups should fail fast so a dead server doesn't hang startup.
+DEFAULT_TIMEOUTS = {
+    '/api/tags': aiohttp.ClientTimeout(total=15, sock_connect=5),
+    '/api/ps': aiohttp.ClientTimeout(total=15, sock_connect=5),
+    '/api/delete': aiohttp.ClientTimeout(total=60, sock_connect=5),
+    '/api/chat': aiohttp.ClientTimeout(total=600, sock_connect=10),
+    '/api/embed': aiohttp.ClientTimeout(total=60, sock_connect=10),
+    '/api/create': aiohttp.ClientTimeout(total=None, sock_connect=10),
+}
+FALLBACK_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_connect=10)
+# Streams have no overall deadline, only a limit on how long the server may go quiet.
+STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=300)
+
+
+class OllamaError(Exception):
+    """
+    Raised when the Ollama server answers with a non-200 status.
+    """
+    def __init__(self, status, details):
+        super().__init__(f"HTTP {status}: {details}")
+        self.status = status
+        self.details = details
+
+
+class OllamaClient:
+    """
+    A single pooled HTTP client for the Ollama server, owned by the bot and shared by all cogs.
+    Connections are kept alive between requests, transient failures are retried with
+    exponential backoff and every endpoint gets its own timeout.
+    """
+    def __init__(self, base_url, pool_size=16, pool_size_per_host=8, keepalive_timeout=60, retries=3, backoff=0.5, timeouts=None):
+        self.base_url = (base_url or '').rstrip('/')
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self._session = None
+
+    @property
+    def session(self):
+        """
+        The shared aiohttp session, created lazily so it binds to the running event loop.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def timeout_for(self, path):
+        return self.timeouts.get(path, FALLBACK_TIMEOUT)
+
+    async def backoff_delay(self, attempt, reason):
+        delay = self.backoff * (2 ** attempt) * (1 + random.random() / 2)
+        logger.warning(f"Transient Ollama error ({reason}), retrying in {delay:.2f}s (attempt {attempt + 1}/{self.retries})")
+        await asyncio.sleep(delay)
+
+    async def request(self, method, path, payload=None):
+        """
+        Send a request to the Ollama server and return the decoded JSON body.
+        Raises OllamaError for non-200 responses once retries are exhausted.
+        """
+        url = f'{self.base_url}{path}'
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.request(method, url, json=payload, timeout=self.timeout_for(path)) as response:
+                    body = await response.text()
+                    if response.status == 200:
+                        return json.loads(body) if body else {}
+                    if response.status not in TRANSIENT_STATUSES or attempt == self.retries:
+                        raise OllamaError(response.status, body)
+                    reason = f"HTTP {response.status}"
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                reason = type(e).__name__
+            await self.backoff_delay(attempt, reason)
+
+    async def stream(self, path, payload):
+        """
+        POST to a streaming endpoint and yield each NDJSON object as it arrives.
+        Transient failures are only retried before the stream has started.
+        """
+        url = f'{self.base_url}{path}'
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.session.post(url, json=payload, timeout=STREAM_TIMEOUT)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                await self.backoff_delay(attempt, type(e).__name__)
+                continue
+
+            async with response:
+                if response.status == 200:
+                    async for line in response.content:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        if 'error' in chunk:
+                            raise OllamaError(response.status, chunk['error'])
+                        yield chunk
+                    return
+                body = await response.text()
+                if response.status not in TRANSIENT_STATUSES or attempt == self.retries:
+                    raise OllamaError(response.status, body)
+            await self.backoff_delay(attempt, f"HTTP {response.status}")
+
+    async def get(self, path):
+        return await self.request('GET', path)
+
+    async def post(self, path, payload):
+        return await self.request('POST', path, payload)
+
+    async def delete(self, path, payload):
+        return await self.request('DELETE', path, payload)
+
+    async def close(self):
+        """
+        Close the pooled connections. Safe to call more than once.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
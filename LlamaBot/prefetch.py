@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+from history_store import estimate_tokens
+from ollama_client import OllamaError
+
+logger = logging.getLogger(__name__)
+
+
+def payload_size(payload):
+    return sum(len(message.get('content', '').encode('utf-8')) for message in payload['messages'])
+
+
+def payload_tokens(payload):
+    return sum(estimate_tokens(message.get('content', '')) for message in payload['messages'])
+
+
+class Alternatives:
+    __slots__ = ('message', 'payload', 'guild_id', 'responses', 'expires', 'size', 'task')
+
+    def __init__(self, message, payload, guild_id, expires):
+        self.message = message
+        self.payload = payload
+        self.guild_id = guild_id
+        self.responses = []
+        self.expires = expires
+        self.size = payload_size(payload)
+        self.task = None
+
+
+class Prefetcher:
+    """
+    Generates alternative responses to the latest turn of each conversation while the GPUs are
+    idle, so that regenerating it can swap one in instead of waiting for a new generation.
+
+    Alternatives are sampled from the same prompt as the response being shown, in background
+    slots of the scheduler: they only run on a backend with nothing else to do and are dropped
+    and retried later when a real request arrives. Up to count alternatives are kept per
+    conversation for ttl seconds, and the prompts and responses held are bounded by max_bytes in
+    total, least recently used first. Anything that changes the conversation discards them.
+
+    With quotas (a quota.QuotaManager) each alternative is charged to the user and guild of the
+    conversation when it is generated, and none are generated while either is over budget.
+    """
+    def __init__(self, scheduler, client, metrics=None, count=1, ttl=600, max_bytes=16 * 1024 * 1024, quotas=None):
+        self.scheduler = scheduler
+        self.client = client
+        self.metrics = metrics
+        self.quotas = quotas
+        self.count = count
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.generated = 0
+        self.served = 0
+        self.preempted = 0
+
+    def schedule(self, user_id, model, message, payload, guild_id=None):
+        """
+        Start prefetching alternatives to the response just given to the message, which was generated from payload.
+        """
+        key = (user_id, model)
+        self.discard(user_id, model)
+        entry = self.entries[key] = Alternatives(message, {**payload, 'stream': False}, guild_id, time.time() + self.ttl)
+        self.bytes += entry.size
+        self.evict()
+        if key in self.entries:
+            self.fill(key, entry)
+
+    def fill(self, key, entry):
+        if entry.task is None or entry.task.done():
+            entry.task = asyncio.create_task(self.run(key, entry))
+
+    async def run(self, key, entry):
+        try:
+            while len(entry.responses) < self.count:
+                remaining = entry.expires - time.time()
+                if remaining <= 0:
+                    return
+                if self.quotas is not None and self.quotas.over_budget(key[0], entry.guild_id, payload_tokens(entry.payload)) is not None:
+                    return
+                response = await self.generate(key[0], entry.guild_id, entry.payload, remaining)
+                if self.entries.get(key) is not entry:
+                    return
+                if response is None:
+                    continue
+                size = len(response.encode('utf-8'))
+                entry.responses.append(response)
+                entry.size += size
+                self.bytes += size
+                self.generated += 1
+                self.evict()
+        except asyncio.TimeoutError:
+            return
+        except (OllamaError, aiohttp.ClientError) as e:
+            logger.warning(f"Failed to prefetch an alternative response for user {key[0]} with '{key[1]}': {str(e)}")
+        except Exception as e:
+            logger.exception(f"Unexpected error prefetching alternative responses: {str(e)}")
+
+    async def generate(self, user_id, guild_id, payload, timeout):
+        """
+        Generate one response in a background slot. Returns None if a real request preempted it.
+        """
+        async with self.scheduler.background_slot(payload['model'], user_id, timeout) as (backend, preempted):
+            started = time.perf_counter()
+            request = asyncio.create_task(self.client.chat(payload, user_id, backend))
+            interrupted = asyncio.create_task(preempted.wait())
+            try:
+                await asyncio.wait((request, interrupted), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                interrupted.cancel()
+                if not request.done():
+                    request.cancel()
+            if request.cancelled():
+                self.preempted += 1
+                return None
+            data = request.result()
+        if self.metrics is not None:
+            self.metrics.observe('prefetch', time.perf_counter() - started)
+        if self.quotas is not None:
+            self.quotas.charge(user_id, guild_id, data)
+        return data['message']['content']
+
+    def take(self, user_id, model, message):
+        """
+        Return a prefetched alternative to the latest response to the message, or None if none is ready.
+        The prompt hasn't changed, so the remaining alternatives stay valid and are topped up again.
+        """
+        key = (user_id, model)
+        entry = self.entries.get(key)
+        if entry is None or entry.message != message:
+            return None
+        if entry.expires <= time.time():
+            self.discard(user_id, model)
+            return None
+        if not entry.responses:
+            return None
+        response = entry.responses.pop(0)
+        size = len(response.encode('utf-8'))
+        entry.size -= size
+        self.bytes -= size
+        self.served += 1
+        self.entries.move_to_end(key)
+        self.fill(key, entry)
+        return response
+
+    def evict(self):
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if entry.expires <= now]:
+            self.discard_entry(key)
+        while self.bytes > self.max_bytes and self.entries:
+            self.discard_entry(next(iter(self.entries)))
+
+    def discard_entry(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry.size
+        if entry.task is not None:
+            entry.task.cancel()
+
+    def discard(self, user_id, model=None):
+        """
+        Drop the alternatives for a user's conversation with one model, or with every model, and stop generating them.
+        """
+        for key in [key for key in self.entries if key[0] == user_id and model in (None, key[1])]:
+            self.discard_entry(key)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'ready': sum(len(entry.responses) for entry in self.entries.values()),
+            'bytes': self.bytes,
+            'generated': self.generated,
+            'served': self.served,
+            'preempted': self.preempted
+        }
+
+    async def close(self):
+        tasks = [entry.task for entry in self.entries.values() if entry.task is not None]
+        for key in list(self.entries):
+            self.discard_entry(key)
+        await asyncio.gather(*tasks, return_exceptions=True)
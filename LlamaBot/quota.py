@@ -0,0 +1,280 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Windows a limit can be set for, in seconds.
+WINDOWS = {'minute': 60, 'hour': 3600, 'day': 86400}
+SCOPES = ('user', 'guild')
+# Usage is persisted as one row per subject and period of this many seconds.
+PERIOD = 3600
+
+
+class QuotaExceeded(Exception):
+    """
+    Raised when a request would overrun a user's or a guild's token budget.
+    """
+    def __init__(self, scope, window, retry_after):
+        self.scope = scope
+        self.window = window
+        self.retry_after = retry_after
+        who = "You have" if scope == 'user' else "This server has"
+        if retry_after == float('inf'):
+            super().__init__(f"{who} no token budget for generating responses.")
+            return
+        minutes = max(1, round(retry_after / 60))
+        super().__init__(f"{who} used up the token budget for this {window}. Please try again in about {minutes} minute{'s' if minutes != 1 else ''}.")
+
+
+class TokenBucket:
+    """
+    Holds up to capacity tokens and refills continuously at capacity per window seconds, so what
+    is missing from it is roughly the usage over the last window. Responses are charged after
+    the fact, so the level can go below zero; the debt is paid off by the refill.
+    """
+    __slots__ = ('capacity', 'window', 'level', 'updated')
+
+    def __init__(self, capacity, window, level, now):
+        self.capacity = capacity
+        self.window = window
+        self.level = level
+        self.updated = now
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / self.window)
+        self.updated = now
+        return self.level
+
+    def seconds_until(self, tokens):
+        return max(0.0, (tokens - self.level) * self.window / self.capacity) if self.capacity else float('inf')
+
+
+class QuotaManager:
+    """
+    Token budgets per user and per guild, charged with the prompt and generated tokens Ollama
+    reports for each response.
+
+    A subject has a token bucket for each window in its limits, e.g. {'hour': 50000, 'day': 400000}.
+    Limits come from limits['user'] or limits['guild'] unless an admin set some for the subject.
+    Before a request is sent to Ollama, admit() checks that the user's and the guild's buckets
+    still hold its estimated prompt tokens; if one doesn't, action decides whether the request is
+    rejected with QuotaExceeded or served at low priority behind everyone else.
+
+    Only the given scopes are enforced. What is charged to the others is still recorded, and
+    kept for drain() so the manager that does enforce them can be debited: worker processes
+    enforce user budgets and the gateway guild budgets (see workers.WorkerPool).
+
+    Usage is summed up in memory and written every flush_interval seconds as one row per subject
+    and hour; at startup the buckets are refilled from those rows, and rows older than keep_days
+    are deleted.
+    """
+    def __init__(self, history, limits=None, action='reject', scopes=SCOPES, flush_interval=60, keep_days=31):
+        self.history = history
+        self.defaults = {scope: dict((limits or {}).get(scope, {})) for scope in SCOPES}
+        self.action = action
+        self.scopes = scopes
+        self.flush_interval = flush_interval
+        self.keep_days = keep_days
+        self.overrides = {}
+        self.buckets = {}
+        self.pending = defaultdict(lambda: [0, 0, 0])
+        self.unreported = defaultdict(int)
+        self.rejected = 0
+        self.deprioritized = 0
+        self.pruned = 0.0
+        self.task = None
+
+    async def start(self):
+        for scope, subject_id, window, tokens in await self.history.get_quota_limits():
+            self.overrides.setdefault((scope, subject_id), {})[window] = tokens
+        await self.restore()
+        self.task = asyncio.create_task(self.flush_loop())
+
+    async def restore(self):
+        """
+        Start each bucket as full as the persisted usage of its last window allows, assuming usage was spread evenly over each hour.
+        """
+        now = time.time()
+        used = defaultdict(float)
+        for scope, subject_id, period, prompt_tokens, tokens, _ in await self.history.get_quota_usage(now - max(WINDOWS.values())):
+            end = min(period + PERIOD, now)
+            if scope not in self.scopes or end <= period:
+                continue
+            for window, seconds in WINDOWS.items():
+                overlap = end - max(period, now - seconds)
+                if overlap > 0:
+                    used[(scope, subject_id, window)] += (prompt_tokens + tokens) * overlap / (end - period)
+        monotonic = time.monotonic()
+        for (scope, subject_id, window), tokens in used.items():
+            capacity = self.limits(scope, subject_id).get(window)
+            if capacity is not None:
+                self.buckets[(scope, subject_id, window)] = TokenBucket(capacity, WINDOWS[window], capacity - tokens, monotonic)
+
+    def limits(self, scope, subject_id):
+        """
+        The {window: tokens} limits of a user or guild, with those set by admins taking precedence over the defaults.
+        """
+        return {**self.defaults[scope], **self.overrides.get((scope, subject_id), {})}
+
+    def subjects(self, user_id, guild_id):
+        if user_id is not None:
+            yield 'user', user_id
+        if guild_id is not None:
+            yield 'guild', guild_id
+
+    def buckets_of(self, scope, subject_id, now):
+        """
+        Yield (window, bucket) for each limit of the subject, refilled to now.
+        """
+        for window, capacity in self.limits(scope, subject_id).items():
+            key = (scope, subject_id, window)
+            bucket = self.buckets.get(key)
+            if bucket is None or bucket.capacity != capacity:
+                # A changed limit keeps what was used of the old one.
+                level = capacity if bucket is None else capacity - bucket.capacity + bucket.refill(now)
+                bucket = self.buckets[key] = TokenBucket(capacity, WINDOWS[window], level, now)
+            bucket.refill(now)
+            yield window, bucket
+
+    def over_budget(self, user_id, guild_id, tokens):
+        """
+        Return QuotaExceeded for the first of the user's and the guild's budgets that can't take tokens, or None.
+        """
+        now = time.monotonic()
+        for scope, subject_id in self.subjects(user_id, guild_id):
+            if scope not in self.scopes:
+                continue
+            for window, bucket in self.buckets_of(scope, subject_id, now):
+                # At least one token, so a limit of 0 turns everything away.
+                needed = max(1, min(tokens, bucket.capacity))
+                if bucket.level < needed:
+                    return QuotaExceeded(scope, window, bucket.seconds_until(needed))
+        return None
+
+    def admit(self, user_id, guild_id, tokens):
+        """
+        Check a request estimated at tokens prompt tokens against the user's and the guild's budgets.
+        Returns False if it should be served at low priority; raises QuotaExceeded if it should be rejected.
+        """
+        exceeded = self.over_budget(user_id, guild_id, tokens)
+        if exceeded is None:
+            return True
+        if self.action == 'deprioritize':
+            self.deprioritized += 1
+            return False
+        self.rejected += 1
+        raise exceeded
+
+    def charge(self, user_id, guild_id, data):
+        """
+        Charge the user and the guild for an Ollama chat response (or the final chunk of a stream).
+        """
+        prompt_tokens = data.get('prompt_eval_count') or 0
+        tokens = data.get('eval_count') or 0
+        period = time.time() // PERIOD * PERIOD
+        for scope, subject_id in self.subjects(user_id, guild_id):
+            if scope in self.scopes:
+                self.debit(scope, subject_id, prompt_tokens + tokens)
+            else:
+                self.unreported[(scope, subject_id)] += prompt_tokens + tokens
+            usage = self.pending[(scope, subject_id, period)]
+            usage[0] += prompt_tokens
+            usage[1] += tokens
+            usage[2] += 1
+
+    def debit(self, scope, subject_id, tokens):
+        """
+        Take tokens out of the subject's buckets; they may go below zero.
+        """
+        for _, bucket in self.buckets_of(scope, subject_id, time.monotonic()):
+            bucket.level -= tokens
+
+    def drain(self):
+        """
+        Return and forget the [scope, subject_id, tokens] charged to scopes this manager doesn't enforce since the last drain.
+        """
+        unreported, self.unreported = self.unreported, defaultdict(int)
+        return [[scope, subject_id, tokens] for (scope, subject_id), tokens in unreported.items()]
+
+    async def set_limit(self, scope, subject_id, window, tokens):
+        """
+        Set a user's or guild's limit for a window, or go back to the default with tokens None.
+        """
+        await self.history.set_quota_limit(scope, subject_id, window, tokens)
+        overrides = self.overrides.setdefault((scope, subject_id), {})
+        if tokens is None:
+            overrides.pop(window, None)
+        else:
+            overrides[window] = tokens
+        if not overrides:
+            del self.overrides[(scope, subject_id)]
+
+    async def report(self, scope, subject_id):
+        """
+        Return a subject's limits, what is left of them and its token usage over the last day, as plain data.
+        """
+        await self.flush()
+        now = time.monotonic()
+        remaining = {window: bucket.level for window, bucket in self.buckets_of(scope, subject_id, now)}
+        since = time.time() - WINDOWS['day']
+        usage = [0, 0, 0]
+        for *_, prompt_tokens, tokens, requests in await self.history.get_quota_usage(since, scope, subject_id):
+            usage = [usage[0] + prompt_tokens, usage[1] + tokens, usage[2] + requests]
+        return {
+            'limits': self.limits(scope, subject_id),
+            'remaining': remaining,
+            'prompt_tokens': usage[0],
+            'tokens': usage[1],
+            'requests': usage[2]
+        }
+
+    def stats(self):
+        return {
+            'buckets': len(self.buckets),
+            'rejected': self.rejected,
+            'deprioritized': self.deprioritized
+        }
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                self.prune_buckets()
+                if time.time() - self.pruned > WINDOWS['day']:
+                    await self.history.prune_quota_usage(time.time() - self.keep_days * WINDOWS['day'])
+                    self.pruned = time.time()
+            except Exception as e:
+                logger.exception(f"Failed to save token usage: {str(e)}")
+
+    async def flush(self):
+        """
+        Write the usage summed up since the last flush.
+        """
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, defaultdict(lambda: [0, 0, 0])
+        try:
+            await self.history.add_quota_usage([(*key, *usage) for key, usage in pending.items()])
+        except BaseException:
+            # Keep it for the next flush.
+            for key, usage in pending.items():
+                self.pending[key] = [total + part for total, part in zip(self.pending[key], usage)]
+            raise
+
+    def prune_buckets(self):
+        """
+        Forget full buckets; they are recreated full when next needed.
+        """
+        now = time.monotonic()
+        for key in [key for key, bucket in self.buckets.items() if bucket.refill(now) >= bucket.capacity]:
+            del self.buckets[key]
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+from ollama_client import OllamaError
+
+logger = logging.getLogger(__name__)
+
+
+class ResidencyManager:
+    """
+    Decides which models stay loaded on the Ollama nodes.
+
+    Demand for each model is a request count that decays with the given half-life, seeded at
+    startup from recent history and fed by every chat request. The resident_models most in-demand
+    models are "hot": requests for them ask Ollama to keep them loaded for hot_keep_alive and the
+    manager preloads them when the health check (/api/ps) shows they aren't loaded, unloading
+    models nobody has asked for to make room. Other models with recent demand are kept for
+    warm_keep_alive, the rest only for cold_keep_alive, so a model used once doesn't hold on to
+    VRAM the next user's model needs. Models in pinned (such as the embedding model) are never unloaded.
+
+    With several worker processes each one sees only its own share of the requests, which is
+    enough to pick keep_alive values; only the one created with preload=True loads and unloads models.
+    """
+    def __init__(self, pool, history, metrics=None, resident_models=2, half_life=3600, interval=60,
+                 hot_keep_alive='24h', warm_keep_alive='30m', cold_keep_alive='5m', warm_demand=1.0, pinned=(), preload=True):
+        self.pool = pool
+        self.history = history
+        self.metrics = metrics
+        self.resident_models = resident_models
+        self.half_life = half_life
+        self.interval = interval
+        self.hot_keep_alive = hot_keep_alive
+        self.warm_keep_alive = warm_keep_alive
+        self.cold_keep_alive = cold_keep_alive
+        self.warm_demand = warm_demand
+        self.pinned = set(pinned)
+        self.preload_models = preload
+        self.demand = {}
+        self.task = None
+        self.warming = None
+        self.lock = asyncio.Lock()
+
+    def decayed(self, model, now=None):
+        score, updated = self.demand.get(model, (0.0, 0.0))
+        return score * 0.5 ** (((now or time.time()) - updated) / self.half_life)
+
+    def record(self, model, weight=1.0, at=None):
+        now = time.time()
+        at = at or now
+        self.demand[model] = (self.decayed(model, now) + weight * 0.5 ** ((now - at) / self.half_life), now)
+
+    def ranking(self):
+        """
+        Return (model, demand) pairs, most in-demand first.
+        """
+        now = time.time()
+        return sorted(((model, self.decayed(model, now)) for model in self.demand), key=lambda item: item[1], reverse=True)
+
+    def hot_models(self):
+        return [model for model, demand in self.ranking()[:self.resident_models] if demand >= self.warm_demand]
+
+    def keep_alive(self, model):
+        """
+        The keep_alive to send with a request for the model, by its current demand.
+        """
+        if model in self.hot_models():
+            return self.hot_keep_alive
+        if self.decayed(model) >= self.warm_demand:
+            return self.warm_keep_alive
+        return self.cold_keep_alive
+
+    def is_loaded(self, model):
+        return any(model in backend.loaded for backend in self.pool.backends.values() if backend.healthy)
+
+    async def seed(self):
+        """
+        Start from the demand seen in the history of the last few half-lives.
+        """
+        for model, timestamp, count in await self.history.model_demand(time.time() - 4 * self.half_life):
+            self.record(model, count, timestamp)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run_loop())
+
+    async def run_loop(self):
+        try:
+            await self.seed()
+        except Exception as e:
+            logger.warning(f"Failed to read model demand from history: {str(e)}")
+        while self.preload_models:
+            try:
+                await self.warm()
+            except Exception as e:
+                logger.exception(f"Unexpected error managing model residency: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def warm(self):
+        """
+        Preload hot models that aren't loaded, first unloading models with no demand left.
+        """
+        async with self.lock:
+            if not any(backend.models for backend in self.pool.backends.values()):
+                await self.pool.refresh()
+            available = set(self.pool.available_models)
+            missing = [model for model in self.hot_models() if model in available and not self.is_loaded(model)]
+            if not missing:
+                return
+            idle = {model for backend in self.pool.backends.values() for model in backend.loaded}
+            for model in idle:
+                if model not in self.pinned and model not in self.hot_models() and self.decayed(model) < self.warm_demand:
+                    logger.info(f"Unloading idle model '{model}'")
+                    await self.pool.unload_model(model)
+            for model in missing:
+                await self.preload(model)
+
+    def schedule_warm(self):
+        """
+        Run warm() in the background, e.g. after a model was created.
+        """
+        if self.preload_models and (self.warming is None or self.warming.done()):
+            self.warming = asyncio.create_task(self.warm())
+
+    async def preload(self, model):
+        started = time.perf_counter()
+        try:
+            await self.pool.load_model(model, self.keep_alive(model))
+        except (OllamaError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Failed to preload model '{model}': {str(e)}")
+            return
+        elapsed = time.perf_counter() - started
+        if self.metrics is not None:
+            self.metrics.observe('preload', elapsed)
+        logger.info(f"Preloaded model '{model}' in {elapsed:.1f}s")
+
+    def snapshot(self):
+        """
+        Return (model, demand, keep_alive, loaded) for every model with demand, most in-demand first.
+        """
+        return [(model, demand, self.keep_alive(model), self.is_loaded(model)) for model, demand in self.ranking()]
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.warming is not None:
+            self.warming.cancel()
+            await asyncio.gather(self.warming, return_exceptions=True)
@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+class Abandoned(Exception):
+    """
+    Set on an in-flight generation that failed or whose leader was cancelled, so waiting followers generate themselves.
+    Only a response is shared: the leader's error, such as its full queue or used up quota, is its own.
+    """
+
+
+def cache_key(payload):
+    """
+    Content address of a chat request: a hash of the model, its options and the exact message list.
+    """
+    material = json.dumps({
+        'model': payload['model'],
+        'options': payload.get('options', {}),
+        'messages': payload['messages']
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Caches chat responses by content address, with LRU and TTL eviction, and makes identical
+    requests that are in flight at the same time share a single generation.
+
+    Entries live in memory; when a path is given they are also kept in a SQLite file so they
+    survive restarts, with the memory tier acting as the hot front of the disk tier. The disk tier
+    is only pruned once it holds more than max_disk_entries, down to nine tenths of that, so
+    a put is usually a single insert.
+    """
+    def __init__(self, max_entries=1024, ttl=3600, path=None, max_disk_entries=100000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.db = None
+        self.disk_entries = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def open(self):
+        if self.path is None:
+            return
+        self.db = await aiosqlite.connect(self.path, isolation_level=None)
+        await self.db.execute("PRAGMA journal_mode=WAL")
+        await self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)")
+        await self.db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        await self.db.execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires)")
+        await self.db.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+        async with self.db.execute("SELECT COUNT(*) FROM responses") as cursor:
+            self.disk_entries = (await cursor.fetchone())[0]
+
+    async def close(self):
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+
+    async def get(self, key):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, response = entry
+            if expires > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return response
+            del self.entries[key]
+
+        if self.db is not None:
+            async with self.db.execute("SELECT response, expires FROM responses WHERE key = ? AND expires > ?", (key, now)) as cursor:
+                row = await cursor.fetchone()
+            if row is not None:
+                await self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+                self.remember(key, row[0], row[1])
+                self.disk_hits += 1
+                return row[0]
+
+        self.misses += 1
+        return None
+
+    def remember(self, key, response, expires):
+        self.entries[key] = (expires, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def put(self, key, response):
+        now = time.time()
+        self.remember(key, response, now + self.ttl)
+        if self.db is not None:
+            await self.db.execute("INSERT OR REPLACE INTO responses (key, response, expires, used) VALUES (?, ?, ?, ?)", (key, response, now + self.ttl, now))
+            # Replacing an entry counts too, which only makes the next prune come a little early.
+            self.disk_entries += 1
+            if self.disk_entries > self.max_disk_entries:
+                await self.prune(now)
+
+    async def prune(self, now):
+        """
+        Delete expired entries, then the least recently used ones until the disk tier is down to nine tenths of max_disk_entries.
+        """
+        await self.db.execute("DELETE FROM responses WHERE expires < ?", (now,))
+        async with self.db.execute("SELECT COUNT(*) FROM responses") as cursor:
+            count = (await cursor.fetchone())[0]
+        excess = count - self.max_disk_entries * 9 // 10
+        if excess > 0:
+            await self.db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used LIMIT ?)", (excess,))
+            count -= excess
+        self.disk_entries = count
+
+    async def get_or_generate(self, payload, generate):
+        """
+        Return (response, cached) for the request. On a miss, generate() is awaited to produce the
+        response; identical requests arriving meanwhile wait for it instead of generating again,
+        and generate themselves if it fails.
+        """
+        key = cache_key(payload)
+        while True:
+            response = await self.get(key)
+            if response is not None:
+                return response, True
+
+            future = self.in_flight.get(key)
+            if future is None:
+                break
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future), True
+            except Abandoned:
+                continue
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            response = await generate()
+        except BaseException:
+            future.set_exception(Abandoned())
+            raise
+        else:
+            future.set_result(response)
+            await self.put(key, response)
+            return response, False
+        finally:
+            self.in_flight.pop(key, None)
+            # Mark the exception as retrieved in case nobody was waiting for it.
+            if future.done() and not future.cancelled():
+                future.exception()
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0
+        }
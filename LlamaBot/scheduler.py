@@ -0,0 +1,297 @@
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# Returned by pick_backend when no backend has a free slot for the model.
+FULL = object()
+
+
+class QueueFull(Exception):
+    """
+    Raised when a request is rejected because the queue is over its limits or the wait took too long.
+    """
+
+
+class Ticket:
+    __slots__ = ('model', 'user_id', 'guild_id', 'low_priority', 'future', 'position')
+
+    def __init__(self, model, user_id, guild_id, low_priority=False):
+        self.model = model
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.low_priority = low_priority
+        self.future = asyncio.get_running_loop().create_future()
+        self.position = 0
+
+
+class RequestScheduler:
+    """
+    Sits between the cogs and Ollama and caps the number of generations in flight,
+    per model and per backend. The router returns the backends that can serve a model,
+    best first; a request takes a slot on the first one with room and is told which.
+
+    Requests that can't start right away are queued per guild and, within a guild, per user.
+    Dispatch goes round-robin over guilds and then over the users of a guild, so one busy
+    guild or one heavy user can't starve everyone else. Low priority requests, such as those of
+    users over their token quota, are only served once no other request is waiting. The queue is
+    bounded in total, per user and in how long a request may wait; anything beyond that is
+    rejected with QueueFull.
+
+    Speculative work takes a background slot instead. It only starts on a backend that has
+    nothing running while nothing is queued, and is preempted as soon as a real request is
+    started on that backend.
+    """
+    def __init__(self, max_per_model=2, max_per_backend=4, max_queued=100, max_queued_per_user=3, max_wait=300, position_interval=2.0, router=None):
+        self.max_per_model = max_per_model
+        self.max_per_backend = max_per_backend
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.max_wait = max_wait
+        self.position_interval = position_interval
+        self.router = router or (lambda model, user_id: [None])
+        # (backend, model) -> running generations, and backend -> running generations.
+        self.running = Counter()
+        self.running_backend = Counter()
+        # guild_id -> user_id -> deque of tickets; both levels rotate as they are served.
+        self.queues = OrderedDict()
+        self.queued = 0
+        self.queued_per_user = Counter()
+        self.rejected = 0
+        # backend -> event set to preempt the background generation running there.
+        self.background = {}
+        self.preempted = 0
+        self.changed = asyncio.Event()
+
+    def pick_backend(self, model, user_id):
+        for backend in self.router(model, user_id):
+            if self.running_backend[backend] < self.max_per_backend and self.running[(backend, model)] < self.max_per_model:
+                return backend
+        return FULL
+
+    @asynccontextmanager
+    async def slot(self, model, user_id=None, guild_id=None, on_position=None, low_priority=False):
+        """
+        Wait for a generation slot for the model and hold it for the duration of the block,
+        which receives the backend the slot is on. on_position is awaited with the 1-based
+        queue position whenever it changes while waiting.
+        """
+        backend = await self.acquire(model, user_id, guild_id, on_position, low_priority)
+        try:
+            yield backend
+        finally:
+            self.release(model, backend)
+
+    @asynccontextmanager
+    async def background_slot(self, model, user_id=None, timeout=None):
+        """
+        Wait until a backend that can serve the model is idle and hold it for the duration of the
+        block, which receives (backend, preempted). preempted is an asyncio.Event that is set when a
+        real request needs the backend; the block should then stop its work as soon as it can.
+        Raises asyncio.TimeoutError if no backend became idle within timeout seconds.
+        """
+        backend = await self.acquire_background(model, user_id, timeout)
+        preempted = self.background[backend] = asyncio.Event()
+        try:
+            yield backend, preempted
+        finally:
+            del self.background[backend]
+            self.notify()
+
+    async def acquire_background(self, model, user_id, timeout):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            changed = self.changed
+            backend = self.idle_backend(model, user_id)
+            if backend is not FULL:
+                return backend
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                raise asyncio.TimeoutError()
+            await asyncio.wait_for(changed.wait(), remaining)
+
+    def idle_backend(self, model, user_id):
+        if self.queued:
+            return FULL
+        for backend in self.router(model, user_id):
+            if not self.running_backend[backend] and backend not in self.background:
+                return backend
+        return FULL
+
+    def notify(self):
+        """
+        Wake up background work waiting for an idle backend.
+        """
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def check(self, user_id):
+        """
+        Raise QueueFull if a request from the user would be rejected right now, so callers can
+        turn it away before doing anything on its behalf.
+        """
+        # Both limits can only be reached with requests queued, when a new one would have to queue too.
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            raise QueueFull("The server is too busy right now. Please try again in a moment.")
+        if self.queued_per_user[user_id] >= self.max_queued_per_user:
+            self.rejected += 1
+            raise QueueFull("You already have too many requests waiting. Please wait for them to finish.")
+
+    async def acquire(self, model, user_id, guild_id, on_position, low_priority=False):
+        if self.queued == 0:
+            backend = self.pick_backend(model, user_id)
+            if backend is not FULL:
+                self.start(model, backend)
+                return backend
+
+        self.check(user_id)
+        ticket = Ticket(model, user_id, guild_id, low_priority)
+        self.enqueue(ticket)
+        self.dispatch()
+        try:
+            await self.wait(ticket, on_position)
+        except BaseException:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # We were handed a slot just as we gave up; pass it on.
+                self.release(model, ticket.future.result())
+            else:
+                self.remove(ticket)
+            raise
+        return ticket.future.result()
+
+    async def wait(self, ticket, on_position):
+        deadline = time.monotonic() + self.max_wait
+        reported = None
+        while True:
+            if on_position is not None and ticket.position != reported and not ticket.future.done():
+                reported = ticket.position
+                try:
+                    await on_position(reported)
+                except Exception as e:
+                    logger.warning(f"Failed to report queue position: {str(e)}")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.rejected += 1
+                raise QueueFull("Your request waited too long in the queue. Please try again later.")
+            try:
+                await asyncio.wait_for(asyncio.shield(ticket.future), timeout=min(self.position_interval, remaining))
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    def start(self, model, backend):
+        self.running[(backend, model)] += 1
+        self.running_backend[backend] += 1
+        preempted = self.background.get(backend)
+        if preempted is not None and not preempted.is_set():
+            preempted.set()
+            self.preempted += 1
+
+    def release(self, model, backend):
+        self.running[(backend, model)] -= 1
+        if not self.running[(backend, model)]:
+            del self.running[(backend, model)]
+        self.running_backend[backend] -= 1
+        if not self.running_backend[backend]:
+            del self.running_backend[backend]
+        self.dispatch()
+        self.notify()
+
+    def enqueue(self, ticket):
+        users = self.queues.setdefault(ticket.guild_id, OrderedDict())
+        users.setdefault(ticket.user_id, deque()).append(ticket)
+        self.queued += 1
+        self.queued_per_user[ticket.user_id] += 1
+
+    def remove(self, ticket):
+        users = self.queues.get(ticket.guild_id)
+        tickets = users.get(ticket.user_id) if users else None
+        if not tickets or ticket not in tickets:
+            return
+        tickets.remove(ticket)
+        self.forget(ticket)
+        self.update_positions()
+        self.notify()
+
+    def forget(self, ticket):
+        users = self.queues[ticket.guild_id]
+        if not users[ticket.user_id]:
+            del users[ticket.user_id]
+        if not users:
+            del self.queues[ticket.guild_id]
+        self.queued -= 1
+        self.queued_per_user[ticket.user_id] -= 1
+        if not self.queued_per_user[ticket.user_id]:
+            del self.queued_per_user[ticket.user_id]
+
+    def dispatch(self):
+        """
+        Start as many queued requests as capacity allows, in fair round-robin order.
+        A request whose model is at its limit doesn't hold up requests for other models.
+        """
+        while self.queued:
+            ticket, backend = self.next_ticket()
+            if ticket is None:
+                break
+            users = self.queues[ticket.guild_id]
+            users[ticket.user_id].remove(ticket)
+            # Rotate the guild and the user to the back so others are served first next time.
+            users.move_to_end(ticket.user_id)
+            self.queues.move_to_end(ticket.guild_id)
+            self.forget(ticket)
+            self.start(ticket.model, backend)
+            ticket.future.set_result(backend)
+        self.update_positions()
+
+    def next_ticket(self):
+        """
+        The first ticket in service order that has a backend with room, and that backend.
+        """
+        for ticket in self.service_order():
+            backend = self.pick_backend(ticket.model, ticket.user_id)
+            if backend is not FULL:
+                return ticket, backend
+        return None, FULL
+
+    def service_order(self):
+        """
+        Yield queued tickets in the order they would be served if every model had capacity.
+        """
+        # Low priority tickets are interleaved on their own, so they don't take their guild's or user's turn.
+        for low_priority in (False, True):
+            per_guild = [
+                self.interleave([[ticket for ticket in tickets if ticket.low_priority == low_priority] for tickets in users.values()])
+                for users in self.queues.values()
+            ]
+            yield from self.interleave(per_guild)
+
+    @staticmethod
+    def interleave(sequences):
+        iterators = deque(iter(sequence) for sequence in sequences)
+        while iterators:
+            iterator = iterators.popleft()
+            item = next(iterator, None)
+            if item is not None:
+                yield item
+                iterators.append(iterator)
+
+    def update_positions(self):
+        for position, ticket in enumerate(self.service_order(), start=1):
+            ticket.position = position
+
+    def stats(self):
+        per_model = Counter()
+        for (_, model), count in self.running.items():
+            per_model[model] += count
+        return {
+            'running': sum(self.running_backend.values()),
+            'running_per_model': dict(per_model),
+            'queued': self.queued,
+            'rejected': self.rejected,
+            'background': len(self.background),
+            'preempted': self.preempted
+        }
@@ -0,0 +1,26 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from backend_pool import BackendPool
+
+
+def test_no_urls_is_an_error():
+    with pytest.raises(ValueError):
+        BackendPool([])
+
+
+def test_refresh_raises_a_client_error_when_no_node_answers():
+    async def run():
+        # Nothing listens on the discard port, so the connection is refused right away.
+        pool = BackendPool(['http://127.0.0.1:9'], retries=0)
+        try:
+            with pytest.raises(aiohttp.ClientError):
+                await pool.refresh()
+            assert not pool.backends['http://127.0.0.1:9'].healthy
+            assert pool.available_models == []
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
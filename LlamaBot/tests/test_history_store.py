@@ -0,0 +1,109 @@
+import asyncio
+import sqlite3
+
+from history_store import HistoryStore
+
+
+def stored_turns(path, user_id, model):
+    """
+    The turns committed to the database, read on a connection of its own.
+    """
+    with sqlite3.connect(path) as db:
+        return [turn for turn, in db.execute("SELECT turn FROM history WHERE user_id = ? AND model = ? ORDER BY turn", (user_id, model))]
+
+
+def open_store(path, **kwargs):
+    # Nothing is flushed on a timer or a full batch during a test unless it asks for it.
+    return HistoryStore(str(path), **{'durability': 'deferred', 'batch_size': 1000, 'flush_interval': 3600, **kwargs})
+
+
+def test_reads_see_queued_turns(tmp_path):
+    path = tmp_path / 'history.db'
+
+    async def run():
+        history = open_store(path)
+        await history.open()
+        try:
+            await history.add_turn(1, 'model', 'first', 'one')
+            await history.add_turn(1, 'model', 'second', 'two')
+            assert stored_turns(path, 1, 'model') == []
+
+            assert [row[:3] for row in await history.get_turns(1, 'model')] == [
+                (1, 'user', 'first'), (2, 'assistant', 'one'), (3, 'user', 'second'), (4, 'assistant', 'two')
+            ]
+            assert [row[0] for row in await history.get_turns(1, 'model', after_turn=2)] == [3, 4]
+            assert await history.get_messages(1, 'model') == [
+                {'role': 'user', 'content': 'first'}, {'role': 'assistant', 'content': 'one'},
+                {'role': 'user', 'content': 'second'}, {'role': 'assistant', 'content': 'two'}
+            ]
+            assert await history.last_used_model(1) == 'model'
+        finally:
+            await history.close()
+
+    asyncio.run(run())
+
+
+def test_conversation_sees_queued_turns_after_a_flush(tmp_path):
+    path = tmp_path / 'history.db'
+
+    async def run():
+        history = open_store(path)
+        await history.open()
+        try:
+            await history.add_turn(1, 'model', 'first', 'one')
+            await history.flush()
+            assert stored_turns(path, 1, 'model') == [1, 2]
+
+            # Not cached yet, so this one is loaded from the database and the queue.
+            history.cache.discard((1, 'model'))
+            await history.add_turn(1, 'model', 'second', 'two')
+            conversation = await history.get_conversation(1, 'model')
+            assert [row[0] for row in conversation.rows] == [1, 2, 3, 4]
+            assert conversation.last_turn == 4
+        finally:
+            await history.close()
+
+    asyncio.run(run())
+
+
+def test_close_flushes_queued_turns(tmp_path):
+    path = tmp_path / 'history.db'
+
+    async def run():
+        history = open_store(path)
+        await history.open()
+        await history.add_turn(1, 'model', 'first', 'one')
+        await history.add_turn(2, 'model', 'hello', 'hi', guild_id=7)
+        assert history.queue
+        await history.close()
+
+    asyncio.run(run())
+    assert stored_turns(path, 1, 'model') == [1, 2]
+    assert stored_turns(path, 2, 'model') == [1, 2]
+
+    async def reopen():
+        history = open_store(path)
+        await history.open()
+        try:
+            await history.add_turn(1, 'model', 'second', 'two')
+            return [row[0] for row in await history.get_turns(1, 'model')]
+        finally:
+            await history.close()
+
+    assert asyncio.run(reopen()) == [1, 2, 3, 4]
+
+
+def test_batched_add_turn_returns_once_committed(tmp_path):
+    path = tmp_path / 'history.db'
+
+    async def run():
+        history = open_store(path, durability='batched', flush_interval=0.01)
+        await history.open()
+        try:
+            await asyncio.gather(*(history.add_turn(user_id, 'model', 'hello', 'hi') for user_id in range(5)))
+            assert not history.queue
+            assert all(stored_turns(path, user_id, 'model') == [1, 2] for user_id in range(5))
+        finally:
+            await history.close()
+
+    asyncio.run(run())
@@ -0,0 +1,130 @@
+import asyncio
+
+import history_transfer
+from history_store import HistoryStore
+
+
+def exported(user_id, model, turns, guild_id=None, start=1):
+    """
+    Exported (user_id, model, guild_id, turn, role, message, timestamp) rows for (message, response) pairs.
+    """
+    rows = []
+    for index, (message, response) in enumerate(turns):
+        turn = start + 2 * index
+        rows.append((user_id, model, guild_id, turn, 'user', message, 1000.0 + turn))
+        rows.append((user_id, model, guild_id, turn + 1, 'assistant', response, 1001.0 + turn))
+    return rows
+
+
+async def open_store(path):
+    history = HistoryStore(str(path), durability='immediate')
+    await history.open()
+    return history
+
+
+async def turns_of(history, user_id, model):
+    return [(turn, role, message) for turn, role, message, _ in await history.get_turns(user_id, model)]
+
+
+def test_import_is_idempotent(tmp_path):
+    async def run():
+        history = await open_store(tmp_path / 'history.db')
+        try:
+            rows = exported(1, 'model', [('hi', 'hello'), ('how are you', 'fine')])
+            assert await history.import_turns(rows) == (4, set())
+            assert await history.import_turns(rows) == (0, set())
+            assert [turn for turn, _, _ in await turns_of(history, 1, 'model')] == [1, 2, 3, 4]
+        finally:
+            await history.close()
+
+    asyncio.run(run())
+
+
+def test_import_carries_on_a_matching_conversation(tmp_path):
+    async def run():
+        history = await open_store(tmp_path / 'history.db')
+        try:
+            await history.add_turn(1, 'model', 'hi', 'hello')
+            rows = exported(1, 'model', [('hi', 'hello'), ('how are you', 'fine')])
+            assert await history.import_turns(rows) == (2, set())
+            assert await turns_of(history, 1, 'model') == [
+                (1, 'user', 'hi'), (2, 'assistant', 'hello'), (3, 'user', 'how are you'), (4, 'assistant', 'fine')
+            ]
+        finally:
+            await history.close()
+
+    asyncio.run(run())
+
+
+def test_conflicting_conversations_are_left_out(tmp_path):
+    async def run():
+        history = await open_store(tmp_path / 'history.db')
+        try:
+            await history.add_turn(1, 'model', 'something else', 'entirely')
+            await history.add_turn(2, 'model', 'hi', 'hello')
+            rows = (exported(1, 'model', [('hi', 'hello'), ('more', 'yes')])
+                    # User 2 has turns 1-2 here; turns 5-6 would leave a gap.
+                    + exported(2, 'model', [('later', 'much later')], start=5)
+                    + exported(3, 'model', [('new', 'user')]))
+            inserted, conflicts = await history.import_turns(rows)
+            assert (inserted, conflicts) == (2, {(1, 'model'), (2, 'model')})
+            assert await turns_of(history, 1, 'model') == [(1, 'user', 'something else'), (2, 'assistant', 'entirely')]
+            assert [turn for turn, _, _ in await turns_of(history, 2, 'model')] == [1, 2]
+            assert [turn for turn, _, _ in await turns_of(history, 3, 'model')] == [1, 2]
+        finally:
+            await history.close()
+
+    asyncio.run(run())
+
+
+def test_import_sees_turns_still_queued_for_writing(tmp_path):
+    async def run():
+        history = HistoryStore(str(tmp_path / 'history.db'), durability='deferred', flush_interval=3600)
+        await history.open()
+        try:
+            await history.add_turn(1, 'model', 'hi', 'hello')
+            assert await history.import_turns(exported(1, 'model', [('hi', 'hello')])) == (0, set())
+            assert await history.import_turns(exported(1, 'model', [('other', 'turn')])) == (0, {(1, 'model')})
+        finally:
+            await history.close()
+
+    asyncio.run(run())
+
+
+def test_export_and_import_round_trip_with_archives(tmp_path):
+    async def run():
+        source = await open_store(tmp_path / 'source.db')
+        target = await open_store(tmp_path / 'target.db')
+        try:
+            for index in range(3):
+                await source.add_turn(1, 'model', f"question {index}", f"answer {index}", guild_id=7)
+            await source.add_turn(2, 'other', 'hi', 'hello')
+            assert await source.archive_turns(1, 'model', 4) == 4
+
+            for compress in (False, True):
+                path = tmp_path / f"export-{compress}.jsonl"
+                assert await history_transfer.export_history(source, str(path), compress=compress) == 8
+                read, inserted, conflicts = await history_transfer.import_history(target, str(path))
+                # The second import finds everything already there.
+                assert (read, inserted, conflicts) == ((8, 8, 0) if not compress else (8, 0, 0))
+
+            assert await turns_of(target, 1, 'model') == [(5, 'user', 'question 2'), (6, 'assistant', 'answer 2')]
+            assert await turns_of(target, 2, 'other') == [(1, 'user', 'hi'), (2, 'assistant', 'hello')]
+            archive = await target.get_archive(1)
+            assert [(model, [row[:3] for row in rows]) for model, rows in archive] == [
+                ('model', [[1, 'user', 'question 0'], [2, 'assistant', 'answer 0'], [3, 'user', 'question 1'], [4, 'assistant', 'answer 1']])
+            ]
+
+            path = tmp_path / 'one-user.jsonl'
+            await history_transfer.export_history(source, str(path), user_id=2)
+            owned = await open_store(tmp_path / 'owned.db')
+            try:
+                assert await history_transfer.import_history(owned, str(path), owns=lambda user_id: user_id != 2) == (0, 0, 0)
+                assert await history_transfer.import_history(owned, str(path)) == (2, 2, 0)
+            finally:
+                await owned.close()
+        finally:
+            await source.close()
+            await target.close()
+
+    asyncio.run(run())
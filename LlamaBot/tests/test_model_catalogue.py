@@ -0,0 +1,87 @@
+import asyncio
+
+from model_catalogue import MAX_CHOICES, ModelCatalogue
+
+MODELS = ['dolphin-mistral', 'llama3:8b', 'Llama3:70b', 'mistral', 'mixtral:8x7b', 'nomic-embed-text', 'codellama']
+
+
+class Pool:
+    def __init__(self, models):
+        self.models = models
+
+    async def refresh(self):
+        return self.models
+
+
+def catalogue(models=MODELS, path='unused.txt'):
+    models_catalogue = ModelCatalogue(Pool(models), path)
+    models_catalogue.update_index(models)
+    return models_catalogue
+
+
+def test_name_prefix_then_word_prefix_then_substring():
+    assert catalogue().search('mis') == ['mistral', 'dolphin-mistral']
+    assert catalogue().search('llama') == ['Llama3:70b', 'llama3:8b', 'codellama']
+    assert catalogue().search('7') == ['Llama3:70b', 'mixtral:8x7b']
+
+
+def test_search_ignores_case_and_surrounding_space():
+    assert catalogue().search('  LLAMA3:7 ') == ['Llama3:70b']
+    assert catalogue().search('nothing') == []
+
+
+def test_recently_used_models_come_first_within_a_tier():
+    models = catalogue()
+    models.record_use(1, 'codellama')
+    models.record_use(1, 'llama3:8b')
+    assert models.search('llama', 1) == ['llama3:8b', 'Llama3:70b', 'codellama']
+    # The tier still comes first, and other users see the plain order.
+    assert models.search('', 1)[:2] == ['llama3:8b', 'codellama']
+    assert models.search('llama', 2) == ['Llama3:70b', 'llama3:8b', 'codellama']
+
+
+def test_recent_models_are_bounded():
+    models = ModelCatalogue(Pool([]), recent_per_user=2, max_users=2)
+    for model in ('a', 'b', 'c', 'b'):
+        models.record_use(1, model)
+    assert list(models.recent[1]) == ['b', 'c']
+    models.record_use(2, 'a')
+    models.record_use(3, 'a')
+    assert list(models.recent) == [2, 3]
+
+
+def test_at_most_25_choices():
+    models = catalogue([f"model-{index:03}" for index in range(100)])
+    assert len(models.search('')) == MAX_CHOICES
+    assert len(models.search('model')) == MAX_CHOICES
+    models.record_use(1, 'model-099')
+    results = models.search('model', 1)
+    assert len(results) == MAX_CHOICES
+    assert results[0] == 'model-099'
+
+
+def test_update_rebuilds_the_index_and_saves_only_changes(tmp_path):
+    path = tmp_path / 'available_models.txt'
+
+    async def run():
+        models = ModelCatalogue(Pool(['b', 'a']), str(path))
+        await models.refresh()
+        assert models.models == ['a', 'b']
+        assert path.read_text() == 'a\nb'
+        assert models.search('a') == ['a']
+
+        path.write_text('changed by hand')
+        await models.update(['a', 'b'])
+        assert path.read_text() == 'changed by hand'
+        # An empty answer, as from a failed refresh, keeps what we had.
+        await models.update([])
+        assert models.models == ['a', 'b']
+
+        await models.update(['c'])
+        assert models.search('a') == [] and models.search('c') == ['c']
+
+        reloaded = ModelCatalogue(Pool([]), str(path))
+        await reloaded.load()
+        assert reloaded.models == ['c']
+
+    asyncio.run(run())
@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from history_store import HistoryStore
+from quota import QuotaExceeded, QuotaManager
+
+
+def response(prompt_tokens, tokens):
+    return {'prompt_eval_count': prompt_tokens, 'eval_count': tokens}
+
+
+def test_admit_until_the_budget_is_used_up():
+    quotas = QuotaManager(None, {'user': {'hour': 1000}, 'guild': {'day': 5000}})
+    assert quotas.admit(1, 7, 100)
+    quotas.charge(1, 7, response(300, 600))
+    assert quotas.admit(1, 7, 100)
+    quotas.charge(1, 7, response(50, 50))
+
+    with pytest.raises(QuotaExceeded) as exceeded:
+        quotas.admit(1, 7, 100)
+    assert (exceeded.value.scope, exceeded.value.window) == ('user', 'hour')
+    assert 0 < exceeded.value.retry_after <= 3600
+    assert quotas.rejected == 1
+    # Other users of the guild still have theirs.
+    assert quotas.admit(2, 7, 100)
+
+
+def test_zero_limit_admits_nothing():
+    quotas = QuotaManager(None, {'user': {'hour': 0}})
+    with pytest.raises(QuotaExceeded) as exceeded:
+        quotas.admit(1, None, 50)
+    assert exceeded.value.retry_after == float('inf')
+    assert "no token budget" in str(exceeded.value)
+    assert quotas.over_budget(1, None, 0) is not None
+
+
+def test_guild_budget_is_shared_by_its_users():
+    quotas = QuotaManager(None, {'guild': {'hour': 1000}})
+    quotas.charge(1, 7, response(500, 500))
+    with pytest.raises(QuotaExceeded) as exceeded:
+        quotas.admit(2, 7, 10)
+    assert exceeded.value.scope == 'guild'
+    assert quotas.admit(2, 8, 10)
+    assert quotas.admit(2, None, 10)
+
+
+def test_deprioritize_instead_of_rejecting():
+    quotas = QuotaManager(None, {'user': {'minute': 100}}, action='deprioritize')
+    quotas.charge(1, None, response(100, 100))
+    assert quotas.admit(1, None, 10) is False
+    assert (quotas.deprioritized, quotas.rejected) == (1, 0)
+
+
+def test_charge_records_usage_per_subject():
+    quotas = QuotaManager(None)
+    quotas.charge(1, 7, response(10, 20))
+    quotas.charge(1, 7, response(1, 2))
+    quotas.charge(2, None, response(5, 5))
+    usage = {(scope, subject_id): value for (scope, subject_id, _), value in quotas.pending.items()}
+    assert usage == {('user', 1): [11, 22, 2], ('guild', 7): [11, 22, 2], ('user', 2): [5, 5, 1]}
+
+
+def test_changed_limit_keeps_what_was_used():
+    quotas = QuotaManager(None, {'user': {'hour': 1000}})
+    quotas.charge(1, None, response(0, 400))
+    quotas.defaults['user']['hour'] = 2000
+    assert quotas.over_budget(1, None, 1590) is None
+    assert quotas.over_budget(1, None, 1610) is not None
+    assert quotas.buckets[('user', 1, 'hour')].capacity == 2000
+
+
+def test_unenforced_scopes_are_drained():
+    quotas = QuotaManager(None, {'user': {'hour': 100}, 'guild': {'hour': 100}}, scopes=('user',))
+    quotas.charge(1, 7, response(100, 100))
+    quotas.charge(2, 7, response(10, 0))
+    assert quotas.admit(3, 7, 10)
+    assert sorted(quotas.drain()) == [['guild', 7, 210]]
+    assert quotas.drain() == []
+    # The guild's usage is still saved with everyone else's.
+    assert any(key[0] == 'guild' for key in quotas.pending)
+
+    gateway = QuotaManager(None, {'guild': {'hour': 100}}, scopes=('guild',))
+    gateway.debit('guild', 7, 210)
+    with pytest.raises(QuotaExceeded):
+        gateway.admit(None, 7, 10)
+
+
+def test_restore_from_saved_usage_and_limits(tmp_path):
+    async def run():
+        history = HistoryStore(str(tmp_path / 'history.db'))
+        await history.open()
+        try:
+            limits = {'user': {'hour': 10000, 'day': 50000}}
+            quotas = QuotaManager(history, limits)
+            await quotas.start()
+            quotas.charge(1, 7, response(1000, 2000))
+            await quotas.set_limit('user', 2, 'hour', 500)
+            await quotas.close()
+
+            restored = QuotaManager(history, limits)
+            await restored.start()
+            try:
+                assert restored.limits('user', 2) == {'hour': 500, 'day': 50000}
+                assert restored.buckets[('user', 1, 'hour')].level == pytest.approx(7000, abs=1)
+                assert restored.buckets[('user', 1, 'day')].level == pytest.approx(47000, abs=1)
+                # Nothing was used by user 2, so there is nothing to restore.
+                assert ('user', 2, 'hour') not in restored.buckets
+                report = await restored.report('user', 1)
+                assert (report['prompt_tokens'], report['tokens'], report['requests']) == (1000, 2000, 1)
+            finally:
+                await restored.close()
+
+            # Only the enforced scopes are restored.
+            guilds = QuotaManager(history, {'guild': {'hour': 10000}}, scopes=('guild',))
+            await guilds.start()
+            try:
+                assert set(guilds.buckets) == {('guild', 7, 'hour')}
+                assert guilds.buckets[('guild', 7, 'hour')].level == pytest.approx(7000, abs=1)
+            finally:
+                await guilds.close()
+        finally:
+            await history.close()
+
+    asyncio.run(run())
@@ -0,0 +1,88 @@
+import importlib
+import random
+import re
+
+renderer = importlib.import_module('cogs.llm-cogs.renderer')
+
+WORDS = ['the', 'model', 'said', 'a', 'sentence.', 'Question?', 'yes!', 'x' * 30, 'café', '**bold**', '\n', '\n\n', '``', 'end']
+
+
+def visible(text):
+    """
+    The text without whitespace, which is all a page boundary may drop.
+    """
+    return re.sub(r'\s', '', text)
+
+
+def random_text(generator, words):
+    return ' '.join(generator.choice(WORDS) for _ in range(words))
+
+
+def test_paginate_keeps_every_character():
+    generator = random.Random(1)
+    for _ in range(300):
+        text = random_text(generator, generator.randrange(0, 400))
+        max_length = generator.choice([10, 37, 100, 2048])
+        pages = renderer.paginate(text, max_length)
+        assert pages
+        assert all(len(page) <= max_length for page in pages)
+        assert visible(''.join(pages)) == visible(text)
+
+
+def test_paginate_prefers_natural_breaks():
+    text = "First paragraph here.\n\nSecond one, which is a bit longer than the first."
+    assert renderer.paginate(text, 40) == ["First paragraph here.", "Second one, which is a bit longer than", "the first."]
+    assert renderer.paginate("a" * 25, 10) == ["a" * 10, "a" * 10, "a" * 5]
+    assert renderer.paginate("", 10) == [""]
+
+
+def test_render_separates_code_and_keeps_the_prose():
+    generator = random.Random(2)
+    for _ in range(200):
+        parts, prose, code = [], [], []
+        for _ in range(generator.randrange(1, 6)):
+            text = random_text(generator, generator.randrange(0, 60)).replace('**', '')
+            if generator.random() < 0.4:
+                language = generator.choice(['', 'python', 'c++', 'objective-c'])
+                parts.append(f"```{language}\n{text}\n```")
+                code.append((language, text))
+            else:
+                parts.append(text)
+                prose.append(text)
+        rendered = renderer.render('\n'.join(parts), 100)
+        assert all(len(page) <= 100 for page in rendered.pages)
+        assert visible(''.join(rendered.pages)) == visible(''.join(prose))
+        assert [(language, visible(block)) for language, block in rendered.code_blocks] == [(language, visible(block)) for language, block in code]
+
+
+def test_render_fixes_markdown_outside_code_only():
+    rendered = renderer.render("**Bold**<br>text\n```py\nx = a ** b\n```\nafter __this__", 2048)
+    assert rendered.pages == ["*Bold*\ntext\n\nafter _this_"]
+    assert rendered.code_blocks == [('py', 'x = a ** b')]
+
+
+def test_unclosed_fence_is_code_to_the_end():
+    rendered = renderer.render("Here:\n```python\nprint('hi')\nprint('still streaming')", 2048)
+    assert rendered.pages == ["Here:"]
+    assert rendered.code_blocks == [('python', "print('hi')\nprint('still streaming')")]
+    # A fence in the middle of a sentence isn't a code block.
+    assert renderer.render("Use ``` to start code.", 2048).pages == ["Use ``` to start code."]
+
+
+def test_preview_shows_the_last_page_with_code_inline():
+    part, page = renderer.render_preview("word " * 50 + "\n```py\nx = 1", 100)
+    assert part == 3
+    assert page.endswith("```py\nx = 1\n```")
+
+
+def test_split_code_keeps_every_line():
+    generator = random.Random(3)
+    for _ in range(200):
+        lines = [''.join(generator.choice('ab ') for _ in range(generator.randrange(0, 30))) for _ in range(generator.randrange(1, 40))]
+        code = '\n'.join(lines)
+        pieces = renderer.split_code(code, 25)
+        assert all(len(piece) <= 25 for piece in pieces)
+        if all(len(line) <= 25 for line in lines):
+            assert '\n'.join(pieces) == code
+        else:
+            assert ''.join(pieces).replace('\n', '') == code.replace('\n', '')
@@ -0,0 +1,142 @@
+import asyncio
+
+import pytest
+
+from response_cache import ResponseCache, cache_key
+
+
+def payload(content, model='model'):
+    return {'model': model, 'messages': [{'role': 'user', 'content': content}], 'options': {'num_ctx': 4096}}
+
+
+class Generator:
+    """
+    A generate() for get_or_generate that counts its calls and answers once released.
+    """
+    def __init__(self, response='response', error=None):
+        self.response = response
+        self.error = error
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+def test_key_depends_on_model_options_and_messages():
+    assert cache_key(payload('hello')) == cache_key(payload('hello'))
+    assert cache_key(payload('hello')) != cache_key(payload('hello', model='other'))
+    assert cache_key(payload('hello')) != cache_key({**payload('hello'), 'options': {'num_ctx': 8192}})
+    # Settings that don't change the response, such as streaming, don't split the cache.
+    assert cache_key(payload('hello')) == cache_key({**payload('hello'), 'stream': True})
+
+
+def test_identical_requests_share_one_generation():
+    async def run():
+        cache = ResponseCache()
+        generate = Generator()
+        requests = [asyncio.create_task(cache.get_or_generate(payload('hello'), generate)) for _ in range(3)]
+        await asyncio.sleep(0)
+        generate.release.set()
+        results = await asyncio.gather(*requests)
+        assert generate.calls == 1
+        assert results == [('response', False), ('response', True), ('response', True)]
+        assert cache.coalesced == 2
+        assert await cache.get_or_generate(payload('hello'), Generator('other')) == ('response', True)
+
+    asyncio.run(run())
+
+
+def test_followers_generate_themselves_when_the_first_request_fails():
+    async def run():
+        cache = ResponseCache()
+        leader = Generator(error=RuntimeError("leader's quota is used up"))
+        followers = Generator('mine')
+        first = asyncio.create_task(cache.get_or_generate(payload('hello'), leader))
+        await asyncio.sleep(0)
+        others = [asyncio.create_task(cache.get_or_generate(payload('hello'), followers)) for _ in range(2)]
+        await asyncio.sleep(0)
+        leader.release.set()
+        with pytest.raises(RuntimeError):
+            await first
+        await asyncio.sleep(0)
+        followers.release.set()
+        # One follower takes over and the other waits for it; neither sees the leader's error.
+        assert sorted(await asyncio.gather(*others)) == [('mine', False), ('mine', True)]
+        assert followers.calls == 1
+        assert not cache.in_flight
+
+    asyncio.run(run())
+
+
+def test_followers_take_over_when_the_first_request_is_cancelled():
+    async def run():
+        cache = ResponseCache()
+        first = asyncio.create_task(cache.get_or_generate(payload('hello'), Generator()))
+        await asyncio.sleep(0)
+        generate = Generator('mine')
+        generate.release.set()
+        follower = asyncio.create_task(cache.get_or_generate(payload('hello'), generate))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await follower == ('mine', False)
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+    asyncio.run(run())
+
+
+def test_least_recently_used_entries_are_evicted():
+    async def run():
+        cache = ResponseCache(max_entries=2)
+        await cache.put('a', 'A')
+        await cache.put('b', 'B')
+        assert await cache.get('a') == 'A'
+        await cache.put('c', 'C')
+        assert await cache.get('b') is None
+        assert await cache.get('a') == 'A'
+        assert await cache.get('c') == 'C'
+
+    asyncio.run(run())
+
+
+def test_expired_entries_are_misses():
+    async def run():
+        cache = ResponseCache(ttl=-1)
+        await cache.put('a', 'A')
+        assert await cache.get('a') is None
+        assert cache.stats()['misses'] == 1
+
+    asyncio.run(run())
+
+
+def test_disk_tier_survives_a_restart_and_is_pruned(tmp_path):
+    path = str(tmp_path / 'responses.db')
+
+    async def run():
+        cache = ResponseCache(max_entries=1, path=path, max_disk_entries=10)
+        await cache.open()
+        try:
+            for index in range(11):
+                await cache.put(str(index), f"response {index}")
+            # Over the limit, so pruned down to nine tenths of it, oldest first.
+            assert cache.disk_entries == 9
+            assert await cache.get('0') is None
+            assert await cache.get('10') == 'response 10'
+        finally:
+            await cache.close()
+
+        reopened = ResponseCache(path=path, max_disk_entries=10)
+        await reopened.open()
+        try:
+            assert reopened.disk_entries == 9
+            assert await reopened.get('5') == 'response 5'
+            assert reopened.stats()['disk_hits'] == 1
+        finally:
+            await reopened.close()
+
+    asyncio.run(run())
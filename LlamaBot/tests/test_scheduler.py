@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from scheduler import QueueFull, RequestScheduler
+
+
+async def served_order(scheduler, requests):
+    """
+    Queue (user_id, guild_id, low_priority) requests behind a held slot, release it and return
+    the user ids in the order the requests got the slot.
+    """
+    order = []
+
+    async def request(user_id, guild_id, low_priority):
+        async with scheduler.slot('model', user_id, guild_id, low_priority=low_priority):
+            order.append(user_id)
+
+    async with scheduler.slot('model', 'holder'):
+        tasks = []
+        for user_id, guild_id, low_priority in requests:
+            tasks.append(asyncio.create_task(request(user_id, guild_id, low_priority)))
+            # Let it queue before the next one, so the queue order is the list order.
+            await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_users_of_a_guild_take_turns():
+    async def run():
+        scheduler = RequestScheduler(max_per_model=1)
+        return await served_order(scheduler, [('a', 1, False), ('a', 1, False), ('a', 1, False), ('b', 1, False)])
+
+    assert asyncio.run(run()) == ['a', 'b', 'a', 'a']
+
+
+def test_guilds_take_turns():
+    async def run():
+        scheduler = RequestScheduler(max_per_model=1)
+        return await served_order(scheduler, [('a', 1, False), ('b', 1, False), ('c', 1, False), ('d', 2, False)])
+
+    assert asyncio.run(run()) == ['a', 'd', 'b', 'c']
+
+
+def test_low_priority_requests_wait_for_everyone_else():
+    async def run():
+        scheduler = RequestScheduler(max_per_model=1)
+        return await served_order(scheduler, [('a', 1, True), ('b', 1, False), ('c', 2, False)])
+
+    assert asyncio.run(run()) == ['b', 'c', 'a']
+
+
+def test_queue_limits():
+    async def run():
+        scheduler = RequestScheduler(max_per_model=1, max_queued=3, max_queued_per_user=2)
+        async with scheduler.slot('model', 'holder'):
+            waiting = [asyncio.create_task(scheduler.acquire('model', 'a', None, None)) for _ in range(2)]
+            await asyncio.sleep(0)
+            with pytest.raises(QueueFull):
+                scheduler.check('a')
+            with pytest.raises(QueueFull):
+                await scheduler.acquire('model', 'a', None, None)
+
+            waiting.append(asyncio.create_task(scheduler.acquire('model', 'b', None, None)))
+            await asyncio.sleep(0)
+            with pytest.raises(QueueFull):
+                await scheduler.acquire('model', 'c', None, None)
+            assert scheduler.stats()['queued'] == 3
+            assert scheduler.rejected == 3
+
+            for task in waiting:
+                task.cancel()
+            await asyncio.gather(*waiting, return_exceptions=True)
+            assert scheduler.stats()['queued'] == 0
+        assert scheduler.stats()['running'] == 0
+
+    asyncio.run(run())
+
+
+def test_waiting_too_long_is_rejected():
+    async def run():
+        scheduler = RequestScheduler(max_per_model=1, max_wait=0.05, position_interval=0.01)
+        async with scheduler.slot('model', 'holder'):
+            with pytest.raises(QueueFull):
+                await scheduler.acquire('model', 'a', None, None)
+            assert scheduler.stats()['queued'] == 0
+
+    asyncio.run(run())
@@ -0,0 +1,555 @@
+import asyncio
+import base64
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+
+import discord
+
+from history_store import estimate_tokens
+from metrics import Metrics
+from quota import QuotaExceeded, QuotaManager
+
+logger = logging.getLogger(__name__)
+
+# Longest line either side may send: a rendered response with its code attachments.
+LINE_LIMIT = 64 * 1024 * 1024
+
+
+class WorkerError(Exception):
+    """
+    Raised when a job fails in a worker process or the worker goes away while running it.
+    """
+
+
+def dump_response(response):
+    """
+    Turn rendered (embeds, files) into plain data that can be sent between processes.
+    """
+    embeds, files = response
+    return {
+        'embeds': [embed.to_dict() for embed in embeds],
+        'files': [{'filename': file.filename, 'data': base64.b64encode(file.fp.read()).decode('ascii')} for file in files]
+    }
+
+
+def load_response(data):
+    embeds = [discord.Embed.from_dict(embed) for embed in data['embeds']]
+    files = [discord.File(io.BytesIO(base64.b64decode(file['data'])), filename=file['filename']) for file in data['files']]
+    return embeds, files
+
+
+def encode(message):
+    return json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+class WorkerServer:
+    """
+    Serves one worker process's jobs to the gateway over a Unix socket.
+
+    Every line is a JSON object. A request {'id', 'op', 'args'} runs the op with the worker's
+    LocalJobs and is answered with any number of {'id', 'event': 'token' | 'position'} lines
+    while it runs, then one 'result' or 'error' line. {'op': 'cancel', 'id'} cancels a job.
+    An event with a 'question' number waits for the gateway to send {'op': 'answer', 'question',
+    'result'} back (see ask()). The worker serves a single gateway connection and stops when it closes.
+    """
+    def __init__(self, jobs, path):
+        self.jobs = jobs
+        self.path = path
+        self.done = asyncio.Event()
+        self.questions = itertools.count(1)
+        self.answers = {}
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle, self.path, limit=LINE_LIMIT)
+        async with server:
+            await self.done.wait()
+
+    async def handle(self, reader, writer):
+        tasks = {}
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                if request['op'] == 'answer':
+                    answer = self.answers.get(request['question'])
+                    if answer is not None and not answer.done():
+                        answer.set_result(request['result'])
+                    continue
+                if request['op'] == 'cancel':
+                    task = tasks.get(request['id'])
+                    if task is not None:
+                        task.cancel()
+                    continue
+                task = tasks[request['id']] = asyncio.create_task(self.run(request, writer))
+                task.add_done_callback(lambda _, job_id=request['id']: tasks.pop(job_id, None))
+        finally:
+            for task in list(tasks.values()):
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            writer.close()
+            self.done.set()
+
+    async def run(self, request, writer):
+        job_id = request['id']
+
+        async def send(event, **data):
+            writer.write(encode({'id': job_id, 'event': event, **data}))
+            await writer.drain()
+
+        try:
+            result = await getattr(self, f"op_{request['op']}")(send, **request['args'])
+        except Exception as e:
+            logger.exception(f"Error running '{request['op']}' in worker: {str(e)}")
+            await send('error', message=str(e))
+            return
+        await send('result', result=result)
+
+    async def ask(self, send, event, **data):
+        """
+        Send an event that the gateway answers, and return its answer.
+        """
+        question = next(self.questions)
+        answer = self.answers[question] = asyncio.get_running_loop().create_future()
+        try:
+            await send(event, question=question, **data)
+            return await answer
+        finally:
+            del self.answers[question]
+
+    async def op_respond(self, send, model, user_id, message, guild_id, regenerate, stream, low_priority):
+        async def on_token(content):
+            await send('token', content=content)
+
+        async def on_position(position):
+            await send('position', position=position)
+
+        return dump_response(await self.jobs.respond(model, user_id, message, guild_id, regenerate, on_token if stream else None, on_position, low_priority))
+
+    async def op_build_response(self, send, response):
+        return dump_response(await self.jobs.build_response(response))
+
+    async def op_take_alternative(self, send, model, user_id, message, guild_id):
+        response = await self.jobs.take_alternative(model, user_id, message, guild_id)
+        return dump_response(response) if response is not None else None
+
+    async def op_last_used_model(self, send, user_id):
+        return await self.jobs.last_used_model(user_id)
+
+    async def op_clear_history(self, send, user_id, model):
+        await self.jobs.clear_history(user_id, model)
+
+    async def op_export_history(self, send, path, user_id, model, compress):
+        return await self.jobs.export_history(path, user_id, model, compress)
+
+    async def op_import_history(self, send, path, shard):
+        return await self.jobs.import_history(path, shard)
+
+    async def op_run_batch(self, send, model, user_id, guild_id, prompts, path):
+        async def on_progress(stats):
+            await send('progress', stats=stats)
+
+        async def admit(tokens):
+            answer = await self.ask(send, 'admit', tokens=tokens)
+            if 'exceeded' in answer:
+                raise QuotaExceeded(*answer['exceeded'])
+            return answer['admitted']
+
+        return await self.jobs.run_batch(model, user_id, guild_id, prompts, path, on_progress, admit if guild_id is not None else None)
+
+    async def op_quota_report(self, send, scope, subject_id):
+        return await self.jobs.quota_report(scope, subject_id)
+
+    async def op_set_quota(self, send, scope, subject_id, window, tokens):
+        await self.jobs.set_quota(scope, subject_id, window, tokens)
+
+    async def op_get_quota_limits(self, send):
+        return await self.jobs.get_quota_limits()
+
+    async def op_get_quota_usage(self, send, since, scope, subject_id):
+        return await self.jobs.get_quota_usage(since, scope, subject_id)
+
+    async def op_drain_quota(self, send):
+        return await self.jobs.drain_quota()
+
+    async def op_flush_quota(self, send):
+        await self.jobs.flush_quota()
+
+    async def op_save_paginator(self, send, user_id, model, message, pages):
+        return await self.jobs.save_paginator(user_id, model, message, pages)
+
+    async def op_update_paginator(self, send, paginator_id, pages):
+        await self.jobs.update_paginator(paginator_id, pages)
+
+    async def op_touch_paginator(self, send, paginator_id, used):
+        await self.jobs.touch_paginator(paginator_id, used)
+
+    async def op_get_paginator(self, send, paginator_id):
+        return await self.jobs.get_paginator(paginator_id)
+
+    async def op_warm(self, send):
+        await self.jobs.warm()
+
+    async def op_report(self, send):
+        return await self.jobs.report()
+
+    async def op_size_report(self, send):
+        return await self.jobs.size_report()
+
+    async def op_compact(self, send):
+        return await self.jobs.compact()
+
+
+class Worker:
+    """
+    The gateway's handle on one worker process: starts it, restarts it if it dies, and runs jobs on it.
+    """
+    def __init__(self, index, count, path, target, start_timeout=120):
+        self.index = index
+        self.count = count
+        self.path = path
+        self.target = target
+        self.start_timeout = start_timeout
+        self.process = None
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.restart_task = None
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.ready = asyncio.Event()
+        self.closing = False
+
+    async def start(self):
+        context = multiprocessing.get_context('spawn')
+        self.process = context.Process(target=self.target, args=(self.index, self.count, self.path), name=f"llamabot-worker-{self.index}", daemon=True)
+        self.process.start()
+        deadline = asyncio.get_running_loop().time() + self.start_timeout
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if not self.process.is_alive():
+                    raise WorkerError(f"Worker {self.index} exited during startup with code {self.process.exitcode}")
+                if asyncio.get_running_loop().time() > deadline:
+                    raise WorkerError(f"Worker {self.index} didn't start within {self.start_timeout}s")
+                await asyncio.sleep(0.1)
+        self.read_task = asyncio.create_task(self.read_loop())
+        self.ready.set()
+        logger.info(f"Worker {self.index} started (pid {self.process.pid})")
+
+    async def read_loop(self):
+        try:
+            while line := await self.reader.readline():
+                message = json.loads(line)
+                queue = self.pending.get(message['id'])
+                if queue is not None:
+                    queue.put_nowait(message)
+        except (ConnectionError, ValueError) as e:
+            logger.error(f"Lost connection to worker {self.index}: {str(e)}")
+        finally:
+            self.ready.clear()
+            for queue in self.pending.values():
+                queue.put_nowait({'event': 'error', 'message': f"Worker {self.index} stopped while running the request."})
+        if not self.closing:
+            logger.error(f"Worker {self.index} stopped unexpectedly, restarting it")
+            self.restart_task = asyncio.create_task(self.restart())
+
+    async def restart(self):
+        await self.stop_process()
+        while not self.closing:
+            try:
+                await self.start()
+                return
+            except WorkerError as e:
+                logger.error(f"Failed to restart worker {self.index}: {str(e)}")
+                await asyncio.sleep(5)
+
+    async def call(self, op, args=None, on_event=None):
+        """
+        Run an op on the worker and return its result. on_event is awaited with the events it sends
+        meanwhile; what it returns for an event with a question is sent back as the answer.
+        """
+        await asyncio.wait_for(self.ready.wait(), self.start_timeout)
+        job_id = next(self.ids)
+        queue = self.pending[job_id] = asyncio.Queue()
+        try:
+            self.writer.write(encode({'id': job_id, 'op': op, 'args': args or {}}))
+            await self.writer.drain()
+            while True:
+                message = await queue.get()
+                if message['event'] == 'result':
+                    return message.get('result')
+                if message['event'] == 'error':
+                    raise WorkerError(message['message'])
+                answer = await on_event(message) if on_event is not None else None
+                if 'question' in message:
+                    self.writer.write(encode({'op': 'answer', 'question': message['question'], 'result': answer}))
+                    await self.writer.drain()
+        except asyncio.CancelledError:
+            if self.ready.is_set() and self.writer is not None:
+                self.writer.write(encode({'id': job_id, 'op': 'cancel'}))
+            raise
+        finally:
+            del self.pending[job_id]
+
+    async def stop_process(self, timeout=30):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        elif self.process is not None:
+            # Cut off while starting: it never had a connection to close, so it won't exit by itself.
+            timeout = 0
+        if self.process is None:
+            return
+        # Closing the connection tells the worker to flush and exit; give it time to do so.
+        await asyncio.get_running_loop().run_in_executor(None, self.process.join, timeout)
+        if self.process.is_alive():
+            if timeout:
+                logger.warning(f"Worker {self.index} didn't exit in time, terminating it")
+            self.process.terminate()
+            await asyncio.get_running_loop().run_in_executor(None, self.process.join, 5)
+        self.process = None
+
+    async def close(self):
+        self.closing = True
+        if self.restart_task is not None:
+            self.restart_task.cancel()
+            await asyncio.gather(self.restart_task, return_exceptions=True)
+            self.restart_task = None
+        await self.stop_process()
+        if self.read_task is not None:
+            await asyncio.gather(self.read_task, return_exceptions=True)
+
+
+class WorkerQuotaStore:
+    """
+    The quota tables of the history store as the gateway's QuotaManager sees them: limits and
+    usage are read and limits written through a worker. Usage is saved by the workers, which
+    charge the requests, so the gateway never writes or prunes any.
+    """
+    def __init__(self, worker):
+        self.worker = worker
+
+    async def get_quota_limits(self):
+        return await self.worker.call('get_quota_limits')
+
+    async def get_quota_usage(self, since, scope=None, subject_id=None):
+        return await self.worker.call('get_quota_usage', {'since': since, 'scope': scope, 'subject_id': subject_id})
+
+    async def set_quota_limit(self, scope, subject_id, window_name, tokens):
+        await self.worker.call('set_quota', {'scope': scope, 'subject_id': subject_id, 'window': window_name, 'tokens': tokens})
+
+    async def add_quota_usage(self, rows):
+        pass
+
+    async def prune_quota_usage(self, before):
+        pass
+
+
+class WorkerPool:
+    """
+    Runs the work behind the commands in worker processes, so the gateway process only handles
+    Discord. Offers the same methods as the cogs' LocalJobs.
+
+    Each worker has its own history store, context builder, scheduler and Ollama connections and
+    talks to the gateway over a Unix socket in socket_dir. Users are assigned to workers by id,
+    so a conversation's caches live in exactly one process. Worker 0 additionally does the work
+    that must only happen once, such as preloading models and vacuuming the database.
+
+    A user's token budget is enforced by their worker, but a guild's users are spread over all
+    of them, so guild budgets are enforced here: requests are admitted against the guild with the
+    tokens of the new message before they are sent to a worker, and every quota_sync_interval
+    seconds the tokens the workers charged to guilds are taken out of the guild's buckets. The
+    prompts of a batch are admitted one by one, the worker asking the gateway for each.
+    """
+    def __init__(self, count, target, metrics, catalogue, socket_dir, paginator_expiry=None, quota_limits=None, quota_action='reject', quota_sync_interval=1.0):
+        self.metrics = metrics
+        self.catalogue = catalogue
+        self.paginator_expiry = paginator_expiry
+        self.workers = [Worker(index, count, os.path.join(socket_dir, f"worker-{index}.sock"), target) for index in range(count)]
+        self.quotas = QuotaManager(WorkerQuotaStore(self.workers[0]), quota_limits, quota_action, scopes=('guild',))
+        self.quota_sync_interval = quota_sync_interval
+        self.quota_task = None
+
+    async def start(self):
+        # The first worker brings the database schema up to date before the others open it.
+        await self.workers[0].start()
+        await asyncio.gather(*(worker.start() for worker in self.workers[1:]))
+        await self.quotas.start()
+        self.quota_task = asyncio.create_task(self.quota_sync_loop())
+
+    async def close(self):
+        if self.quota_task is not None:
+            self.quota_task.cancel()
+            await asyncio.gather(self.quota_task, return_exceptions=True)
+            self.quota_task = None
+        await self.quotas.close()
+        await asyncio.gather(*(worker.close() for worker in self.workers))
+
+    async def quota_sync_loop(self):
+        while True:
+            await asyncio.sleep(self.quota_sync_interval)
+            try:
+                await self.sync_quotas()
+            except Exception as e:
+                logger.exception(f"Failed to collect guild token usage from the workers: {str(e)}")
+
+    async def sync_quotas(self):
+        """
+        Debit the guild buckets with what the running workers charged to guilds since the last sync.
+        """
+        workers = [worker for worker in self.workers if worker.ready.is_set()]
+        for result in await asyncio.gather(*(worker.call('drain_quota') for worker in workers), return_exceptions=True):
+            if isinstance(result, WorkerError):
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            for scope, subject_id, tokens in result:
+                self.quotas.debit(scope, subject_id, tokens)
+
+    def admit_guild(self, guild_id, message):
+        """
+        Check a request's message against the guild's budget. Returns whether it should wait behind
+        everyone else's requests; raises QuotaExceeded if it should be rejected.
+        """
+        return not self.quotas.admit(None, guild_id, estimate_tokens(message))
+
+    def worker_for(self, key):
+        return self.workers[key % len(self.workers)]
+
+    async def last_used_model(self, user_id):
+        return await self.worker_for(user_id).call('last_used_model', {'user_id': user_id})
+
+    async def respond(self, model, user_id, message, guild_id=None, regenerate=False, on_token=None, on_position=None):
+        async def on_event(event):
+            if event['event'] == 'token' and on_token is not None:
+                await on_token(event['content'])
+            elif event['event'] == 'position' and on_position is not None:
+                await on_position(event['position'])
+
+        worker = self.worker_for(user_id)
+        try:
+            low_priority = self.admit_guild(guild_id, message)
+        except QuotaExceeded as e:
+            logger.info(f"Rejected request from user {user_id} for '{model}' over its guild's {e.window} token quota")
+            return load_response(await worker.call('build_response', {'response': str(e)}))
+        args = {'model': model, 'user_id': user_id, 'message': message, 'guild_id': guild_id, 'regenerate': regenerate, 'stream': on_token is not None, 'low_priority': low_priority}
+        result = await worker.call('respond', args, on_event)
+        self.catalogue.record_use(user_id, model)
+        return load_response(result)
+
+    async def take_alternative(self, model, user_id, message, guild_id=None):
+        if self.quotas.over_budget(None, guild_id, estimate_tokens(message)) is not None:
+            return None
+        args = {'model': model, 'user_id': user_id, 'message': message, 'guild_id': guild_id}
+        result = await self.worker_for(user_id).call('take_alternative', args)
+        return load_response(result) if result is not None else None
+
+    async def clear_history(self, user_id, model=None):
+        await self.worker_for(user_id).call('clear_history', {'user_id': user_id, 'model': model})
+
+    async def export_history(self, path, user_id=None, model=None, compress=True):
+        worker = self.worker_for(user_id) if user_id is not None else self.workers[0]
+        return await worker.call('export_history', {'path': path, 'user_id': user_id, 'model': model, 'compress': compress})
+
+    async def import_history(self, path):
+        """
+        Every worker reads the file and loads the users it owns, so their caches stay right.
+        """
+        count = len(self.workers)
+        results = await asyncio.gather(*(worker.call('import_history', {'path': path, 'shard': [index, count]}) for index, worker in enumerate(self.workers)))
+        return tuple(sum(column) for column in zip(*results))
+
+    async def run_batch(self, model, user_id, guild_id, prompts, path, on_progress=None):
+        async def on_event(event):
+            if event['event'] == 'progress' and on_progress is not None:
+                await on_progress(event['stats'])
+            elif event['event'] == 'admit':
+                try:
+                    return {'admitted': self.quotas.admit(None, guild_id, event['tokens'])}
+                except QuotaExceeded as e:
+                    return {'exceeded': [e.scope, e.window, e.retry_after]}
+
+        args = {'model': model, 'user_id': user_id, 'guild_id': guild_id, 'prompts': prompts, 'path': path}
+        return await self.worker_for(user_id).call('run_batch', args, on_event)
+
+    async def quota_report(self, scope, subject_id):
+        """
+        A user's quota lives in its worker and a guild's here, once every worker has reported and saved its usage.
+        """
+        if scope == 'user':
+            return await self.worker_for(subject_id).call('quota_report', {'scope': scope, 'subject_id': subject_id})
+        await self.sync_quotas()
+        await asyncio.gather(*(worker.call('flush_quota') for worker in self.workers))
+        return await self.quotas.report(scope, subject_id)
+
+    async def set_quota(self, scope, subject_id, window, tokens):
+        if scope == 'user':
+            await self.worker_for(subject_id).call('set_quota', {'scope': scope, 'subject_id': subject_id, 'window': window, 'tokens': tokens})
+        else:
+            await self.quotas.set_limit(scope, subject_id, window, tokens)
+
+    async def save_paginator(self, user_id, model, message, pages):
+        return await self.worker_for(user_id).call('save_paginator', {'user_id': user_id, 'model': model, 'message': message, 'pages': pages})
+
+    async def update_paginator(self, paginator_id, pages):
+        await self.worker_for(paginator_id).call('update_paginator', {'paginator_id': paginator_id, 'pages': pages})
+
+    async def touch_paginator(self, paginator_id, used):
+        await self.worker_for(paginator_id).call('touch_paginator', {'paginator_id': paginator_id, 'used': used})
+
+    async def get_paginator(self, paginator_id):
+        return await self.worker_for(paginator_id).call('get_paginator', {'paginator_id': paginator_id})
+
+    async def warm(self):
+        await self.workers[0].call('warm')
+
+    async def report(self):
+        """
+        Combine the workers' reports: metrics states are collected (the gateway's own included),
+        cache counters are added up and model residency is worker 0's.
+        """
+        reports = await asyncio.gather(*(worker.call('report') for worker in self.workers))
+        combined = {
+            'metrics': [self.metrics.state()] + [state for report in reports for state in report['metrics']],
+            'residency': reports[0]['residency']
+        }
+        for name, hits, lookups in (('history_cache', ('hits',), ('hits', 'misses')),
+                                    ('response_cache', ('hits', 'disk_hits'), ('hits', 'disk_hits', 'misses')),
+                                    ('prefetch', None, None),
+                                    ('quota', None, None)):
+            parts = [report[name] for report in reports if report[name] is not None]
+            if name == 'quota':
+                parts.append(self.quotas.stats())
+            if not parts:
+                combined[name] = None
+                continue
+            total = {key: sum(part[key] for part in parts) for key in parts[0] if key != 'hit_rate'}
+            if hits is not None:
+                looked_up = sum(total[key] for key in lookups)
+                total['hit_rate'] = sum(total[key] for key in hits) / looked_up if looked_up else 0.0
+            combined[name] = total
+        return combined
+
+    async def collect_metrics(self):
+        """
+        The metrics of the gateway and every worker together, for the Prometheus endpoint.
+        """
+        return Metrics.merged((await self.report())['metrics'])
+
+    async def size_report(self):
+        return await self.workers[0].call('size_report')
+
+    async def compact(self):
+        """
+        Apply retention in every worker, then let worker 0 expire paginators and vacuum.
+        """
+        results = await asyncio.gather(*(worker.call('compact') for worker in self.workers[1:]))
+        results.append(await self.workers[0].call('compact'))
+        return sum(conversations for conversations, _ in results), sum(rows for _, rows in results)